@@ -3,17 +3,32 @@
 import logging
 import pandas as pd
 import io
+import openpyxl
+import threading
+import time
 from exception import InputError, ParseError
+from log_context import ContextThreadPoolExecutor
 
+PREFIX_CACHE_TTL = 3600
+PREFIX_WORKERS = 8
 
-def parse(attachment, sheetname=None):
+# Audience prefix -> (is_empty, expiry); shared by every ADD validated in this process
+_prefix_cache = {}
+_prefix_lock = threading.Lock()
+
+
+def parse(attachment, sheetname=None, read_only=True):
     """Returns a Pandas DataFrame of the given JIRA attachment
     Args:
         attachment: JIRA attachment object (jira.resources.Attachment)
         sheetname (str): Specific sheetname to parse (optional)
+        read_only (bool): Stream rows with openpyxl's read-only mode instead of loading the
+                          whole workbook (optional)
     Returns:
         add: Pandas DataFrame
     """
+    if attachment and read_only:
+        return parse_read_only(attachment, sheetname)
     if attachment:
         excelfile = pd.ExcelFile(io.BytesIO(attachment))
         if sheetname:
@@ -29,6 +44,36 @@ def parse(attachment, sheetname=None):
     return None
 
 
+def parse_read_only(attachment, sheetname=None):
+    """ Returns a Pandas DataFrame of the given JIRA attachment, streaming rows in read-only mode.
+        As with parse(), the first row is the header and columns are numbered from 0.
+    Args:
+        attachment: JIRA attachment object (jira.resources.Attachment)
+        sheetname (str): Specific sheetname to parse (optional)
+    Returns:
+        add: Pandas DataFrame
+    """
+    workbook = openpyxl.load_workbook(io.BytesIO(attachment), read_only=True, data_only=True)
+    try:
+        if sheetname:
+            if sheetname not in workbook.sheetnames:
+                logging.log(40, "Invalid sheetname: {}. In file: {}".format(sheetname, workbook.sheetnames))
+                return None
+            sheet = workbook[sheetname]
+        else:
+            sheet = workbook.worksheets[0]
+        values = sheet.values
+        next(values, None)
+        rows = list(values)
+        # Read-only sheets report formatted but empty trailing rows; pandas trims them too
+        while rows and all(cell is None for cell in rows[-1]):
+            rows.pop()
+    finally:
+        workbook.close()
+    add = pd.DataFrame(rows, dtype=object)
+    return add.where(add.notna(), float('nan'))
+
+
 def get_rows(add):
     """Returns number of rows in file"""
     rows = len(add[0])
@@ -37,20 +82,113 @@ def get_rows(add):
 
 def get_audience_file(add, row, input_folder, input_prefix, aws):
     """Gets audience file field"""
-    try:
-        audience_file = str(add[1][row]).strip()
-    except Exception as e:
-        raise ParseError("Unable to parse audience file: (B{})\n{}".format(row+1, e))
+    return get_audience_files(add, [row], input_folder, input_prefix, aws)[0]
 
-    prefix = input_prefix.format(audience_file=audience_file, input_folder=input_folder)
 
-    if aws.is_empty(prefix):
-        # Audience file isn't in S3
-        msg = "Input-ADD Error: Invalid audience file: {}. Please revise ADD (Cell B{}).".format(audience_file, row+1)
-        logging.log(40, msg)
-        return msg
+def get_audience_files(add, rows, input_folder, input_prefix, aws, workers=PREFIX_WORKERS, ttl=PREFIX_CACHE_TTL):
+    """ Gets audience file fields for many rows, checking each distinct S3 prefix only once
+    Args:
+        add: Pandas DataFrame of the ADD
+        rows (int or list(int)): Number of rows, or specific row indexes
+        input_folder (str): Audience input folder
+        input_prefix (str): Audience S3 prefix template
+        aws: AWS object
+        workers (int): Number of concurrent S3 checks
+        ttl (int): Seconds a prefix check stays cached
+    Returns:
+        List of audience files, or error messages for rows with invalid audience files
+    """
+    rows = range(rows) if isinstance(rows, int) else rows
+    audience_files, prefixes = [], []
+    for row in rows:
+        try:
+            audience_file = str(add[1][row]).strip()
+        except Exception as e:
+            raise ParseError("Unable to parse audience file: (B{})\n{}".format(row+1, e))
+        audience_files.append(audience_file)
+        prefixes.append(input_prefix.format(audience_file=audience_file, input_folder=input_folder))
+
+    empty = check_prefixes(set(prefixes), aws, workers, ttl)
+
+    fields = []
+    for row, audience_file, prefix in zip(rows, audience_files, prefixes):
+        if empty[prefix]:
+            # Audience file isn't in S3
+            msg = "Input-ADD Error: Invalid audience file: {}. Please revise ADD (Cell B{}).".format(audience_file, row+1)
+            logging.log(40, msg)
+            fields.append(msg)
+        else:
+            fields.append(audience_file)
+    return fields
+
+
+def check_prefixes(prefixes, aws, workers=PREFIX_WORKERS, ttl=PREFIX_CACHE_TTL):
+    """ Checks which S3 prefixes are empty, concurrently and through a TTL cache
+    Args:
+        prefixes (set(str)): S3 prefixes
+        aws: AWS object
+        workers (int): Number of concurrent S3 checks
+        ttl (int): Seconds a result stays cached
+    Returns:
+        Dict of prefix to is_empty
+    """
+    now = time.time()
+    results = {}
+    with _prefix_lock:
+        for prefix in prefixes:
+            cached = _prefix_cache.get(prefix)
+            if cached and cached[1] > now:
+                results[prefix] = cached[0]
+
+    missing = [prefix for prefix in prefixes if prefix not in results]
+    if missing:
+        with ContextThreadPoolExecutor(max_workers=min(workers, len(missing))) as pool:
+            checked = dict(zip(missing, pool.map(aws.is_empty, missing)))
+        with _prefix_lock:
+            for prefix, is_empty in checked.items():
+                _prefix_cache[prefix] = (is_empty, now + ttl)
+        results.update(checked)
+    logging.log(20, "Checked {} audience prefixes ({} cached)".format(len(prefixes), len(prefixes) - len(missing)))
+    return results
+
+
+def validate_columns(add):
+    """ Validates the Pixel ID, Profile IDs and targeted flag columns of the whole ADD in a few
+        vectorized passes. Values and messages match get_pixel_id, get_profile_ids and
+        get_targeted_flag row for row.
+    Args:
+        add: Pandas DataFrame of the ADD
+    Returns:
+        Dict of 'pixel_id', 'profile_ids' and 'targeted' lists (one value or error message per
+        row) and 'errors', every error message with its cell reference
+    """
+    for column, name in [(2, 'Pixel ID'), (3, 'Profile IDs'), (4, 'targeted flag')]:
+        if column not in add.columns:
+            raise ParseError("Unable to parse {}: column {} missing".format(name, 'ABCDE'[column]))
+    cells = pd.Series(range(1, len(add) + 1), index=add.index).astype(str)
+
+    pixel_ids = add[2].astype(str).str.strip().str.replace('.0', '', regex=False)
+    pixel_ids = pixel_ids.where(pixel_ids.str.isdigit(),
+                                "Input-ADD Error: Invalid Pixel/LineItem ID: " + pixel_ids + ". (Cell C" + cells + "). Expected only digits.")
+
+    profile_ids = add[3].astype(str).str.replace(' ', '', regex=False).str.replace('.0', '', regex=False)
+    blank = profile_ids.isin(['None', 'nan'])
+    digits = profile_ids.str.split(',').explode().str.isdigit().groupby(level=0).all()
+    profile_ids = profile_ids.where(digits | blank,
+                                    "Input-ADD Error: Invalid Profile IDs: " + profile_ids + ". (Cell D" + cells + "). Expected only digits.")
+    profile_ids = profile_ids.astype(object).where(~blank, None)
 
-    return audience_file
+    expected = ['Y', 'N']
+    targeted = add[4].astype(str).str.strip().str.upper()
+    targeted = targeted.where(targeted.isin(expected),
+                              "Input-ADD Error: Invalid targeted flag: " + targeted + ". (Cell E" + cells + "). Expected: {}.".format(expected))
+
+    fields = {'pixel_id': pixel_ids.tolist(), 'profile_ids': profile_ids.tolist(), 'targeted': targeted.tolist()}
+    fields['errors'] = [value for column in fields.values() for value in column
+                        if value is not None and value.startswith('Input-ADD Error')]
+    for msg in fields['errors']:
+        logging.log(40, msg)
+    return fields
 
 
 def get_pixel_id(add, row):
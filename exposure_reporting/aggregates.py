@@ -0,0 +1,187 @@
+"""This module builds a report's WEEKLY counts and DUPLICATES histogram locally from its sorted
+Exposure File, in place of the Hive queries (see queries.get_queries include_weekly and
+include_duplicates), with the same values and formatting as the Hive output.
+
+The counts are taken from the chunks chunk_tap hands out while the sorted file streams through the
+sort or gzip pass, so the file is not read again. Each chunk holds complete CUST_ID groups, so
+distinct counts can simply be summed across chunks.
+
+As in the Exposure File, NULL and empty strings cannot be told apart, and both are treated as NULL.
+
+Exported Classes
+ExposureAggregates
+
+Exported Functions
+format_java
+write_csv
+"""
+
+import csv
+import os
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+import chunk_tap
+from exception import FileError
+from queries import parse_duplicate_buckets
+
+
+def format_java(text):
+    """ Formats a float's shortest decimal string the way Hive writes doubles and floats
+        (Java toString: plain between 10^-3 and 10^7, else d.dddEn)
+    Args:
+        text (str): Shortest round-trip string, e.g. repr of a double or str of a numpy.float32
+    Returns:
+        Formatted string
+    """
+    value = Decimal(text)
+    if value == 0:
+        return '0.0'
+    if Decimal('0.001') <= abs(value) < Decimal('10000000'):
+        plain = format(value, 'f')
+        return plain if '.' in plain else plain + '.0'
+    sign, digits, exponent = value.normalize().as_tuple()
+    digits = ''.join(str(digit) for digit in digits)
+    return '{}{}.{}E{}'.format('-' if sign else '', digits[0], digits[1:] or '0', len(digits) + exponent - 1)
+
+
+def write_csv(file, headers, rows):
+    """ Writes a header row and rows of already formatted values, as download_csv(stream=True) does.
+        The file is written next to file and renamed over it, never rewritten in place, since file
+        may be a hardlink into the download cache.
+    Args:
+        file (str): File to write
+        headers (list(str)): File headers
+        rows (list(list(str))): Rows of values
+    """
+    tmp_file = '{}.tmp'.format(file)
+    try:
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(headers)
+            for row in rows:
+                f.write(','.join(row) + '\n')
+        os.replace(tmp_file, file)
+    except Exception as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise FileError("File write failed: {}\n{}".format(file, e))
+
+
+class ExposureAggregates(object):
+    """
+    A class used to compute the WEEKLY and DUPLICATES outputs of a report from its Exposure File
+
+    Parameters
+    ----------
+    start_dates, end_dates: list(str)
+        Bucket boundaries from queries.create_splits
+    granularity: str
+        day, week or month, as used for queries.create_splits
+    duplicate_buckets: str or list
+        Duplicate buckets, see queries.parse_duplicate_buckets
+
+    Methods
+    -------
+    aggregate_file(file)
+        Reads a whole sorted Exposure File (gzipped if its name ends in .gz)
+    update(df)
+        Adds a chunk of complete CUST_ID groups
+    get_weekly_rows()
+        Returns the WEEKLY rows, as get_weekly_queries writes them
+    get_duplicate_row(report_num, campaign_name)
+        Returns the DUPLICATES row, as get_duplicate_queries writes it
+    """
+
+    def __init__(self, start_dates, end_dates, granularity="week", duplicate_buckets=None):
+        self.start_dates = start_dates
+        self.end_dates = end_dates
+        self.granularity = granularity
+        self.buckets = parse_duplicate_buckets(duplicate_buckets) if isinstance(duplicate_buckets, str) \
+            else duplicate_buckets or parse_duplicate_buckets()
+        self.start = datetime.strptime(start_dates[0], "%Y-%m-%d %H:%M:%S")
+        self.weekly_counts = defaultdict(int)
+        self.weekly_customers = defaultdict(int)
+        self.duplicates = [0] * len(self.buckets)
+        self.exposed_customers = 0
+
+    def aggregate_file(self, file, delimiter='|', chunk_rows=chunk_tap.CHUNK_ROWS):
+        """ Reads a whole sorted Exposure File (gzipped if its name ends in .gz), for when no pass streamed it
+        Args:
+            file (str): Exposure File sorted by CUST_ID
+            delimiter (str): File delimiter
+            chunk_rows (int): Rows per chunk
+        Returns:
+            self
+        """
+        chunk_tap.read_file(file, [self], delimiter, chunk_rows)
+        return self
+
+    def get_bucket(self, timestamps):
+        """ Numbers each timestamp's bucket from 1, as queries.get_bucket_expression does in Hive
+        Args:
+            timestamps: Series of timestamp strings
+        Returns:
+            Series of bucket numbers (NaN where the date cannot be parsed)
+        """
+        dates = pd.to_datetime(timestamps.str[:10], format="%Y-%m-%d", errors='coerce')
+        if self.granularity == "month":
+            return (dates.dt.year - self.start.year) * 12 + dates.dt.month - self.start.month + 1
+        days = (dates - pd.Timestamp(self.start.date())).dt.days
+        if self.granularity == "day":
+            return days + 1
+        return np.floor(days / 7) + 1
+
+    def update(self, df):
+        """ Adds a chunk of complete CUST_ID groups
+        Args:
+            df: DataFrame with CUST_ID, IMPRESSION_TIMESTAMP and CREATIVE_ID columns
+        """
+        exposed = df[(df['IMPRESSION_TIMESTAMP'] != '') & (df['CUST_ID'] != '')]
+        if exposed.empty:
+            return
+        self.exposed_customers += exposed['CUST_ID'].nunique()
+
+        # WEEKLY: impressions and distinct CUST_IDs per bucket within the date range
+        timestamps = exposed['IMPRESSION_TIMESTAMP']
+        in_range = exposed[(timestamps >= self.start_dates[0]) & (timestamps < self.end_dates[-1])]
+        if not in_range.empty:
+            weekly = pd.DataFrame({'BUCKET': self.get_bucket(in_range['IMPRESSION_TIMESTAMP']),
+                                   'CUST_ID': in_range['CUST_ID']}).dropna()
+            grouped = weekly.groupby('BUCKET')['CUST_ID'].agg(['size', 'nunique'])
+            for bucket, row in grouped.iterrows():
+                self.weekly_counts[int(bucket)] += int(row['size'])
+                self.weekly_customers[int(bucket)] += int(row['nunique'])
+
+        # DUPLICATES: distinct CUST_IDs with a (CUST_ID, IMPRESSION_TIMESTAMP, CREATIVE_ID) key in each bucket
+        keyed = exposed[exposed['CREATIVE_ID'] != '']
+        if not keyed.empty:
+            qty = keyed.groupby(['CUST_ID', 'IMPRESSION_TIMESTAMP', 'CREATIVE_ID']).size()
+            customers = qty.index.get_level_values(0)
+            for i, (count, condition) in enumerate(self.buckets):
+                mask = qty.values >= count if condition == '>=' else qty.values == count
+                self.duplicates[i] += customers[mask].nunique()
+
+    def get_weekly_rows(self):
+        """Returns the WEEKLY rows, as get_weekly_queries writes them"""
+        rows = []
+        for i, start in enumerate(self.start_dates):
+            bucket = i + 1
+            count = self.weekly_counts.get(bucket, 0)
+            customers = self.weekly_customers.get(bucket, 0)
+            average = format_java(repr(count / float(customers))) if customers else ''
+            rows.append([str(bucket), datetime.strptime(start, "%Y-%m-%d %H:%M:%S").strftime("%m/%d/%Y"),
+                         str(count), average])
+        return rows
+
+    def get_duplicate_row(self, report_num, campaign_name):
+        """Returns the DUPLICATES row, as get_duplicate_queries writes it"""
+        if self.exposed_customers:
+            percentage = format_java(str(np.float32(sum(self.duplicates) / float(self.exposed_customers) * 100)))
+        else:
+            percentage = ''
+        return [str(report_num), campaign_name] + [str(count) for count in self.duplicates] + [percentage]
@@ -1,47 +1,132 @@
+import csv
+import hashlib
 import io
 import logging
-import boto3
 import pandas as pd
+import connections
+import transfer
 from exception import ConfigError, FileError
 
 
 class AWS(object):
-    def __init__(self, key, secret_key, bucket):
+    def __init__(self, key, secret_key, bucket, concurrency=None, chunk_size=None, upload_concurrency=None,
+                 download_cache=None):
         self._key = key
         self._secret_key = secret_key
         self._bucket = bucket
+        self._concurrency = concurrency or transfer.DEFAULT_CONCURRENCY
+        self._chunk_size = chunk_size or transfer.DEFAULT_CHUNK_SIZE
+        self._upload_concurrency = upload_concurrency or transfer.DEFAULT_CONCURRENCY
+        self._download_cache = download_cache
 
     def check_keys(self):
         """Checks validity of class """
         try:
-            session = boto3.Session(self._key, self._secret_key)
+            session = connections.get_session(self._key, self._secret_key)
         except Exception as e:
             raise ConfigError("Config Error: Check AWS credentials")
 
     def download(self, src, dst):
-        """ Downloads a file from S3
+        """ Downloads all objects under an S3 prefix into one file, concatenated in key order.
+            Objects are split into ranged GETs that run concurrently (see transfer.py).
+            With a download cache, unchanged objects are linked from the cache instead.
         Args:
             self: AWS object
             src: S3 prefix
             dst: zfs_path + file
         """
-        session = boto3.Session(self._key, self._secret_key)
-        bucket = session.resource("s3").Bucket(self._bucket)
+        if self._download_cache:
+            self._download_cache.fetch(self._bucket, src, self._get_cache_etag(src), dst,
+                                       lambda file: self._download(src, file))
+        else:
+            self._download(src, dst)
+
+    def build_cached(self, src, dst, build, etag=None, variant=''):
+        """ Builds a local file from the objects under an S3 prefix (e.g. the sorted gzip Exposure File)
+            through the download cache, so an unchanged prefix is not streamed and built again
+        Args:
+            src: S3 prefix
+            dst: Local file to create
+            build: Function building the file at the path it is given
+            etag: Composite ETag of src, if already known (optional)
+            variant: Anything else that changes the built bytes (optional)
+        Returns:
+            True if dst was linked from the cache, else False
+        """
+        if not self._download_cache:
+            build(dst)
+            return False
+        return self._download_cache.fetch(self._bucket, src, etag or self._get_cache_etag(src), dst, build,
+                                          variant=variant)
+
+    def _download(self, src, dst):
+        """ Downloads all objects under an S3 prefix into one file (see download) """
         try:
-            with open(dst, 'wb') as outfile:
-                for key in bucket.objects.filter(Prefix=src):
-                    outfile.write(key.get()["Body"].read())
+            client, objects = self._get_transfer_objects(src)
+            transfer.download_objects(client, self._bucket, objects, dst,
+                                      concurrency=self._concurrency,
+                                      chunk_size=self._chunk_size)
         except Exception as e:
             raise FileError("File download from {} to {} failed.\n{}".format(src, dst, e))
 
-    def download_csv(self, src, dst, delimiter=',', headers=None):
+    def stream(self, src):
+        """ Streams all objects under an S3 prefix in key order, without writing to disk
+        Args:
+            src: S3 prefix
+        Returns:
+            Generator of bytes chunks
+        """
+        client, objects = self._get_transfer_objects(src)
+        return transfer.stream_objects(client, self._bucket, objects,
+                                       concurrency=self._concurrency,
+                                       chunk_size=self._chunk_size)
+
+    def stream_parts(self, src):
+        """ Streams all objects under an S3 prefix in key order (see stream), with their sizes so
+            callers can tell where each object ends
+        Args:
+            src: S3 prefix
+        Returns:
+            List of object sizes, generator of bytes chunks
+        """
+        client, objects = self._get_transfer_objects(src)
+        objects = [obj for obj in objects if obj.size != 0]
+        return [obj.size for obj in objects], transfer.stream_objects(client, self._bucket, objects,
+                                                                       concurrency=self._concurrency,
+                                                                       chunk_size=self._chunk_size)
+
+    def _get_transfer_objects(self, src):
+        """ Gets an S3 client sized for the transfer concurrency and the objects under a prefix
+        Args:
+            src: S3 prefix
+        """
+        return self._get_client(), self.get_keys(src)
+
+    def _get_client(self):
+        """ Gets the shared S3 client, with a connection pool that fits the transfer concurrency """
+        return connections.get_client(self._key, self._secret_key,
+                                      pool_size=max(self._concurrency, self._upload_concurrency))
+
+    def download_csv(self, src, dst, delimiter=',', headers=None, stream=False):
         """ Downloads a CSV file from S3
         Args:
             src (str or list(str)): Single S3 prefix or list of S3 prefixes
             dst (str): zfs_path + filename
             delimiter (str): File delimiter
             headers (list(str)): List of file headers (optional)
+            stream (bool): Write the header once and copy object bodies through in order,
+                           without building DataFrames (optional)
         """
+        if self._download_cache:
+            variant = repr((delimiter, headers, stream))
+            self._download_cache.fetch(self._bucket, src, self._get_cache_etag(src), dst,
+                                       lambda file: self._download_csv(src, file, delimiter, headers, stream),
+                                       variant=variant)
+        else:
+            self._download_csv(src, dst, delimiter, headers, stream)
+
+    def _download_csv(self, src, dst, delimiter=',', headers=None, stream=False):
+        """ Downloads a CSV file from S3 (see download_csv) """
         if type(src) == str:
             keys = self.get_keys(src)
         elif type(src) == list:
@@ -50,6 +135,9 @@ class AWS(object):
                 k = self.get_keys(s)
                 keys.extend(k)
 
+        if stream:
+            return self.stream_csv(keys, src, dst, delimiter, headers)
+
         files = []
         for key in keys:
             file = self.get_file_from_key(key, delimiter)
@@ -67,47 +155,75 @@ class AWS(object):
         else:
             raise FileError("Files to download are empty: {}".format(src))
 
+    def stream_csv(self, keys, src, dst, delimiter=',', headers=None):
+        """ Writes a header row, then copies S3 object bodies into one file in key order.
+            Memory use is bounded by the transfer window, regardless of the number of objects.
+        Args:
+            keys (list): S3 ObjectSummary objects to concatenate
+            src (str or list(str)): S3 prefix(es) the keys came from, for error messages
+            dst (str): zfs_path + filename
+            delimiter (str): File delimiter
+            headers (list(str)): List of file headers (optional)
+        """
+        objects = [key for key in keys if key.size != 0]
+        if not objects:
+            raise FileError("Files to download are empty: {}".format(src))
+
+        sizes = iter([obj.size for obj in objects])
+        remaining = next(sizes)
+        try:
+            with open(dst, 'wb') as outfile:
+                if headers:
+                    header = io.StringIO()
+                    csv.writer(header, delimiter=delimiter, lineterminator='\n').writerow(headers)
+                    outfile.write(header.getvalue().encode('utf-8'))
+                for data in transfer.stream_objects(self._get_client(), self._bucket, objects,
+                                                    concurrency=self._concurrency,
+                                                    chunk_size=self._chunk_size):
+                    outfile.write(data)
+                    remaining -= len(data)
+                    if remaining == 0:
+                        # Keep object boundaries on line boundaries
+                        if not data.endswith(b'\n'):
+                            outfile.write(b'\n')
+                        remaining = next(sizes, None)
+        except Exception as e:
+            raise FileError("File download failed: {}\n{}".format(dst, e))
+
     def upload(self, src, dst):
-        """ Uploads file from filesystem to S3
+        """ Uploads file from filesystem to S3 as a concurrent multipart upload (see transfer.py)
         Args:
             src: zfs_path + filename
             dst: S3 prefix + filename
         """
-        s3 = boto3.client("s3", aws_access_key_id=self._key, aws_secret_access_key=self._secret_key)
-        fin = open(src, "rb")
-        mpu = s3.create_multipart_upload(Bucket=self._bucket, Key=dst)
-        chunk_size = 10485760
-        parts = []
-        part_number = 0
-        chunk_read, chunk_write = "", ""
-
-        while True:
-            chunk_read = fin.read(chunk_size)
-            if chunk_write:
-                part_number += 1
-                chunk_to_load = chunk_write
-                part = s3.upload_part(Body=chunk_to_load, Bucket=self._bucket,
-                                      Key=dst, PartNumber=part_number,
-                                      UploadId=mpu["UploadId"])
-                parts.append({"ETag": part["ETag"], "PartNumber": part_number})
-            if len(chunk_read) == 0:
-                fin.close()
-                break
-            chunk_write = chunk_read
-        resp = s3.complete_multipart_upload(Bucket=self._bucket, Key=dst,
-                                            MultipartUpload={"Parts": parts},
-                                            UploadId=mpu["UploadId"])
+        try:
+            transfer.upload_file(self._get_client(), self._bucket, src, dst,
+                                 concurrency=self._upload_concurrency)
+        except Exception as e:
+            raise FileError("File upload from {} to {} failed.\n{}".format(src, dst, e))
+
+    def assemble(self, src, dst):
+        """ Concatenates all objects under an S3 prefix, in key order, into one S3 object with a
+            multipart copy, without downloading them (see transfer.py)
+        Args:
+            src: S3 prefix
+            dst: S3 prefix + filename
+        """
+        try:
+            objects = [key for key in self.get_keys(src) if key.size != 0]
+            if not objects:
+                raise FileError("Files to assemble are empty: {}".format(src))
+            transfer.assemble_objects(self._get_client(), self._bucket, objects, dst,
+                                      concurrency=self._upload_concurrency)
+        except Exception as e:
+            raise FileError("File assembly from {} to {} failed.\n{}".format(src, dst, e))
 
     def get_keys(self, prefix):
         """ Gets keys in a specified prefix
         Args:
             prefix: S3 prefix
         """
-        session = boto3.Session(
-            aws_access_key_id=self._key,
-            aws_secret_access_key=self._secret_key,
-        )
-        s3 = session.resource('s3')
+        s3 = connections.get_resource(self._key, self._secret_key)
         #s3 = boto3.resource('s3')
         bucket = s3.Bucket(self._bucket)
         keys = list(bucket.objects.filter(Prefix=prefix))
@@ -118,7 +234,7 @@ class AWS(object):
         Args:
             prefix: S3 prefix
         """
-        client = boto3.client("s3", aws_access_key_id=self._key, aws_secret_access_key=self._secret_key)
+        client = self._get_client()
         response = client.list_objects_v2(
             Bucket=self._bucket,
             Prefix=prefix
@@ -129,6 +245,62 @@ class AWS(object):
         else:
             return False
 
+    def get_etag(self, prefix):
+        """ Gets a composite ETag for all objects under a prefix, which changes if any object
+            under it is added, removed or rewritten
+        Args:
+            prefix: S3 prefix
+        Returns:
+            Hex digest string, or None if the prefix is empty
+        """
+        keys = self.get_keys(prefix)
+        if not keys:
+            return None
+        md5 = hashlib.md5()
+        for key in sorted(keys, key=lambda k: k.key):
+            md5.update('{}:{}:{}\n'.format(key.key, key.e_tag, key.size).encode('utf-8'))
+        return md5.hexdigest()
+
+    def _get_cache_etag(self, src):
+        """ Gets the download cache ETag for one or more prefixes
+        Args:
+            src (str or list(str)): Single S3 prefix or list of S3 prefixes
+        Returns:
+            ETag string, or None (not cached) if any prefix is empty
+        """
+        etags = [self.get_etag(prefix) for prefix in (src if isinstance(src, list) else [src])]
+        if None in etags:
+            return None
+        return '|'.join(etags)
+
+    def read_object(self, key):
+        """ Reads a small S3 object into memory
+        Args:
+            key: S3 key
+        Returns:
+            bytes, or None if the object does not exist
+        """
+        client = self._get_client()
+        try:
+            return client.get_object(Bucket=self._bucket, Key=key)['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+
+    def write_object(self, key, body):
+        """ Writes a small S3 object from memory
+        Args:
+            key: S3 key
+            body: bytes or str
+        """
+        self._get_client().put_object(Bucket=self._bucket, Key=key, Body=body)
+
+    def delete_object(self, key):
+        """ Deletes an S3 object
+        Args:
+            key: S3 key
+        """
+        self._get_client().delete_object(Bucket=self._bucket, Key=key)
+
     def get_file_from_key(self, key, delimiter):
         """ Gets a file object from an S3 key object
         Args:
@@ -0,0 +1,139 @@
+################################################################################
+#
+#    Filename: benchmark.py
+#
+#    Description: Benchmarks for the post-processing stages of the Exposure
+#                 Reporting automation. Compares the original implementation
+#                 of each stage against its replacement on the same input.
+#
+#    Usage: python benchmark.py download [S3 PREFIX]
+#           python benchmark.py zip --size-mb 4096 --workers 2 4 8
+#
+################################################################################
+
+from argparse import ArgumentParser
+from configparser import ConfigParser
+import gzip
+import hashlib
+import os
+import random
+import tempfile
+import time
+import zfs
+from cfg import CFG
+
+
+def sequential_download(key, secret_key, bucket_name, src, dst):
+    """Original AWS.download loop: one object at a time, whole body in memory"""
+    import boto3
+    session = boto3.Session(key, secret_key)
+    bucket = session.resource("s3").Bucket(bucket_name)
+    with open(dst, 'wb') as outfile:
+        for obj in bucket.objects.filter(Prefix=src):
+            outfile.write(obj.get()["Body"].read())
+
+
+def checksum(file, opener=open):
+    """Gets md5 hex digest of a file"""
+    md5 = hashlib.md5()
+    with opener(file, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def timed(func, *args, **kwargs):
+    """Returns seconds taken by func(*args, **kwargs)"""
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def report(name, seconds, file):
+    """Prints one benchmark result line"""
+    size = os.path.getsize(file)
+    print("{:<32} {:>9.2f}s {:>10.1f} MB/s  {}".format(name, seconds, size / 1048576.0 / max(seconds, 0.001), checksum(file)))
+
+
+def bench_download(config, args):
+    """Sequential loop vs the ranged-GET transfer engine for one S3 prefix"""
+    from aws import AWS
+    key = os.environ['AWS_ACCESS_KEY']
+    secret_key = os.environ['AWS_SECRET']
+    bucket = config.get_field('aws', 'bucket')
+    workdir = tempfile.mkdtemp(dir=args.path)
+    keys = AWS(key, secret_key, bucket).get_keys(args.prefix)
+    print("input: s3://{}/{}, {} objects, {} bytes, {} cpus".format(bucket, args.prefix, len(keys),
+                                                                  sum(obj.size for obj in keys), os.cpu_count()))
+
+    baseline = os.path.join(workdir, 'sequential.txt')
+    report('sequential', timed(sequential_download, key, secret_key, bucket, args.prefix, baseline), baseline)
+    os.remove(baseline)
+
+    for concurrency in args.concurrency:
+        aws_conn = AWS(key, secret_key, bucket, concurrency=concurrency, chunk_size=args.chunk_size)
+        dst = os.path.join(workdir, 'engine_{}.txt'.format(concurrency))
+        report('engine (concurrency={})'.format(concurrency), timed(aws_conn.download, args.prefix, dst), dst)
+        os.remove(dst)
+    os.rmdir(workdir)
+
+
+def write_exposure_file(file, size_mb):
+    """Writes a synthetic pipe-delimited exposure file of roughly size_mb megabytes"""
+    rng = random.Random(0)
+    target = size_mb * 1048576
+    written = 0
+    with open(file, 'w') as f:
+        while written < target:
+            lines = []
+            for _ in range(10000):
+                exposed = rng.random() < 0.7
+                lines.append('{}|{}|{}|{}|{}|{}|{}|{}\n'.format(
+                    rng.randint(10000000, 99999999),
+                    '2023-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+                                                                   rng.randint(0, 59), rng.randint(0, 59)) if exposed else '',
+                    rng.choice(['A', 'B', 'C', 'D']), rng.randint(1, 99), rng.choice(['M', 'F', 'U']), rng.randint(18, 80),
+                    rng.randint(100000, 999999) if exposed else '', rng.randint(1000, 9999) if exposed else ''))
+            block = ''.join(lines)
+            f.write(block)
+            written += len(block)
+
+
+def bench_zip(config, args):
+    """Single-threaded zfs.zip vs block-parallel compression on a synthetic exposure file"""
+    workdir = tempfile.mkdtemp(dir=args.path)
+    file = os.path.join(workdir, 'exposure.txt')
+    write_exposure_file(file, args.size_mb)
+    print("input: {} bytes, md5 {}, {} cpus".format(os.path.getsize(file), checksum(file), os.cpu_count()))
+
+    for workers in [1] + args.workers:
+        name = 'zfs.zip' if workers == 1 else 'parallel (workers={})'.format(workers)
+        seconds = timed(zfs.zip, file, workers)
+        zipfile = file + '.gz'
+        print("{:<32} {:>9.2f}s {:>10.1f} MB/s  {:>12} bytes  decompressed md5 {}".format(
+            name, seconds, args.size_mb / max(seconds, 0.001), os.path.getsize(zipfile), checksum(zipfile, gzip.open)))
+        os.remove(zipfile)
+    os.remove(file)
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--path', '-p', type=str, default=None, help='Scratch directory (defaults to system temp)')
+    subparsers = parser.add_subparsers(dest='stage')
+
+    download_parser = subparsers.add_parser('download')
+    download_parser.add_argument('prefix', type=str)
+    download_parser.add_argument('--concurrency', '-c', type=int, nargs='+', default=[4, 8, 16, 32])
+    download_parser.add_argument('--chunk-size', type=int, default=8388608)
+    download_parser.set_defaults(func=bench_download)
+
+    zip_parser = subparsers.add_parser('zip')
+    zip_parser.add_argument('--size-mb', type=int, default=2048)
+    zip_parser.add_argument('--workers', '-w', type=int, nargs='+', default=[2, 4, 8])
+    zip_parser.set_defaults(func=bench_zip)
+
+    args = parser.parse_args()
+    configfile = ConfigParser()
+    configfile.read('config.ini')
+    args.func(CFG(configfile), args)
@@ -0,0 +1,207 @@
+"""This module keeps a per-ticket checkpoint on the ZFS volume so a restarted run can resume
+where the last one stopped instead of starting over.
+
+The checkpoint is one JSON file per ticket, rewritten atomically (write to a temporary file, then
+rename) after every change. It records:
+    jobs        Datanado job instance ID, last known status and query hash, per job name
+    downloads   Local files already downloaded, with the composite ETag of their S3 source
+    sorted      Local files already sorted
+    compressed  Local files already compressed
+    delivered   S3 delivery objects already written
+    comments    JIRA comments already posted
+    plan        Values that must be reused so resumed queries match launched ones
+
+Next to it, a lock file is held (flock) for as long as a run of the ticket is alive. The OS drops
+the lock when the process dies, so a restarted batch can tell a crashed run it should resume from
+one still running elsewhere.
+
+Exported Classes
+Checkpoint
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+
+
+class Checkpoint(object):
+    """
+    A class used to record and query the completed stages of a ticket
+
+    Parameters
+    ----------
+    path: str
+        Directory for the checkpoint file (the ticket's ZFS path)
+    ticket: str
+        Ticket key
+
+    Methods
+    -------
+    get_job(name)
+        Returns (job_instance_id, status) of a Datanado job, or (None, None)
+    set_job(name, job_instance_id, status, query_hash)
+        Records a launched job or its new status
+    get_job_hash(name)
+        Returns the hash of the query a job was launched with, or None
+    drop_job(name)
+        Forgets a job, so it is launched again
+    is_downloaded(file, etag)
+        Returns True if file exists and was downloaded from a source with this ETag
+    set_downloaded(file, etag)
+        Records a finished download
+    is_done(stage, file)
+        Returns True if the stage ('sorted', 'compressed' or 'delivered') finished for file
+    set_done(stage, file)
+        Records a finished stage
+    has_comment(name) / set_comment(name)
+        Checks / records a posted JIRA comment
+    get_plan(name, default) / set_plan(name, value) / drop_plan(name)
+        Gets / records / forgets a value the query plan must reuse on resume
+    lock() / unlock()
+        Takes / releases the ticket's run lock
+    is_abandoned()
+        Returns True if a run of the ticket started and its process has since died
+    clear()
+        Deletes the checkpoint once the ticket is complete
+    """
+
+    def __init__(self, path, ticket):
+        self.file = os.path.join(path, '.checkpoint_{}.json'.format(ticket))
+        self.lock_file = os.path.join(path, '.checkpoint_{}.lock'.format(ticket))
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self.state = {'ticket': ticket, 'jobs': {}, 'downloads': {}, 'sorted': [], 'compressed': [],
+                      'delivered': [], 'comments': [], 'plan': {}}
+        if os.path.exists(self.file):
+            try:
+                with open(self.file) as f:
+                    self.state.update(json.load(f))
+                logging.log(20, "Resuming {} from checkpoint {}".format(ticket, self.file))
+            except ValueError as e:
+                logging.log(30, "Ignoring unreadable checkpoint {}\n{}".format(self.file, e))
+
+    def save(self):
+        """Writes the checkpoint atomically"""
+        tmp_file = '{}.tmp'.format(self.file)
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file)
+
+    def get_job(self, name):
+        """Returns (job_instance_id, status) of a Datanado job, or (None, None)"""
+        job = self.state['jobs'].get(str(name))
+        if job is None:
+            return None, None
+        return job['id'], job['status']
+
+    def set_job(self, name, job_instance_id, status, query_hash=None):
+        """ Records a launched job or its new status
+        Args:
+            name: Job name, e.g. the report number
+            job_instance_id: Datanado job instance ID
+            status (str): Job status
+            query_hash (str): Hash of the job's query (optional, kept from the last call for the same job)
+        """
+        with self._lock:
+            job = self.state['jobs'].get(str(name), {})
+            if query_hash is None and job.get('id') == job_instance_id:
+                query_hash = job.get('hash')
+            self.state['jobs'][str(name)] = {'id': job_instance_id, 'status': status, 'hash': query_hash}
+            self.save()
+
+    def get_job_hash(self, name):
+        """Returns the hash of the query a job was launched with, or None"""
+        return self.state['jobs'].get(str(name), {}).get('hash')
+
+    def drop_job(self, name):
+        """Forgets a job, so it is launched again"""
+        with self._lock:
+            if self.state['jobs'].pop(str(name), None) is not None:
+                self.save()
+
+    def is_downloaded(self, file, etag):
+        """Returns True if file exists and was downloaded from a source with this ETag"""
+        return etag is not None and os.path.exists(file) and self.state['downloads'].get(file) == etag
+
+    def set_downloaded(self, file, etag):
+        """Records a finished download, which invalidates any later stage done on the old file"""
+        with self._lock:
+            self.state['downloads'][file] = etag
+            for stage in ('sorted', 'compressed'):
+                if file in self.state[stage]:
+                    self.state[stage].remove(file)
+            self.save()
+
+    def is_done(self, stage, file):
+        """Returns True if the stage ('sorted', 'compressed' or 'delivered') finished for file"""
+        return file in self.state[stage]
+
+    def set_done(self, stage, file):
+        """Records a finished stage"""
+        with self._lock:
+            if file not in self.state[stage]:
+                self.state[stage].append(file)
+            self.save()
+
+    def has_comment(self, name):
+        """Returns True if the named JIRA comment was posted"""
+        return name in self.state['comments']
+
+    def set_comment(self, name):
+        """Records a posted JIRA comment"""
+        self.set_done('comments', name)
+
+    def get_plan(self, name, default=None):
+        """Gets a value the query plan must reuse on resume"""
+        return self.state['plan'].get(name, default)
+
+    def set_plan(self, name, value):
+        """Records a value the query plan must reuse on resume"""
+        with self._lock:
+            self.state['plan'][name] = value
+            self.save()
+
+    def drop_plan(self, name):
+        """Forgets a value of the query plan, so it is made afresh"""
+        with self._lock:
+            if self.state['plan'].pop(name, None) is not None:
+                self.save()
+
+    def lock(self):
+        """ Takes the ticket's run lock, which the OS releases if the process dies
+        Returns:
+            True, or False if another run holds it
+        """
+        fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def unlock(self):
+        """Releases the ticket's run lock"""
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def is_abandoned(self):
+        """Returns True if a run of the ticket started (the lock file exists) and no run holds its lock"""
+        if not os.path.exists(self.lock_file) or not self.lock():
+            return False
+        self.unlock()
+        return True
+
+    def clear(self):
+        """Deletes the checkpoint once the ticket is complete"""
+        if os.path.exists(self.file):
+            os.remove(self.file)
+        if os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
+        self.unlock()
@@ -0,0 +1,216 @@
+"""This module hands the lines of a sorted Exposure File to pandas consumers (stats.ExposureStats,
+aggregates.ExposureAggregates) in chunks, either while the file streams through a pass we already
+make (the sort or the gzip) or, if no pass ran, by reading the finished file.
+
+A ChunkTap is written to alongside the pass's output (see zfs.sort_to_gzip and zfs.zip). Writes
+are only appended to a buffer; full blocks go on a bounded queue to a background thread, which
+parses them with the pandas C parser and does all of the consumers' work, so the pass itself does
+no per-line work for them. The queue blocks the pass only if the consumers fall that far behind.
+
+The file is sorted by CUST_ID, so every CUST_ID's rows are contiguous. GroupChunks carries the rows
+of the last CUST_ID of a chunk over to the next one; each chunk a consumer sees then holds complete
+CUST_ID groups, and distinct CUST_ID counts can simply be summed across chunks.
+
+As in the Exposure File, NULL and empty strings cannot be told apart, and both are read as ''.
+
+Exported Classes
+GroupChunks
+ChunkTap
+
+Exported Functions
+read_chunks
+read_file
+"""
+
+import csv
+import io
+import queue
+
+import pandas as pd
+
+import log_context
+from exception import FileError
+
+EXPOSURE_COLUMNS = ['CUST_ID', 'IMPRESSION_TIMESTAMP', 'ATTRIBUTE_1', 'ATTRIBUTE_2', 'ATTRIBUTE_3',
+                    'ATTRIBUTE_4', 'CREATIVE_ID', 'PLACEMENT_ID']
+USED_COLUMNS = ['CUST_ID', 'IMPRESSION_TIMESTAMP', 'CREATIVE_ID', 'PLACEMENT_ID']
+CHUNK_ROWS = 1000000
+BLOCK_BYTES = 16777216
+QUEUE_BLOCKS = 4
+
+
+def read_chunks(source, delimiter='|', chunk_rows=None):
+    """ Parses Exposure File lines into DataFrames of the columns the consumers use
+    Args:
+        source: File name (gzipped if it ends in .gz) or binary file object
+        delimiter (str): File delimiter
+        chunk_rows (int): Rows per chunk; None parses everything into one DataFrame
+    Returns:
+        DataFrame, or an iterator of DataFrames if chunk_rows is set
+    """
+    # latin-1 maps every byte to one character, so no line can fail to decode
+    return pd.read_csv(source, sep=delimiter, header=None, names=EXPOSURE_COLUMNS, usecols=USED_COLUMNS,
+                       index_col=False, dtype=str, na_filter=False, quoting=csv.QUOTE_NONE, encoding='latin-1',
+                       chunksize=chunk_rows, compression='infer' if isinstance(source, str) else None)
+
+
+def read_file(file, consumers, delimiter='|', chunk_rows=CHUNK_ROWS):
+    """ Hands a whole sorted Exposure File to consumers, for when no pass streamed it
+    Args:
+        file (str): Exposure File, sorted by CUST_ID, gzipped if its name ends in .gz
+        consumers (list): Objects with an update(df) method
+        delimiter (str): File delimiter
+        chunk_rows (int): Rows per chunk
+    """
+    chunks = GroupChunks(consumers, file)
+    for chunk in read_chunks(file, delimiter, chunk_rows):
+        chunks.add(chunk)
+    chunks.finish()
+
+
+class GroupChunks(object):
+    """
+    A class used to split sorted DataFrame chunks into chunks of complete CUST_ID groups
+
+    Parameters
+    ----------
+    consumers: list
+        Objects with an update(df) method, called with each chunk of complete groups
+    name: str
+        File name for errors
+
+    Methods
+    -------
+    add(chunk)
+        Adds the next chunk of the file
+    finish()
+        Hands the last CUST_ID group to the consumers
+    """
+
+    def __init__(self, consumers, name=''):
+        self.consumers = consumers
+        self.name = name
+        self.carry = None
+
+    def add(self, chunk):
+        """Adds the next chunk of the file; raises FileError if it is not sorted by CUST_ID"""
+        chunk = chunk.fillna('')
+        if chunk.empty:
+            return
+        if not chunk['CUST_ID'].is_monotonic_increasing or \
+                (self.carry is not None and chunk['CUST_ID'].iat[0] < self.carry['CUST_ID'].iat[0]):
+            raise FileError("Exposure File is not sorted by CUST_ID: {}".format(self.name))
+        if self.carry is not None:
+            chunk = pd.concat([self.carry, chunk], ignore_index=True)
+        last = chunk['CUST_ID'] == chunk['CUST_ID'].iat[-1]
+        self.carry = chunk[last]
+        self._update(chunk[~last])
+
+    def finish(self):
+        """Hands the last CUST_ID group to the consumers"""
+        if self.carry is not None:
+            self._update(self.carry)
+            self.carry = None
+
+    def _update(self, df):
+        if df.empty:
+            return
+        for consumer in self.consumers:
+            consumer.update(df)
+
+
+class ChunkTap(object):
+    """
+    A class used to hand the lines written by a pass to consumers on a background thread
+
+    Parameters
+    ----------
+    consumers: list
+        Objects with an update(df) method, see GroupChunks
+    name: str
+        File name for errors
+    delimiter: str
+        File delimiter
+    block_bytes: int
+        Bytes buffered before a block is queued
+    queue_blocks: int
+        Blocks queued before write blocks
+
+    Methods
+    -------
+    write(data)
+        Adds bytes written by the pass; writes need not end on line boundaries
+    close()
+        Waits for the consumers to see every line; raises the consumers' error, if any
+    cancel()
+        Stops the background thread without finishing, e.g. after the pass failed
+    """
+
+    def __init__(self, consumers, name='', delimiter='|', block_bytes=BLOCK_BYTES, queue_blocks=QUEUE_BLOCKS):
+        self.chunks = GroupChunks(consumers, name)
+        self.delimiter = delimiter
+        self.block_bytes = block_bytes
+        self.error = None
+        self._buffer = bytearray()
+        self._queue = queue.Queue(queue_blocks)
+        self._thread = log_context.start_thread(self._consume, name='chunk-tap', daemon=True)
+
+    def write(self, data):
+        """Adds bytes written by the pass; writes need not end on line boundaries"""
+        self._buffer += data
+        if len(self._buffer) >= self.block_bytes:
+            self._queue.put(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        """Waits for the consumers to see every line; raises the consumers' error, if any"""
+        if self._buffer:
+            self._queue.put(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        """Stops the background thread without finishing, e.g. after the pass failed"""
+        self._buffer = bytearray()
+        self.error = self.error or FileError("Cancelled")
+        self._queue.put(None)
+        self._thread.join()
+
+    def _consume(self):
+        """Parses queued blocks into chunks of whole lines until the end marker"""
+        rest = b''
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            if self.error is not None:
+                # Keep draining so the pass never blocks on a full queue
+                continue
+            try:
+                data = rest + block
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                if end:
+                    self._add(data[:end])
+            except Exception as e:
+                self.error = e
+        if self.error is None:
+            try:
+                if rest:
+                    self._add(rest)
+                self.chunks.finish()
+            except Exception as e:
+                self.error = e
+
+    def _add(self, data):
+        """Parses whole lines and adds them to the chunks"""
+        try:
+            chunk = read_chunks(io.BytesIO(data), self.delimiter)
+        except pd.errors.EmptyDataError:
+            # Only blank lines
+            return
+        self.chunks.add(chunk)
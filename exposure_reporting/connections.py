@@ -0,0 +1,111 @@
+"""This module keeps a process-wide pool of boto3 sessions, clients and resources, so credentials
+and HTTP connection pools are set up once per process instead of once per call.
+
+Sessions and clients are shared by all threads (session creation is serialized, clients are
+thread-safe). Resources are not thread-safe, so each thread gets its own. Every lookup is counted
+so reuse can be logged at the end of a run.
+
+Exported Functions
+get_session
+get_client
+get_resource
+get_stats
+log_stats
+"""
+
+import logging
+import threading
+from collections import Counter
+import boto3
+from botocore.config import Config
+
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_local = threading.local()
+_sessions = {}
+_clients = {}
+_stats = Counter()
+
+
+def get_session(key, secret_key):
+    """ Gets the shared boto3 Session for a set of credentials
+    Args:
+        key (str): AWS access key
+        secret_key (str): AWS secret key
+    Returns:
+        boto3.Session
+    """
+    with _lock:
+        return _get_session(key, secret_key)
+
+
+def _get_session(key, secret_key):
+    """Gets or creates a session; the caller holds _lock"""
+    session = _sessions.get((key, secret_key))
+    if session is None:
+        session = boto3.Session(aws_access_key_id=key, aws_secret_access_key=secret_key)
+        _sessions[(key, secret_key)] = session
+        _stats['sessions_created'] += 1
+    else:
+        _stats['sessions_reused'] += 1
+    return session
+
+
+def get_client(key, secret_key, pool_size=None, service='s3'):
+    """ Gets the shared client for a set of credentials. The client is rebuilt with a larger HTTP
+        connection pool if a caller needs more concurrent connections than it was created with.
+    Args:
+        key (str): AWS access key
+        secret_key (str): AWS secret key
+        pool_size (int): Number of concurrent connections the caller will use (optional)
+        service (str): AWS service name
+    Returns:
+        boto3 client
+    """
+    pool_size = max(pool_size or 0, DEFAULT_POOL_SIZE)
+    with _lock:
+        cached = _clients.get((key, secret_key, service))
+        if cached is not None and cached[0] >= pool_size:
+            _stats['clients_reused'] += 1
+            return cached[1]
+        session = _get_session(key, secret_key)
+        client = session.client(service, config=Config(max_pool_connections=pool_size))
+        _clients[(key, secret_key, service)] = (pool_size, client)
+        _stats['clients_created'] += 1
+        return client
+
+
+def get_resource(key, secret_key, service='s3'):
+    """ Gets this thread's boto3 resource for a set of credentials
+    Args:
+        key (str): AWS access key
+        secret_key (str): AWS secret key
+        service (str): AWS service name
+    Returns:
+        boto3 resource
+    """
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+    resource = resources.get((key, secret_key, service))
+    if resource is None:
+        with _lock:
+            resource = _get_session(key, secret_key).resource(service)
+            _stats['resources_created'] += 1
+        resources[(key, secret_key, service)] = resource
+    else:
+        with _lock:
+            _stats['resources_reused'] += 1
+    return resource
+
+
+def get_stats():
+    """Returns a copy of the creation and reuse counters"""
+    with _lock:
+        return dict(_stats)
+
+
+def log_stats():
+    """Logs the creation and reuse counters"""
+    logging.log(20, "AWS connection pool: {}".format(get_stats()))
@@ -3,10 +3,18 @@ using 3AMP API Security (https://confluence.oracledatacloud.com/display/SAuth/3A
 also manages the POST request to the Datanado API
 (https://confluence.oracledatacloud.com/pages/viewpage.action?spaceKey=DKB&title=Execute+or+Run+Datanado+Job).
 
+Jobs are followed by a DatanadoWatcher, which polls the job status service for any number of
+job instances from one asyncio event loop over a single pooled HTTP session.
+
 Exported Classes
 DatanadoClient
+DatanadoWatcher
+
+Exported Functions
+watch_jobs
 """
 
+import asyncio
 import datetime
 import hashlib
 import hmac
@@ -15,8 +23,12 @@ import email.utils
 import base64
 import json
 import os
-import time
 import logging
+from requests.adapters import HTTPAdapter
+
+STATUS_URL = 'http://datanado-job-status-service-prod.prd-use1-eks-b.k8s.oracledatacloud.com/api/v1/orchestrationStatus/{}'
+IN_PROGRESS = "IN_PROGRESS"
+SUCCESS = "SUCCESS"
 
 
 class DatanadoClient:
@@ -108,22 +120,7 @@ class DatanadoClient:
 
     def watch_datanado_job(self, job_instance_id):
         """Returns 'True' for successful job completion, else returns 'False'"""
-        job_status = "IN_PROGRESS"
-        while job_status == "IN_PROGRESS":
-            time.sleep(60)
-            response = requests.get(
-                'http://datanado-job-status-service-prod.prd-use1-eks-b.k8s.oracledatacloud.com/api/v1/orchestrationStatus/{}'
-                .format(job_instance_id),
-            )
-            logging.log(20, json.loads(response.text).get("job-status"))
-            job_status = json.loads(response.text).get("job-status")
-
-        if job_status == "SUCCESS":
-            logging.log(20, "Datanado job {} completed".format(job_instance_id))
-            return True
-        else:
-            logging.log(40, "Datanado job {} failed.".format(job_instance_id))
-            return False
+        return watch_jobs([job_instance_id])[job_instance_id]
 
     def _get_json_payload(self):
         """Returns jsonified payload"""
@@ -200,3 +197,139 @@ class DatanadoClient:
                       'x-content-sha256 content-type content-length", signature="{1}"'.format(self.client_id, signature)
 
         return auth_header
+
+
+class DatanadoWatcher:
+    """
+    A class used to follow many Datanado job instances at once
+
+    Each job is polled by its own coroutine. Status requests share one requests.Session (and its
+    connection pool) and run in the event loop's thread pool, so a slow response never holds up
+    the other jobs. Polling starts at min_interval and backs off geometrically up to max_interval;
+    when a job's expected duration is known, the interval is capped at half the time remaining so
+    polls tighten as the job nears completion.
+
+    Parameters
+    ----------
+    min_interval: float
+        Shortest wait between polls of one job, in seconds
+    max_interval: float
+        Longest wait between polls of one job, in seconds
+    backoff: float
+        Factor the wait grows by after each poll
+    max_errors: int
+        Consecutive failed status requests before a job is treated as failed
+    session: requests.Session
+        Session to poll with (optional, one is created if not given)
+
+    Methods
+    -------
+    watch(job_instance_id, expected_duration=None, callback=None)
+        Starts watching a job and returns an asyncio.Task resolving to True on success
+    watch_all(job_instance_ids, expected_duration=None, callback=None)
+        Watches jobs until all finish and returns {job_instance_id: succeeded}
+    get_status(job_instance_id)
+        Returns the current job status string
+    close()
+        Closes the HTTP session
+    """
+
+    def __init__(self, min_interval=30, max_interval=60, backoff=1.5, max_errors=5, session=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.statuses = {}
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=32))
+        self.session = session
+
+    def watch(self, job_instance_id, expected_duration=None, callback=None):
+        """ Starts watching a job; must be called from a running event loop
+        Args:
+            job_instance_id: Datanado job instance ID
+            expected_duration (float): Expected seconds until the job finishes (optional)
+            callback: Called as callback(job_instance_id, succeeded) when the job finishes (optional)
+        Returns:
+            asyncio.Task resolving to True for a successful job, else False
+        """
+        return asyncio.get_running_loop().create_task(self._poll(job_instance_id, expected_duration, callback))
+
+    async def watch_all(self, job_instance_ids, expected_duration=None, callback=None):
+        """ Watches jobs until every one has finished
+        Args:
+            job_instance_ids (list): Datanado job instance IDs
+            expected_duration (float): Expected seconds until the jobs finish (optional)
+            callback: Called as callback(job_instance_id, succeeded) as each job finishes (optional)
+        Returns:
+            {job_instance_id: succeeded}
+        """
+        tasks = [self.watch(job_instance_id, expected_duration, callback) for job_instance_id in job_instance_ids]
+        results = await asyncio.gather(*tasks)
+        return dict(zip(job_instance_ids, results))
+
+    def get_status(self, job_instance_id):
+        """Returns the current job status string"""
+        response = self.session.get(STATUS_URL.format(job_instance_id), timeout=60)
+        return json.loads(response.text).get("job-status")
+
+    def close(self):
+        """Closes the HTTP session"""
+        self.session.close()
+
+    async def _poll(self, job_instance_id, expected_duration, callback):
+        """Polls one job until it leaves IN_PROGRESS"""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        interval = self.min_interval
+        errors = 0
+        job_status = IN_PROGRESS
+        while job_status == IN_PROGRESS:
+            await asyncio.sleep(self._get_interval(interval, loop.time() - start_time, expected_duration))
+            try:
+                job_status = await asyncio.to_thread(self.get_status, job_instance_id)
+                errors = 0
+            except Exception as e:
+                errors += 1
+                logging.log(30, "Status request for Datanado job {} failed ({} of {})\n{}".format(job_instance_id, errors, self.max_errors, e))
+                if errors >= self.max_errors:
+                    job_status = None
+                continue
+            self.statuses[job_instance_id] = job_status
+            logging.log(20, "Datanado job {}: {}".format(job_instance_id, job_status))
+            interval = min(interval * self.backoff, self.max_interval)
+
+        succeeded = job_status == SUCCESS
+        if succeeded:
+            logging.log(20, "Datanado job {} completed".format(job_instance_id))
+        else:
+            logging.log(40, "Datanado job {} failed.".format(job_instance_id))
+        if callback is not None:
+            callback(job_instance_id, succeeded)
+        return succeeded
+
+    def _get_interval(self, interval, elapsed, expected_duration):
+        """Caps the backed-off interval at half the time a job is expected to have left"""
+        if expected_duration:
+            remaining = expected_duration - elapsed
+            if remaining > 0:
+                interval = min(interval, remaining / 2.0)
+        return max(self.min_interval, interval)
+
+
+def watch_jobs(job_instance_ids, expected_duration=None, callback=None, **kwargs):
+    """ Blocks until every job has finished, watching them all concurrently
+    Args:
+        job_instance_ids (list): Datanado job instance IDs
+        expected_duration (float): Expected seconds until the jobs finish (optional)
+        callback: Called as callback(job_instance_id, succeeded) as each job finishes (optional)
+        kwargs: DatanadoWatcher parameters
+    Returns:
+        {job_instance_id: succeeded}
+    """
+    watcher = DatanadoWatcher(**kwargs)
+    try:
+        return asyncio.run(watcher.watch_all(job_instance_ids, expected_duration, callback))
+    finally:
+        watcher.close()
@@ -0,0 +1,160 @@
+"""This module keeps a local cache of downloaded S3 files on the ZFS volume, so re-running a ticket
+does not download unchanged objects again. Files built from a download (e.g. the sorted gzip
+Exposure File, see aws.AWS.build_cached) are cached the same way, so they are not built again.
+
+Entries are keyed by bucket, source prefix(es), the composite ETag of the source objects and a
+variant string for anything else that changes the local bytes (e.g. CSV headers). A hit is linked
+into the ticket directory with a hardlink, or a reflink (FICLONE) where hardlinks are not possible,
+falling back to a copy. Entries are evicted least recently used first once the cache is over its
+size quota. Caches on the same path share one lock, so an entry is never evicted while a ticket
+links it; an entry that vanishes anyway (e.g. evicted by another process) is treated as a miss.
+
+Callers must replace, never rewrite in place, a file they got from the cache, since a hardlinked
+file shares its data with the cache entry (zfs.external_sort already replaces the file).
+
+Exported Classes
+DownloadCache
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst):
+    """ Makes dst a hardlink, reflink or copy of src, in that order of preference
+    Returns:
+        'hardlink', 'reflink' or 'copy'
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return 'reflink'
+    except OSError:
+        shutil.copyfile(src, dst)
+        return 'copy'
+
+
+class DownloadCache(object):
+    """
+    A class used to fetch S3 downloads through a local LRU cache
+
+    Parameters
+    ----------
+    path: str
+        Cache directory, on the same filesystem as the ticket directories for hardlinks to work
+    quota_bytes: int
+        Total size the cache is trimmed to after each new entry
+
+    Methods
+    -------
+    fetch(bucket, src, etag, dst, download, variant='')
+        Puts the file for (bucket, src, etag, variant) at dst, calling download(file) on a miss
+    evict()
+        Deletes least recently used entries until the cache fits its quota
+    """
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path, quota_bytes):
+        self.path = path
+        self.quota_bytes = quota_bytes
+        os.makedirs(path, exist_ok=True)
+        with DownloadCache._locks_lock:
+            self._lock = DownloadCache._locks.setdefault(os.path.realpath(path), threading.Lock())
+
+    def get_entry(self, bucket, src, etag, variant=''):
+        """Returns the cache file path for a download"""
+        key = '\0'.join([bucket, str(src), etag, variant])
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def fetch(self, bucket, src, etag, dst, download, variant=''):
+        """ Puts the downloaded file at dst, from the cache if it holds an entry with the same ETag
+        Args:
+            bucket (str): S3 bucket
+            src (str or list(str)): S3 prefix(es) downloaded
+            etag (str): Composite ETag of the source objects; None disables caching
+            dst (str): Local file to create
+            download: Function downloading the file to the path it is given
+            variant (str): Anything else that changes the downloaded bytes (optional)
+        Returns:
+            True on a cache hit, else False
+        """
+        if etag is None:
+            download(dst)
+            return False
+
+        entry = self.get_entry(bucket, src, etag, variant)
+        with self._lock:
+            method = self.link_entry(entry, dst)
+        if method:
+            logging.log(20, "Download cache hit for {} ({})".format(dst, method))
+            return True
+
+        fd, tmp_file = tempfile.mkstemp(prefix='.download_', dir=self.path)
+        os.close(fd)
+        try:
+            download(tmp_file)
+            with self._lock:
+                os.replace(tmp_file, entry)
+                link_or_copy(entry, dst)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        logging.log(20, "Download cache stored {}".format(dst))
+        self.evict(keep=entry)
+        return False
+
+    def link_entry(self, entry, dst):
+        """ Links a cache entry to dst; call with the lock held
+        Returns:
+            'hardlink', 'reflink' or 'copy', or None if the entry is not cached
+        """
+        try:
+            os.utime(entry)
+            return link_or_copy(entry, dst)
+        except FileNotFoundError:
+            return None
+
+    def evict(self, keep=None):
+        """ Deletes least recently used entries until the cache fits its quota
+        Args:
+            keep (str): Entry that must not be evicted (optional)
+        Returns:
+            Number of entries evicted
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.path, name)))
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            for _, size, entry in sorted(entries):
+                if total <= self.quota_bytes:
+                    break
+                if entry == keep:
+                    continue
+                os.remove(entry)
+                total -= size
+                evicted += 1
+        if evicted:
+            logging.log(20, "Download cache evicted {} entries, {} bytes in use".format(evicted, total))
+        return evicted
@@ -1,5 +1,6 @@
 # exposure_report.py
 
+from collections import OrderedDict
 from datetime import datetime, timedelta, date
 import os
 import logging
@@ -12,33 +13,57 @@ import add
 import emailer
 #import qubole
 import jira_util
+import connections
+import result_cache
+import stats
+import aggregates
+import chunk_tap
+from download_cache import DownloadCache
 from aws import AWS
 from jira_util import Jira
 #from qcb import QCBConnection
-from datanado import DatanadoClient
+from datanado import DatanadoClient, watch_jobs
 from report import Report
+from checkpoint import Checkpoint
 from s3 import S3Tools
+from exception import FileError
+from log_context import ContextThreadPoolExecutor
 
 
 class ExposureReport(object):
-    def __init__(self, config, issue):
+    def __init__(self, config, issue, isolate_zfs=False, shares=1):
         """ Sets the config and issue for an ExposureReport instance
         Args:
             config: CFG class instance
             issue: JIRA issue object
+            isolate_zfs (bool): Keep this ticket's files in its own ZFS directory, for running
+                                tickets concurrently (optional)
+            shares (int): Number of tickets running at once; the per-pod sort, gzip and transfer
+                          budgets in the config are split evenly between them (optional)
         """
         self.config = config
         self.issue = issue
+        self.isolate_zfs = isolate_zfs
+        self.shares = max(1, shares or 1)
         #self.s3_bucket = self.config.get_field('aws', 's3_bucket')
         self.logger = logging.log
 
     def run(self, rerun=False):
         """ Run an Exposure Report ticket
         Args:
-            rerun (bool): Flag to overwrite queries or not
+            rerun (bool): Run the queries again instead of reusing cached or checkpointed outputs
         """
         # Set necessary connections
         self.logger(20, "Running ticket: {}".format(self.issue.key))
+
+        # Completed stages are recorded on ZFS so a restarted run resumes where this one stops. The
+        # run lock is held until the process exits, so a restarted batch can tell this run is alive
+        zfs_path = self.get_zfs_path()
+        zfs.stage_path(zfs_path)
+        checkpoint = Checkpoint(zfs_path, self.issue.key)
+        if not checkpoint.lock():
+            self.logger(30, "Ticket {} is already running in another process".format(self.issue.key))
+            return
         jira_util.add_label(self.issue, 'OM.Processing')
         
         jira = Jira(self.config.get_field('jira', 'url'),
@@ -56,7 +81,11 @@ class ExposureReport(object):
 
         aws_conn = AWS(aws_key,
                        aws_secret_key,
-                       self.config.get_field('aws', 'bucket'))
+                       self.config.get_field('aws', 'bucket'),
+                       concurrency=self.get_budget('aws', 'download_concurrency'),
+                       chunk_size=self.config.get_field('aws', 'download_chunk_size', int),
+                       upload_concurrency=self.get_budget('aws', 'upload_concurrency'),
+                       download_cache=self.get_download_cache())
         aws_conn.check_keys()
 
         #qubole.configure(self.config.get_field('qubole', 'token'))
@@ -79,23 +108,23 @@ class ExposureReport(object):
         reports = self.get_reports(jira_args, config_args, add_args)
         for report in reports:
             report.validate()
-
-        # create a sql file name and Datanado payload
-        hive_query_file = "{}_{}.sql".format(str(date.today()), self.issue)
-        datanado_payload_object = {
-            "job-internal-name": "PA_EXPOSURE_REPORTING",
-            "parameters": {
-                "hive-arg-1-script-location": "s3://dlx-prod-analytics/analytics-platform/gold/query/exposure_reporting/{}".format(hive_query_file),
-                "hive-arg-1-command-name": "Exposure_Report_{}".format(self.issue)
-                }
-        }
-        print("s3://dlx-prod-analytics/analytics-platform/gold/query/exposure_reporting/{}".format(hive_query_file))
-        # Run report queries, or skip if specified (skipping no longer used)
-        if rerun is False:
+            report.local_aggregates = self.can_aggregate_locally(report, config_args)
+
+        # Run report queries, or skip them if not rerunning and every output is already in S3.
+        # With the result cache enabled, execute_queries checks outputs against the query instead
+        query_hashes = self.get_query_hashes(reports)
+        if rerun is False and checkpoint.get_plan('queries_succeeded') == query_hashes:
+            self.logger(20, "Skipping queries -- completed before restart")
+            queries_succeeded = True
+        elif rerun is False and self.get_result_cache(aws_conn) is None and self.can_skip_queries(reports, aws_conn):
             self.logger(20, "Skipping queries -- all S3 directories populated")
+            queries_succeeded = True
         else:
             self.logger(20, "Reports to run: {}".format(len(reports)))
-            queries_succeeded = self.execute_queries(reports, datanado_payload_object, hive_query_file)
+            queries_succeeded = self.execute_queries(reports, aws_conn, checkpoint, rerun)
+            if queries_succeeded:
+                # Recorded with the query hashes, so a changed ADD runs the queries again
+                checkpoint.set_plan('queries_succeeded', query_hashes)
 
         if not queries_succeeded:
             jira.transition(self.issue, "Processing Failure")
@@ -106,13 +135,15 @@ class ExposureReport(object):
         
         # Start downloading files
         #zfs_path = "{}{}".format(config_args['zfs_volume'], config_args['zfs_path'])
-        zfs_path = config_args['zfs_path']
-        zfs.stage_path(zfs_path)
 
         # Create files per report
         summaries, duplicates = [], []
         summary_srcs, duplicate_srcs = [], []
+        exposure_stats = {}
+        local_duplicates = {}
         files = [('EXPOSURE', 'txt'), ('SUMMARY', 'csv'), ('WEEKLY', 'csv'), ('DUPLICATES', 'csv')]
+        sorted_parts = config_args['exposure_layout'] == 'sorted_parts'
+        ordered_gzip = config_args['exposure_layout'] == 'ordered_gzip'
         for report in reports:
             # Download files -- onramp, weekly
             src = ['{prefix}/{report_name}/{filename}'.format(prefix=config_args['output_prefix'], report_name=report.campaign_name, filename=file[0]) for file in files]
@@ -121,43 +152,129 @@ class ExposureReport(object):
             
             self.logger(20, "Downloading files for report: {}, files: {}".format(report.campaign_name, src))
             
-            aws_conn.download(src[0], exposure_file)
-            self.logger(20, "Exposure File successfully transferred to ZFS directory")
-            aws_conn.download_csv(src[2], dst[2], delimiter=',', headers=headers.get_weekly_headers())
-
-            # Sort onramp by timestamp, then by cust id
-            zfs.sort(exposure_file, '|', 2, config_args['zfs_path'])
-            zfs.sort(exposure_file, '|', 1, config_args['zfs_path'])
-
-            # Gzip onramp
-            zipfile = zfs.zip(exposure_file)
+            if not report.local_aggregates:
+                self.download_csv(aws_conn, checkpoint, src[2], dst[2], delimiter=',', headers=headers.get_weekly_headers(config_args['weekly_granularity']),
+                                  stream=config_args['stream_csv'])
+
+            zipfile = '{}.gz'.format(exposure_file)
+            exposure_etag = aws_conn.get_etag(src[0])
+
+            # Assemble the S3 delivery object from Hive's gzip parts inside S3, if delivering to S3
+            delivery_key = '{prefix}/{report_name}.txt.gz'.format(prefix=config_args['delivery_prefix'], report_name=report.campaign_name)
+            delivered = False
+            report_stats, report_aggregates = None, None
+            if config_args['delivery_mode'] != 'zfs' and ordered_gzip:
+                delivered = self.assemble_exposure(aws_conn, checkpoint, src[0], delivery_key)
+
+            if config_args['delivery_mode'] == 's3' and delivered:
+                self.logger(20, "Exposure File delivered to S3 only")
+            elif checkpoint.is_downloaded(zipfile, exposure_etag) and checkpoint.is_done('compressed', zipfile):
+                self.logger(20, "Exposure File already sorted and zipped before restart")
+            elif ordered_gzip and self.concat_exposure_parts(aws_conn, src[0], zipfile):
+                checkpoint.set_downloaded(zipfile, exposure_etag)
+                checkpoint.set_done('compressed', zipfile)
+                self.logger(20, "Exposure File gzip parts concatenated to ZFS directory")
+            elif config_args['pipeline']:
+                # The sorted gzip file is cached like a download, keyed on the EXPOSURE ETag and layout
+                passes = []
+                if aws_conn.build_cached(src[0], zipfile, lambda file: passes.append(self.stream_exposure(aws_conn, src[0], file, report, config_args)),
+                                         etag=exposure_etag, variant=repr(('sorted_gzip', config_args['exposure_layout']))):
+                    self.logger(20, "Exposure File linked from the download cache")
+                else:
+                    report_stats, report_aggregates = passes[-1]
+                    self.logger(20, "Exposure File streamed, sorted and zipped to ZFS directory")
+                checkpoint.set_downloaded(zipfile, exposure_etag)
+                checkpoint.set_done('compressed', zipfile)
+            else:
+                if not checkpoint.is_downloaded(exposure_file, exposure_etag):
+                    if sorted_parts and self.merge_exposure_parts(aws_conn, src[0], exposure_file, config_args):
+                        checkpoint.set_downloaded(exposure_file, exposure_etag)
+                        checkpoint.set_done('sorted', exposure_file)
+                    else:
+                        aws_conn.download(src[0], exposure_file)
+                        checkpoint.set_downloaded(exposure_file, exposure_etag)
+                    self.logger(20, "Exposure File successfully transferred to ZFS directory")
+
+                # Sort onramp by cust id, then by timestamp
+                if not checkpoint.is_done('sorted', exposure_file):
+                    zfs.external_sort(exposure_file, '|', config_args['zfs_path'],
+                                      memory_mb=config_args['sort_memory_mb'],
+                                      workers=config_args['sort_workers'])
+                    checkpoint.set_done('sorted', exposure_file)
+
+                # Gzip onramp
+                report_stats, report_aggregates = self.get_exposure_consumers(report, config_args)
+                if self.tap_exposure_pass([report_stats, report_aggregates], zipfile, lambda tap: zfs.zip(
+                        exposure_file, workers=config_args['gzip_workers'], tap=tap)):
+                    checkpoint.set_downloaded(zipfile, exposure_etag)
+                    checkpoint.set_done('compressed', zipfile)
+                else:
+                    report_stats, report_aggregates = None, None
+
+            # Recount the summary metrics and build the local aggregates from the finished file only
+            # if no pass above streamed it (e.g. it was done before a restart or linked from the cache)
+            unstreamed = []
+            if config_args['stats'] and report_stats is None and os.path.exists(zipfile) and not (config_args['delivery_mode'] == 's3' and delivered):
+                report_stats = self.get_exposure_stats(config_args, report.report_type)
+                unstreamed.append(report_stats)
+            if report.local_aggregates and report_aggregates is None:
+                report_aggregates = self.get_exposure_aggregates(report, config_args)
+                unstreamed.append(report_aggregates)
+            if unstreamed:
+                sorted_file = exposure_file if checkpoint.is_done('sorted', exposure_file) and os.path.exists(exposure_file) else zipfile
+                chunk_tap.read_file(sorted_file, unstreamed)
+                self.logger(20, "Recounted {} from {}".format([type(consumer).__name__ for consumer in unstreamed], sorted_file))
+            exposure_stats[report.report_number] = report_stats
+
+            # Upload the local gzip file if the delivery object could not be assembled in S3
+            if config_args['delivery_mode'] != 'zfs' and not delivered and not checkpoint.is_done('delivered', delivery_key):
+                aws_conn.upload(zipfile, delivery_key)
+                checkpoint.set_done('delivered', delivery_key)
+                self.logger(20, "Exposure File uploaded to {}".format(delivery_key))
+
+            # Write weekly and duplicates built from the sorted Exposure File when Hive did not
+            if report.local_aggregates:
+                aggregates.write_csv(dst[2], headers.get_weekly_headers(config_args['weekly_granularity']), report_aggregates.get_weekly_rows())
+                local_duplicates[str(report.report_number)] = report_aggregates.get_duplicate_row(report.report_number, report.campaign_name)
+                self.logger(20, "Weekly and duplicates computed locally for {}".format(report.campaign_name))
 
             # Collect summary and duplicates prefixes
             summary_srcs.append(src[1])
-            duplicate_srcs.append(src[3])
+            if not report.local_aggregates:
+                duplicate_srcs.append(src[3])
 
         # Create overall summary file
         self.logger(20, "Downloading summary file")
         summary_dst = '{0}/{1}_SUMMARY.csv'.format(config_args['zfs_path'], jira_args['Campaign Name'])
-        aws_conn.download_csv(summary_srcs, summary_dst, delimiter=',', headers=headers.get_summary_headers())
+        self.download_csv(aws_conn, checkpoint, summary_srcs, summary_dst, delimiter=',', headers=headers.get_summary_headers(),
+                          stream=config_args['stream_csv'])
 
         # Create overall duplicates file
         self.logger(20, "Downloading duplicates file")
         duplicate_dst = '{0}/{1}_DUPLICATES.csv'.format(config_args['zfs_path'], jira_args['Campaign Name'])
-        aws_conn.download_csv(duplicate_srcs, duplicate_dst, delimiter=',', headers=headers.get_duplicate_headers())
+        if duplicate_srcs:
+            self.download_csv(aws_conn, checkpoint, duplicate_srcs, duplicate_dst, delimiter=',', headers=headers.get_duplicate_headers(config_args['duplicate_buckets']),
+                              stream=config_args['stream_csv'])
+        if local_duplicates:
+            self.merge_duplicate_rows(duplicate_dst, reports, local_duplicates, config_args, hive_rows=bool(duplicate_srcs))
 
         # Get fields from summary and duplicates file
         summaries = zfs.get_fields(summary_dst, headers.get_summary_headers(), skip_header=True)
-        duplicates = zfs.get_fields(duplicate_dst, headers.get_duplicate_headers(), skip_header=True)
+        duplicates = zfs.get_fields(duplicate_dst, headers.get_duplicate_headers(config_args['duplicate_buckets']), skip_header=True)
 
-        # Create summary and duplicate comments
+        # Create summary and duplicate comments, flagging summary values the local recount disagrees with
         self.logger(20, "Sending summary & duplicate comments to JIRA")
         summary_comment = self.get_summary_comment(summaries, headers.get_summary_headers())
-        duplicate_comment = self.get_summary_comment(duplicates, headers.get_duplicate_headers())
+        mismatches = self.reconcile_summaries(reports, summaries, exposure_stats, config_args)
+        if mismatches:
+            summary_comment = '{}\n\n{}'.format(summary_comment, self.get_mismatch_comment(mismatches))
+        duplicate_comment = self.get_summary_comment(duplicates, headers.get_duplicate_headers(config_args['duplicate_buckets']))
 
-        # Post comments to JIRA
-        jira.add_comment(self.issue, summary_comment)
-        jira.add_comment(self.issue, duplicate_comment)
+        # Post comments to JIRA, unless posted before a restart
+        for name, comment in [('summary', summary_comment), ('duplicates', duplicate_comment)]:
+            if not checkpoint.has_comment(name):
+                jira.add_comment(self.issue, comment)
+                checkpoint.set_comment(name)
 
         # Create and post QC Brains payload - No longer supported
         """self.logger(20, "Invoking QC Brains")
@@ -182,6 +299,147 @@ class ExposureReport(object):
         # Transition ticket to QC
         jira.transition(self.issue, 'Submit for Approval')
         jira_util.remove_label(self.issue, 'OM.Processing')
+        checkpoint.clear()
+        connections.log_stats()
+
+    def concat_exposure_parts(self, aws_conn, src, zipfile):
+        """ Builds the gzip file from the EXPOSURE parts written by Hive as gzip files in total order
+            (exposure_layout ordered_gzip). Concatenated gzip members are a valid gzip file, so the
+            parts are downloaded back to back without being decompressed or recompressed.
+        Args:
+            aws_conn: AWS object
+            src: S3 prefix of the parts
+            zipfile: Gzip file to write
+        Returns:
+            True, or False if the parts are not gzip files (e.g. written under another layout)
+        """
+        if not self.has_gzip_parts(aws_conn, src):
+            return False
+        aws_conn.download(src, zipfile)
+        return True
+
+    def assemble_exposure(self, aws_conn, checkpoint, src, dst):
+        """ Builds the S3 delivery object from the EXPOSURE gzip parts (exposure_layout ordered_gzip)
+            with a multipart copy inside S3, giving the same bytes as concat_exposure_parts
+        Args:
+            aws_conn: AWS object
+            checkpoint: Checkpoint object
+            src: S3 prefix of the parts
+            dst: S3 key of the delivery object
+        Returns:
+            True, or False if the parts are not gzip files (e.g. written under another layout)
+        """
+        if checkpoint.is_done('delivered', dst):
+            self.logger(20, "{} already delivered before restart".format(dst))
+            return True
+        if not self.has_gzip_parts(aws_conn, src):
+            return False
+        aws_conn.assemble(src, dst)
+        checkpoint.set_done('delivered', dst)
+        self.logger(20, "Exposure File assembled in S3 at {}".format(dst))
+        return True
+
+    def has_gzip_parts(self, aws_conn, src):
+        """Returns True if every non-empty part under an S3 prefix is a gzip file"""
+        parts = [key for key in aws_conn.get_keys(src) if key.size != 0]
+        if not parts or not all(key.key.endswith('.gz') for key in parts):
+            self.logger(30, "Parts of {} are not gzip files, sorting and zipping instead".format(src))
+            return False
+        return True
+
+    def stream_exposure(self, aws_conn, src, zipfile, report, config_args):
+        """ Streams the EXPOSURE parts through the sort (a merge if Hive sorted them) straight into the
+            gzip file; the recount and local aggregates are taken from the sorted lines on their way to gzip
+        Args:
+            aws_conn: AWS object
+            src: S3 prefix of the parts
+            zipfile: Gzip file to write
+            report: Report object
+            config_args: Config variables
+        Returns:
+            (ExposureStats, ExposureAggregates) that have seen every line, each None if not wanted
+        """
+        consumers = self.get_exposure_consumers(report, config_args)
+        if config_args['exposure_layout'] == 'sorted_parts' and self.tap_exposure_pass(list(consumers), zipfile, lambda tap: self.merge_exposure_parts(
+                aws_conn, src, zipfile, config_args, compress=True, tap=tap)):
+            return consumers
+        consumers = self.get_exposure_consumers(report, config_args)
+        self.tap_exposure_pass(list(consumers), zipfile, lambda tap: zfs.sort_to_gzip(
+            aws_conn.stream(src), zipfile, '|', config_args['zfs_path'],
+            memory_mb=config_args['sort_memory_mb'],
+            workers=config_args['sort_workers'],
+            gzip_workers=config_args['gzip_workers'],
+            tap=tap))
+        return consumers
+
+    def merge_exposure_parts(self, aws_conn, src, dst, config_args, compress=False, tap=None):
+        """ Merges the EXPOSURE parts, each sorted by Hive (exposure_layout sorted_parts), into one
+            sorted file as they are streamed, instead of sorting the whole file locally
+        Args:
+            aws_conn: AWS object
+            src: S3 prefix of the parts
+            dst: Sorted text file, or gzip file if compress is set
+            config_args: Config variables
+            compress (bool): Write dst gzipped
+            tap: chunk_tap.ChunkTap to also give the merged lines to (optional, gzip only)
+        Returns:
+            True, or False if the parts were not sorted (e.g. written under another layout)
+        """
+        part_sizes, chunks = aws_conn.stream_parts(src)
+        try:
+            if compress:
+                zfs.sort_to_gzip(chunks, dst, '|', config_args['zfs_path'],
+                                 gzip_workers=config_args['gzip_workers'],
+                                 part_sizes=part_sizes,
+                                 tap=tap)
+            else:
+                zfs.merge_parts(chunks, part_sizes, dst, '|', config_args['zfs_path'])
+        except FileError as e:
+            self.logger(30, "Could not merge sorted parts of {}, sorting instead\n{}".format(src, e))
+            return False
+        return True
+
+    def tap_exposure_pass(self, consumers, name, run_pass):
+        """ Runs a pass over an Exposure File with a chunk_tap.ChunkTap handing its lines to consumers
+            on a background thread
+        Args:
+            consumers (list): Objects with an update(df) method, e.g. ExposureStats; None entries are skipped
+            name (str): File name for errors
+            run_pass: Function running the pass, called with the tap (None without consumers)
+        Returns:
+            The pass's result; the consumers have seen every line unless it is None or False
+        """
+        consumers = [consumer for consumer in consumers if consumer is not None]
+        tap = chunk_tap.ChunkTap(consumers, name) if consumers else None
+        try:
+            result = run_pass(tap)
+        except Exception:
+            if tap:
+                tap.cancel()
+            raise
+        if tap:
+            if result is None or result is False:
+                tap.cancel()
+            else:
+                tap.close()
+        return result
+
+    def download_csv(self, aws_conn, checkpoint, src, dst, **kwargs):
+        """ Downloads a CSV file from S3, unless the checkpoint shows it was already downloaded
+            from the same (unchanged) objects
+        Args:
+            aws_conn: AWS object
+            checkpoint: Checkpoint object
+            src (str or list(str)): Single S3 prefix or list of S3 prefixes
+            dst (str): zfs_path + filename
+            kwargs: AWS.download_csv arguments
+        """
+        etag = '|'.join(str(aws_conn.get_etag(prefix)) for prefix in (src if isinstance(src, list) else [src]))
+        if checkpoint.is_downloaded(dst, etag):
+            self.logger(20, "{} already downloaded before restart".format(dst))
+            return
+        aws_conn.download_csv(src, dst, **kwargs)
+        checkpoint.set_downloaded(dst, etag)
 
     def get_jira_args(self):
         """ Gets all necessary JIRA variables """
@@ -201,14 +459,83 @@ class ExposureReport(object):
         self.logger(20, jira_args)
         return jira_args
 
+    def get_weekly_granularity(self):
+        """Gets the bucket size of the WEEKLY counts (day, week or month), defaulting to week"""
+        granularity = self.config.get_field('queries', 'weekly_granularity')
+        if granularity not in ('day', 'week', 'month'):
+            self.logger(30, "Unknown weekly_granularity {}, using week".format(granularity))
+            return 'week'
+        return granularity
+
+    def get_exposure_layout(self):
+        """Gets the layout of the EXPOSURE output files (see queries.EXPOSURE_LAYOUTS), defaulting to unsorted"""
+        layout = self.config.get_field('queries', 'exposure_layout') or 'unsorted'
+        if layout not in queries.EXPOSURE_LAYOUTS:
+            self.logger(30, "Unknown exposure_layout {}, using unsorted".format(layout))
+            return 'unsorted'
+        return layout
+
+    def get_delivery_mode(self):
+        """Gets where the Exposure File is delivered (zfs, s3 or both), defaulting to zfs"""
+        mode = self.config.get_field('delivery', 'mode') or 'zfs'
+        if mode not in ('zfs', 's3', 'both'):
+            self.logger(30, "Unknown delivery mode {}, using zfs".format(mode))
+            return 'zfs'
+        return mode
+
+    def get_duplicate_buckets(self):
+        """Gets the DUPLICATES buckets as (count, condition) tuples, defaulting to queries.DUPLICATE_BUCKETS"""
+        buckets = self.config.get_field('queries', 'duplicate_buckets') or queries.DUPLICATE_BUCKETS
+        try:
+            return queries.parse_duplicate_buckets(buckets)
+        except ValueError as e:
+            self.logger(30, "Invalid duplicate_buckets {}, using {}\n{}".format(buckets, queries.DUPLICATE_BUCKETS, e))
+            return queries.parse_duplicate_buckets(queries.DUPLICATE_BUCKETS)
+
+    def get_budget(self, section, option):
+        """ Gets this ticket's share of a per-pod budget from the config
+        Args:
+            section (str): Config section
+            option (str): Config option, an int
+        Returns:
+            The value divided by the number of tickets running at once (at least 1), or None if unset
+        """
+        value = self.config.get_field(section, option, int)
+        if value is None:
+            return None
+        return max(1, value // self.shares)
+
+    def get_zfs_path(self):
+        """Gets the ticket's ZFS directory, its own one when tickets run concurrently"""
+        zfs_path = self.config.get_field('zfs', 'path').format(issuekey=self.issue.key)
+        if self.isolate_zfs and self.issue.key not in zfs_path:
+            zfs_path = os.path.join(zfs_path, self.issue.key)
+        return zfs_path
+
+    def is_abandoned(self):
+        """Returns True if a run of this ticket started and its process has since died, e.g. in a pod restart"""
+        return Checkpoint(self.get_zfs_path(), self.issue.key).is_abandoned()
+
     def get_config_args(self, jira_args):
         """Gets variables from the config file"""
+        zfs_path = self.get_zfs_path()
         config_args = {
             'bucket': self.config.get_field('aws', 'bucket'),
             'input_prefix': self.config.get_field('aws', 'input_prefix'),
             'output_prefix': self.config.get_field('aws', 'output_prefix').format(report_type=jira_args['Report Type']),
-            'zfs_path': self.config.get_field('zfs', 'path').format(issuekey=self.issue.key),
+            'stream_csv': self.config.get_field('aws', 'stream_csv') == 'True',
+            'zfs_path': zfs_path,
             'zfs_volume': self.config.get_field('zfs', 'volume'),
+            'sort_memory_mb': self.get_budget('zfs', 'sort_memory_mb'),
+            'sort_workers': self.get_budget('zfs', 'sort_workers'),
+            'gzip_workers': self.get_budget('zfs', 'gzip_workers'),
+            'pipeline': self.config.get_field('zfs', 'pipeline') == 'True',
+            'weekly_granularity': self.get_weekly_granularity(),
+            'duplicate_buckets': self.get_duplicate_buckets(),
+            'exposure_layout': self.get_exposure_layout(),
+            'delivery_mode': self.get_delivery_mode(),
+            'stats': self.config.get_field('stats', 'enabled') == 'True',
+            'delivery_prefix': (self.config.get_field('delivery', 'prefix') or '').format(report_type=jira_args['Report Type']),
             #'cluster': self.config.get_field('qubole', 'cluster'),
             #'qcb_url': self.config.get_field('qcb', 'url'),
             #'qcb_project': self.config.get_field('qcb', 'project'),
@@ -224,12 +551,13 @@ class ExposureReport(object):
         """Gets variables from the ADD attachment file"""
         add_object = add.parse(attachment)
         rows = add.get_rows(add_object)
+        fields = add.validate_columns(add_object)
         add_args = {
             'rows': rows,
-            'audience_file': [add.get_audience_file(add_object, i, jira_args['input_folder'], config_args['input_prefix'], aws_conn) for i in range(rows)],
-            'pixel_id': [add.get_pixel_id(add_object, row=i) for i in range(rows)],
-            'profile_ids': [add.get_profile_ids(add_object, row=i) for i in range(rows)],
-            'targeted': [add.get_targeted_flag(add_object, row=i) for i in range(rows)]
+            'audience_file': add.get_audience_files(add_object, rows, jira_args['input_folder'], config_args['input_prefix'], aws_conn),
+            'pixel_id': fields['pixel_id'],
+            'profile_ids': fields['profile_ids'],
+            'targeted': fields['targeted']
         }
         self.logger(20, add_args)
         return add_args
@@ -264,68 +592,257 @@ class ExposureReport(object):
         """Determines if queries have already been run successfully for this ticket"""
         s3_locations = []
         for report in reports:
-            s3_locations.extend(['{}/{}/EXPOSURE'.format(report.output_prefix, report.campaign_name),
-                                 '{}/{}/SUMMARY'.format(report.output_prefix, report.campaign_name),
-                                 '{}/{}/WEEKLY'.format(report.output_prefix, report.campaign_name),
-                                 '{}/{}/DUPLICATES'.format(report.output_prefix, report.campaign_name)])
+            s3_locations.extend(self.get_output_prefixes(report).values())
         is_empty = [aws_conn.is_empty(s3_location) for s3_location in s3_locations]
         if True in is_empty:
             return False
         else:
             return True
 
-    def execute_queries(self, reports, payload_object, query_file_name):
-        """ Runs queries from reports via Hive execution
+    def execute_queries(self, reports, aws_conn=None, checkpoint=None, rerun=False):
+        """ Runs queries from reports via Hive execution. Each report gets its own sql file and
+            Datanado job; the jobs are launched together and watched until all have finished.
+            When reports share an impression scan (see queries.plan_queries), a prelude job stages
+            the scan first and a cleanup job drops it afterwards. Reports whose query results are
+            in the result cache are not run again, unless rerunning. With a checkpoint, jobs launched
+            before a restart for the same query are reattached to (or skipped if they succeeded, unless
+            rerunning) rather than launched again.
+            The outcome of each report is recorded on report.job_instance_id and report.status.
         Args:
             reports: list
-            query_file_name: str
-            payload_object: dict
+            aws_conn: AWS object for the result cache (optional, no caching without it)
+            checkpoint: Checkpoint object (optional)
+            rerun (bool): Run every query again; results are still recorded in the cache
         Returns:
-            True or False
+            True if every report's job succeeded or was cached, else False
         """
-        parallel_queries = []
-        for report in reports:
-            query = queries.get_queries(report.campaign_name,
-                                        report.start_date,
-                                        report.end_date,
-                                        report.start_dash,
-                                        report.end_dash,
-                                        report.impression_source,
-                                        report.output_type,
-                                        report.report_type,
-                                        report.audience_file,
-                                        report.pixel_id,
-                                        report.profile_ids,
-                                        report.targeted,
-                                        report.report_number,
-                                        report.bucket,
-                                        report.output_prefix)
-            parallel_queries.append(query)
+        # Reuse the original planning time on resume so table names match any launched jobs
+        plan_time = datetime.now()
+        if checkpoint and checkpoint.get_plan('time'):
+            plan_time = datetime.strptime(checkpoint.get_plan('time'), "%Y%m%d%H%M%S")
+        prelude, report_queries, cleanup = self.plan_report_queries(reports, plan_time)
+        query_hashes = self.get_query_hashes(reports, report_queries)
+        if checkpoint:
+            # Jobs launched for another query (the ADD changed since) are launched again, on a
+            # fresh plan so their table names do not clash with the old jobs'
+            stale = [report.report_number for report in reports
+                     if checkpoint.get_job(report.report_number)[0]
+                     and checkpoint.get_job_hash(report.report_number) != query_hashes[str(report.report_number)]]
+            if stale:
+                self.logger(20, "Queries changed since the checkpoint for reports {}".format(stale))
+                for report_number in stale:
+                    checkpoint.drop_job(report_number)
+                checkpoint.drop_plan('time')
+                plan_time = datetime.now()
+                prelude, report_queries, cleanup = self.plan_report_queries(reports, plan_time)
+            if not checkpoint.get_plan('time'):
+                checkpoint.set_plan('time', plan_time.strftime("%Y%m%d%H%M%S"))
+        cache = self.get_result_cache(aws_conn)
+        cache_keys = {}
+        if cache:
+            # The audience file is read by the query but not named by its contents, so its ETag is
+            # part of the key; a re-uploaded audience file must not reuse old results
+            audience_etags = {}
+            for report in reports:
+                prefix = self.get_audience_prefix(report)
+                if prefix not in audience_etags:
+                    audience_etags[prefix] = aws_conn.get_etag(prefix) or ''
+                cache_keys[report.report_number] = result_cache.get_key(report_queries[report.report_number],
+                                                                        [report.timestamp, report.run_date, report.impression_table],
+                                                                        [audience_etags[prefix]])
+                if not rerun and cache.lookup(cache_keys[report.report_number]):
+                    report.status = "CACHED"
+                    self.logger(20, "Report {} ({}) reusing cached results".format(report.report_number, report.campaign_name))
+        reports = [report for report in reports if report.status != "CACHED"]
+        if not reports:
+            self.logger(20, "All reports cached, moving on to Post-Processing")
+            return True
 
+        # Pick up jobs launched before a restart
+        if checkpoint:
+            for report in reports:
+                job_instance_id, status = checkpoint.get_job(report.report_number)
+                if job_instance_id and (status == "IN_PROGRESS" or (status == "SUCCESS" and not rerun)):
+                    report.job_instance_id, report.status = job_instance_id, status
+                    self.logger(20, "Report {} reattaching to Datanado job {} ({})".format(report.report_number, job_instance_id, status))
+        to_launch = [report for report in reports if report.status not in ("IN_PROGRESS", "SUCCESS")]
+
+        if prelude and to_launch:
+            self.logger(20, "Staging shared impression scan for {} reports".format(len(to_launch)))
+            if not self.run_query_job('prelude', prelude, checkpoint):
+                for report in to_launch:
+                    report.status = "PRELUDE_FAILED"
+                self.logger(30, "Shared impression scan failed")
+                return False
+
+        for report in to_launch:
             # Method call to create sql file and upload to S3 location for Datanado job
-            self.upload_query_file(query_file_name, query)
-
-        #job_ids = qubole.run_queries_parallel(parallel_queries, label, 'ER {}'.format(self.issue.key))
-        #failed = [job_id for job_id in job_ids if not qubole.is_success(job_id)]
-
-        # Create Datanado client
-        datanado_client = DatanadoClient(payload_object=payload_object)
-        # Launch Datanado API job
-        job_instance_id = datanado_client.execute_api_request()
-        print(job_instance_id)
-
-        # Run DN Method to keep track of job status
-        if datanado_client.watch_datanado_job(job_instance_id):
-            self.logger(20, "Moving on to Post-Processing")
-            return True
-        else:
-            self.logger(20, "Qubole query failed")
+            self.upload_query_file(self.get_query_file_name(report.report_number), report_queries[report.report_number])
+
+        # Launch one Datanado API job per report
+        if to_launch:
+            with ContextThreadPoolExecutor(max_workers=len(to_launch)) as pool:
+                job_ids = list(pool.map(self.launch_job, [report.report_number for report in to_launch]))
+            for report, job_instance_id in zip(to_launch, job_ids):
+                print(job_instance_id)
+                report.job_instance_id = job_instance_id
+                report.status = "IN_PROGRESS" if job_instance_id else "LAUNCH_FAILED"
+                if checkpoint and job_instance_id:
+                    checkpoint.set_job(report.report_number, job_instance_id, report.status,
+                                       query_hashes[str(report.report_number)])
+
+        # Watch all running jobs until they finish
+        launched = {report.job_instance_id: report for report in reports if report.status == "IN_PROGRESS"}
+        if launched:
+            def finished(job_instance_id, succeeded):
+                report = launched[job_instance_id]
+                report.status = "SUCCESS" if succeeded else "FAILED"
+                if checkpoint:
+                    checkpoint.set_job(report.report_number, job_instance_id, report.status)
+                self.logger(20, "Report {} ({}) Datanado job {}: {}".format(report.report_number, report.campaign_name,
+                                                                           job_instance_id, report.status))
+
+            self.watch_query_jobs(list(launched), callback=finished)
+
+        if cleanup:
+            if not self.run_query_job('cleanup', cleanup):
+                self.logger(30, "Shared impression cleanup failed")
+            if checkpoint:
+                # The staging tables are gone, so a resumed run has to stage them again
+                prelude_id, _ = checkpoint.get_job('prelude')
+                checkpoint.set_job('prelude', prelude_id, "DROPPED")
+
+        if cache:
+            for report in reports:
+                if report.status == "SUCCESS":
+                    cache.record(cache_keys[report.report_number], self.get_output_prefixes(report),
+                                 ticket=self.issue.key, report_number=report.report_number,
+                                 campaign_name=report.campaign_name, job_instance_id=report.job_instance_id)
+            cache.evict_expired()
+
+        failed = [report.report_number for report in reports if report.status != "SUCCESS"]
+        if failed:
+            self.logger(30, "Datanado jobs failed for reports: {}".format(failed))
             return False
+        self.logger(20, "Moving on to Post-Processing")
+        return True
 
-        #if failed:
-            #self.logger(30, "Parallel queries failed. Qubole Job IDs: {}".format(failed))
-            #return False
-        #return True
+    def plan_report_queries(self, reports, plan_time):
+        """Plans the prelude, per-report and cleanup queries (see queries.plan_queries)"""
+        return queries.plan_queries(reports, self.issue.key,
+                                    fuse_scans=self.config.get_field('queries', 'fuse_scans') == 'True',
+                                    granularity=self.get_weekly_granularity(),
+                                    duplicate_buckets=self.get_duplicate_buckets(),
+                                    now=plan_time,
+                                    exposure_layout=self.get_exposure_layout())
+
+    def get_query_hashes(self, reports, report_queries=None):
+        """ Gets the hash of each report's query, which does not depend on the planning time, so a
+            resumed run can tell a job launched for the same query from one for a since changed ADD
+        Args:
+            reports: list
+            report_queries (dict): Report number to query string (optional, planned now if not given)
+        Returns:
+            {report number (str): query hash}
+        """
+        if report_queries is None:
+            _, report_queries, _ = self.plan_report_queries(reports, datetime.now())
+        return {str(report.report_number): result_cache.get_key(report_queries[report.report_number],
+                                                                [report.timestamp, report.run_date, report.impression_table])
+                for report in reports}
+
+    def get_audience_prefix(self, report):
+        """Gets the S3 prefix of a report's audience file"""
+        input_folder = 'AttributeFileInput' if report.report_type == 'Household' else 'IndividualAttributeFileInput'
+        return self.config.get_field('aws', 'input_prefix').format(audience_file=report.audience_file,
+                                                                   input_folder=input_folder)
+
+    def get_output_prefixes(self, report):
+        """Gets the S3 prefix of each query output of a report, keyed by output name"""
+        return OrderedDict((name, '{}/{}/{}'.format(report.output_prefix, report.campaign_name, name))
+                           for name in result_cache.OUTPUTS
+                           if not (report.local_aggregates and name in ('WEEKLY', 'DUPLICATES')))
+
+    def get_result_cache(self, aws_conn):
+        """Gets the ResultCache if it is enabled in the config, else None"""
+        if aws_conn is None or self.config.get_field('cache', 'enabled') != 'True':
+            return None
+        return result_cache.ResultCache(aws_conn, self.config.get_field('cache', 'prefix'),
+                                        self.config.get_field('cache', 'ttl_days', int) or result_cache.CACHE_TTL_DAYS)
+
+    def get_download_cache(self):
+        """Gets the local DownloadCache if a cache path is set in the config, else None"""
+        path = self.config.get_field('zfs', 'download_cache_path')
+        if not path:
+            return None
+        quota_gb = self.config.get_field('zfs', 'download_cache_quota_gb', int) or 100
+        return DownloadCache(path, quota_gb * 1024 ** 3)
+
+    def run_query_job(self, name, query, checkpoint=None):
+        """ Uploads a sql file, runs it as one Datanado job and waits for it. With a checkpoint,
+            a job for the same query that already succeeded is skipped and one still running is
+            reattached to.
+        Args:
+            name: Suffix for the sql file name
+            query: Query string
+            checkpoint: Checkpoint object (optional)
+        Returns:
+            True or False
+        """
+        query_hash = result_cache.get_key(query, [])
+        job_instance_id, status = checkpoint.get_job(name) if checkpoint else (None, None)
+        if job_instance_id and checkpoint.get_job_hash(name) != query_hash:
+            # Launched for another query, e.g. staging tables of a plan that has since changed
+            checkpoint.drop_job(name)
+            job_instance_id, status = None, None
+        if status == "SUCCESS":
+            return True
+        if not job_instance_id or status != "IN_PROGRESS":
+            self.upload_query_file(self.get_query_file_name(name), query)
+            job_instance_id = self.launch_job(name)
+            if not job_instance_id:
+                return False
+            if checkpoint:
+                checkpoint.set_job(name, job_instance_id, "IN_PROGRESS", query_hash)
+        succeeded = self.watch_query_jobs([job_instance_id])[job_instance_id]
+        if checkpoint:
+            checkpoint.set_job(name, job_instance_id, "SUCCESS" if succeeded else "FAILED")
+        return succeeded
+
+    def watch_query_jobs(self, job_ids, callback=None):
+        """Watches Datanado jobs until all finish, returning {job_instance_id: succeeded}"""
+        expected_duration = self.config.get_field('Datanado', 'expected_duration')
+        return watch_jobs(job_ids, callback=callback,
+                          expected_duration=int(expected_duration) if expected_duration else None,
+                          min_interval=self.config.get_field('Datanado', 'min_poll_interval', int) or 30,
+                          max_interval=self.config.get_field('Datanado', 'max_poll_interval', int) or 60)
+
+    def get_query_file_name(self, name):
+        """Gets the sql file name for a Datanado job, e.g. per report number"""
+        return "{}_{}_{}.sql".format(str(date.today()), self.issue, name)
+
+    def launch_job(self, name):
+        """ Launches a Datanado job
+        Args:
+            name: Suffix of the uploaded sql file name, e.g. the report number
+        Returns:
+            Datanado job instance ID, or None if the launch failed
+        """
+        query_file_name = self.get_query_file_name(name)
+        payload_object = {
+            "job-internal-name": "PA_EXPOSURE_REPORTING",
+            "parameters": {
+                "hive-arg-1-script-location": "s3://dlx-prod-analytics/analytics-platform/gold/query/exposure_reporting/{}".format(query_file_name),
+                "hive-arg-1-command-name": "Exposure_Report_{}_{}".format(self.issue, name)
+                }
+        }
+        print("s3://dlx-prod-analytics/analytics-platform/gold/query/exposure_reporting/{}".format(query_file_name))
+        datanado_client = DatanadoClient(payload_object=payload_object)
+        try:
+            return datanado_client.execute_api_request()
+        except Exception as e:
+            self.logger(40, "Datanado launch failed for {}\n{}".format(query_file_name, e))
+            return None
 
     def upload_query_file(self, s3_file_name, s3_query):
         # Create S3 client
@@ -333,6 +850,95 @@ class ExposureReport(object):
         # Upload local file to S3 location
         s3_client.upload_sql_file(s3_file_name, s3_query)
 
+    def can_aggregate_locally(self, report, config_args):
+        """ Determines if a report's weekly and duplicates can be built locally from its Exposure File
+            instead of by Hive: the file must hold every exposed row (not an Unexposed report) and
+            be on ZFS (not delivered to S3 only)
+        """
+        if self.config.get_field('queries', 'local_aggregates') != 'True' or report.output_type == "Unexposed":
+            return False
+        return not (config_args['delivery_mode'] == 's3' and config_args['exposure_layout'] == 'ordered_gzip')
+
+    def get_exposure_aggregates(self, report, config_args):
+        """Gets a new ExposureAggregates for a report's weekly and duplicates outputs if they are built locally, else None"""
+        if not report.local_aggregates:
+            return None
+        start_dates, end_dates = queries.create_splits(report.start_date, report.end_date, config_args['weekly_granularity'])
+        return aggregates.ExposureAggregates(start_dates, end_dates, config_args['weekly_granularity'],
+                                             config_args['duplicate_buckets'])
+
+    def get_exposure_consumers(self, report, config_args):
+        """Gets a new (ExposureStats, ExposureAggregates) to take from a pass over a report's Exposure File, each None if not wanted"""
+        return self.get_exposure_stats(config_args, report.report_type), self.get_exposure_aggregates(report, config_args)
+
+    def merge_duplicate_rows(self, duplicate_dst, reports, local_duplicates, config_args, hive_rows=False):
+        """ Writes the duplicates file with the locally computed rows, keeping report order
+        Args:
+            duplicate_dst: Duplicates file; holds the downloaded Hive rows if hive_rows is set
+            reports: List of Report objects
+            local_duplicates: Dict of report number (str) to locally computed row
+            config_args: Config variables
+            hive_rows (bool): Keep the Hive rows already in duplicate_dst
+        """
+        downloaded = {}
+        if hive_rows:
+            with open(duplicate_dst) as f:
+                next(f)
+                for line in f:
+                    downloaded[line.split(',', 1)[0]] = [line.rstrip('\n')]
+        rows = []
+        for report in reports:
+            number = str(report.report_number)
+            row = local_duplicates.get(number) or downloaded.get(number)
+            if row:
+                rows.append(row)
+        aggregates.write_csv(duplicate_dst, headers.get_duplicate_headers(config_args['duplicate_buckets']), rows)
+
+    def get_exposure_stats(self, config_args, report_type):
+        """Gets a new ExposureStats to recount an Exposure File if stats are enabled in the config, else None"""
+        if not config_args['stats']:
+            return None
+        return stats.ExposureStats(report_type=report_type)
+
+    def reconcile_summaries(self, reports, summaries, exposure_stats, config_args):
+        """ Compares each report's Hive summary with the local recount of its Exposure File
+        Args:
+            reports: List of Report objects
+            summaries: List of OrderedDicts from the summary file
+            exposure_stats: Dict of report number to ExposureStats (or None if not recounted)
+            config_args: Config variables
+        Returns:
+            List of (campaign name, list of mismatch descriptions) for reports that disagree
+        """
+        mismatches = []
+        for report in reports:
+            report_stats = exposure_stats.get(report.report_number)
+            if report_stats is None:
+                continue
+            summary = next((s for s in summaries if s.get('Report Number') == str(report.report_number)), None)
+            if summary is None:
+                report_mismatches = ["No summary row for report {}".format(report.report_number)]
+            else:
+                report_mismatches = stats.reconcile(report_stats, summary, report.output_type)
+            if report_mismatches:
+                self.logger(30, "Summary mismatch for {}: {}".format(report.campaign_name, '; '.join(report_mismatches)))
+                mismatches.append((report.campaign_name, report_mismatches))
+            else:
+                self.logger(20, "Summary for {} matches local recount".format(report.campaign_name))
+        return mismatches
+
+    def get_mismatch_comment(self, mismatches):
+        """ Constructs the JIRA comment section flagging summary values the local recount disagrees with
+        Args:
+            mismatches: List of (campaign name, list of mismatch descriptions)
+        Returns:
+            comment
+        """
+        comment_list = ['{color:red}*Summary does not match the local recount of the Exposure File*{color}']
+        for campaign_name, report_mismatches in mismatches:
+            comment_list.extend('* {}: {}'.format(campaign_name, mismatch) for mismatch in report_mismatches)
+        return '\n'.join(comment_list)
+
     def get_summary_comment(self, summaries, headers):
         """ Constructs summary comment to post to JIRA
         Args:
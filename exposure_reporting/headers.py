@@ -9,9 +9,17 @@ def get_summary_headers():
             "Creative Count", "Placement Count", "Exposure Start Date", "Exposure End Date"]
 
 
-def get_weekly_headers():
-    return ["Week Number", "Start Date", "Count Impressions", "Avg Imps Per CustID"]
+def get_weekly_headers(granularity="week"):
+    return ["{} Number".format(granularity.capitalize()), "Start Date", "Count Impressions", "Avg Imps Per CustID"]
 
 
-def get_duplicate_headers():
-    return ["Report Number", "Campaign Name", "Two Duplicates (Unique CustIDs)", "Three", "Four", "Five", "Ten+", "% Unique CustIDs as Duplicates"]
+NUMBER_WORDS = {2: "Two", 3: "Three", 4: "Four", 5: "Five", 6: "Six", 7: "Seven", 8: "Eight", 9: "Nine", 10: "Ten"}
+
+
+def get_duplicate_headers(buckets=None):
+    """Headers for the duplicates file; buckets is a list of (count, condition) tuples from queries.parse_duplicate_buckets"""
+    if buckets is None:
+        return ["Report Number", "Campaign Name", "Two Duplicates (Unique CustIDs)", "Three", "Four", "Five", "Ten+", "% Unique CustIDs as Duplicates"]
+    names = ["{}{}".format(NUMBER_WORDS.get(count, count), '+' if condition == '>=' else '') for count, condition in buckets]
+    names[0] = "{} Duplicates (Unique CustIDs)".format(names[0])
+    return ["Report Number", "Campaign Name"] + names + ["% Unique CustIDs as Duplicates"]
@@ -0,0 +1,59 @@
+"""This module tags log records with the key of the ticket they were logged for.
+
+main.run_ticket sets the ticket in a context variable. Threads do not inherit context variables,
+so the pools working for a ticket (transfers, gzip, job launches, the chunk tap, Datanado status
+requests) run their tasks in a copy of the submitting thread's context, keeping the ticket's
+key on their log lines.
+
+Exported Classes
+TicketFilter
+ContextThreadPoolExecutor
+
+Exported Functions
+set_ticket
+reset_ticket
+start_thread
+"""
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ticket = contextvars.ContextVar('ticket', default=None)
+
+
+def set_ticket(key):
+    """ Sets the ticket key logged by the current context
+    Returns:
+        Token for reset_ticket
+    """
+    return ticket.set(key)
+
+
+def reset_ticket(token):
+    """Restores the ticket key from before set_ticket"""
+    ticket.reset(token)
+
+
+def start_thread(target, name=None, daemon=None):
+    """ Starts a thread running target in a copy of the current context
+    Returns:
+        threading.Thread object
+    """
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,), name=name, daemon=daemon)
+    thread.start()
+    return thread
+
+
+class TicketFilter(logging.Filter):
+    """Adds the current context's ticket key to log records"""
+    def filter(self, record):
+        record.ticket = ticket.get() or '-'
+        return True
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor running each task in a copy of the submitting thread's context"""
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
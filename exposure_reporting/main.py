@@ -14,11 +14,13 @@
 
 from argparse import ArgumentParser
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import logging
 import sys
 import exception
+import log_context
 from cfg import CFG
 from jira_util import Jira
 from exposure_report import ExposureReport
@@ -28,7 +30,7 @@ def main(args):
     """Executes exposure reports
     Args:
         args: Command-line arguments
-            --rerun (bool): Flag to overwrite queries or not
+            --rerun (bool): Run the queries again instead of reusing earlier outputs (default False)
             --ticket (str): JIRA ticket key (e.g. CAM-123456)
     """
     configfile = ConfigParser()
@@ -43,6 +45,10 @@ def main(args):
                 )
     jira.connect()
 
+    # Tickets running at once; their ZFS directories are then kept apart, also for manual reruns,
+    # so a rerun finds the files of an earlier batch run
+    max_tickets = config.get_field('project', 'max_tickets', int) or 1
+
     # Case 1: Check manual reruns
     if args.ticket:
         try:
@@ -50,7 +56,7 @@ def main(args):
         except:
             print('Invalid ticket: {}'.format(args.ticket))
             return 1
-        er = ExposureReport(config, issue)
+        er = ExposureReport(config, issue, isolate_zfs=max_tickets > 1)
         er.run(args.rerun)
         return 0
 
@@ -58,24 +64,58 @@ def main(args):
     today_minus_two = (datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d')
     active_jql = config.get_field('jql', 'active').format(today_minus_two=today_minus_two)
     active_issues = jira.conn.search_issues(active_jql)
-    if active_issues:
-        logging.info("Active issues: {}\nExiting...".format([issue.key for issue in active_issues]))
+    # A run that died (e.g. a pod restart) leaves its ticket labelled OM.Processing with its run
+    # lock free; such tickets are resumed from their checkpoint, while a live run still stops the batch
+    abandoned = [issue for issue in active_issues
+                 if ExposureReport(config, issue, isolate_zfs=max_tickets > 1).is_abandoned()]
+    running = [issue.key for issue in active_issues if issue not in abandoned]
+    if running:
+        logging.info("Active issues: {}\nExiting...".format(running))
         return 1
+    if abandoned:
+        logging.info("Resuming abandoned issues: {}".format([issue.key for issue in abandoned]))
 
     # Case 3: Check tickets to process
     today_minus_two = (datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d')
     process_jql = config.get_field('jql', 'jql').format(today_minus_two=today_minus_two)
-    issues = jira.conn.search_issues(process_jql)
+    issues = abandoned + list(jira.conn.search_issues(process_jql))
     logging.info("Issues: {}".format([issue.key for issue in issues]))
-    for issue in issues:
-        print(issue.key)
-        er = ExposureReport(config, issue)
-        er.run(args.rerun)
+    shares = max(1, min(max_tickets, len(issues)))
+    with ThreadPoolExecutor(max_workers=max_tickets) as pool:
+        results = list(pool.map(lambda issue: run_ticket(config, issue, args.rerun, isolate_zfs=max_tickets > 1,
+                                                         shares=shares), issues))
 
+    failed = [issue.key for issue, succeeded in zip(issues, results) if not succeeded]
+    if failed:
+        logging.error("Tickets failed: {}".format(failed))
     logging.info("Exiting successfully")
     #return 0
 
 
+def run_ticket(config, issue, rerun, isolate_zfs=False, shares=1):
+    """Runs one ticket in its own logging context; a failure is logged without stopping the batch
+    Args:
+        config: CFG class instance
+        issue: JIRA issue object
+        rerun (bool): Flag to overwrite queries or not
+        isolate_zfs (bool): Give the ticket its own ZFS directory
+        shares (int): Number of tickets running at once, splitting the sort, gzip and transfer budgets
+    Returns:
+        True if the ticket ran without raising, otherwise False
+    """
+    token = log_context.set_ticket(issue.key)
+    print(issue.key)
+    try:
+        er = ExposureReport(config, issue, isolate_zfs=isolate_zfs, shares=shares)
+        er.run(rerun)
+        return True
+    except Exception:
+        logging.exception("Ticket {} failed".format(issue.key))
+        return False
+    finally:
+        log_context.reset_ticket(token)
+
+
 def set_logger(config):
     """Sets logfile"""
     project_name = config.get_field('project', 'name')
@@ -86,14 +126,18 @@ def set_logger(config):
                                                                             today_date=today_date)
     logging.basicConfig(filename=logfile_name,
                         level=logging.INFO,
-                        format='%(asctime)s: %(levelname)s: %(message)s',
+                        format='%(asctime)s: %(levelname)s: [%(ticket)s] %(message)s',
                         datefmt='%m/%d/%Y %H:%M:%S')
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(log_context.TicketFilter())
     logging.log(20, "Starting execution of {} automation".format(project_name))
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
-    parser.add_argument('--rerun', '-r', choices=[True, False], nargs='?', default=True, const=True, type=bool)
+    # Outputs are reused (result cache, checkpoint) unless -r forces the queries to run again
+    parser.add_argument('--rerun', '-r', choices=[True, False], nargs='?', default=False, const=True,
+                        type=lambda value: value.lower() == 'true')
     parser.add_argument('--ticket', '-t', type=str)
     args = parser.parse_args()
     main(args)
@@ -1,39 +1,185 @@
 # queries.py
 
+import re
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+IMPRESSION_TABLE = "core_digital.unified_impression"
+DUPLICATE_BUCKETS = "2,3,4,5,10+"
+EXPOSURE_LAYOUTS = ("unsorted", "sorted_parts", "ordered_gzip")
+
+
+def plan_queries(reports, ticket, fuse_scans=True, granularity="week", duplicate_buckets=None, now=None,
+                 exposure_layout="unsorted"):
+    """ Plans the queries for all reports of a ticket. Reports that share an impression source and
+        date range read a shared staging table, built by one scan of the impression table for all
+        of their pixel IDs, instead of each scanning the impression table themselves.
+    Args:
+        reports: List of Report objects
+        ticket (str): Ticket key, used to keep table names unique between tickets
+        fuse_scans (bool): Share impression scans between reports
+        granularity (str): Bucket size of the WEEKLY counts: day, week or month
+        duplicate_buckets (str): DUPLICATES buckets, see parse_duplicate_buckets
+        now (datetime): Planning time used for table names and the run date (optional, defaults to
+                        now; pass the original time to reproduce a plan when resuming)
+        exposure_layout (str): Layout of the EXPOSURE output files, see get_exposure_order_clause
+    Returns:
+        Prelude query string (empty if nothing is shared), dict of report number to query string,
+        and cleanup query string (empty if nothing is shared)
+    """
+    if now is None:
+        now = datetime.now()
+    run_date = now.strftime("%m/%d/%Y %H:%M:%S")
+    now = now.strftime("%Y%m%d%H%M%S")
+    label = re.sub(r'\W', '_', str(ticket))
+    impression_tables = {}
+    prelude, cleanup = "", ""
+    if fuse_scans:
+        for i, group in enumerate(get_scan_groups(reports).values()):
+            if len(group) < 2:
+                continue
+            table = "SHARED_IMPRESSIONS_{}_{}_{}".format(label, now, i + 1)
+            pixel_ids = list(OrderedDict.fromkeys(pixel.strip() for report in group
+                                                  for pixel in str(report.pixel_id).split(',')))
+            prelude += get_shared_impression_queries(table, group[0].start_date, group[0].end_date, ','.join(pixel_ids),
+                                                     get_data_source_id_part(group[0].impression_source))
+            cleanup += """
+        DROP TABLE IF EXISTS {TABLE};""".format(TABLE=table)
+            for report in group:
+                impression_tables[report.report_number] = table
+
+    report_queries = OrderedDict()
+    for report in reports:
+        # Recorded on the report so callers can tell them apart from the query's inputs
+        report.timestamp = "{}{}_{}".format(now, report.report_number, label)
+        report.run_date = run_date
+        report.impression_table = impression_tables.get(report.report_number, IMPRESSION_TABLE)
+        report_queries[report.report_number] = get_queries(report.campaign_name,
+                                                           report.start_date,
+                                                           report.end_date,
+                                                           report.start_dash,
+                                                           report.end_dash,
+                                                           report.impression_source,
+                                                           report.output_type,
+                                                           report.report_type,
+                                                           report.audience_file,
+                                                           report.pixel_id,
+                                                           report.profile_ids,
+                                                           report.targeted,
+                                                           report.report_number,
+                                                           report.bucket,
+                                                           report.output_prefix,
+                                                           timestamp=report.timestamp,
+                                                           run_date=report.run_date,
+                                                           impression_table=report.impression_table,
+                                                           granularity=granularity,
+                                                           duplicate_buckets=duplicate_buckets or DUPLICATE_BUCKETS,
+                                                           exposure_layout=exposure_layout,
+                                                           include_weekly=not report.local_aggregates,
+                                                           include_duplicates=not report.local_aggregates)
+    return prelude, report_queries, cleanup
+
+
+def get_scan_groups(reports):
+    """ Groups reports that scan the same impressions: same impression source and date range
+    Returns:
+        OrderedDict of (impression source, start date, end date) to list of reports
+    """
+    groups = OrderedDict()
+    for report in reports:
+        groups.setdefault((report.impression_source, report.start_date, report.end_date), []).append(report)
+    return groups
+
+
+def get_shared_impression_queries(table, start_date, end_date, pixel_ids, data_source_id_part):
+    """ Returns the query staging one scan of the impression table for a group of reports. The
+        staging table keeps every column and filter column the report queries read, so they can
+        use it in place of the impression table unchanged.
+    """
+    return """
+        set hive.exec.compress.intermediate=true;
+        set mapreduce.task.timeout=7500000;
+        set mapreduce.map.java.opts=-Xmx3428m;
+        set mapreduce.map.memory.mb=4288;
+        set mapreduce.input.fileinputformat.split.minsize=768000000;
+        set mapreduce.input.fileinputformat.split.maxsize=768000000;
+
+        DROP TABLE IF EXISTS {TABLE};
+        CREATE TABLE {TABLE} AS
+                SELECT  PIXEL_ID,
+                        EVENT_TIMESTAMP,
+                        NA_GUID_ID,
+                        dlx_chpcr,
+                        dlx_chpth,
+                        DATA_DATE,
+                        DATA_SOURCE_ID_PART,
+                        SOURCE
+                FROM    {IMPRESSION_TABLE}
+                WHERE   DATA_DATE >= '{START_DATE}'
+                AND     DATA_DATE <= '{END_DATE}'
+                AND     PIXEL_ID IN ({PIXEL_ID})
+                AND     DATA_SOURCE_ID_PART = {DATA_SOURCE_ID_PART}
+                AND     SOURCE = "save";
+        """.format(TABLE=table,
+                   IMPRESSION_TABLE=IMPRESSION_TABLE,
+                   START_DATE=start_date,
+                   END_DATE=end_date,
+                   PIXEL_ID=pixel_ids,
+                   DATA_SOURCE_ID_PART=data_source_id_part)
+
 
 def get_queries(campaign_name, start_date, end_date,
                 start_string, end_string, impression_src,
                 output_type, report_type, audience_file, pixel_id,
                 profile_ids, targeted, report_num,
-                s3_bucket, s3_prefix):
+                s3_bucket, s3_prefix, timestamp=None, run_date=None,
+                impression_table=IMPRESSION_TABLE, granularity="week",
+                duplicate_buckets=DUPLICATE_BUCKETS, exposure_layout="unsorted",
+                include_weekly=True, include_duplicates=True):
     """ Generates all queries and returns as one string
+    Args:
+        timestamp (str): Suffix for table names (optional, defaults to the current time and report number)
+        run_date (str): Run date written to the summary (optional, defaults to the current time)
+        impression_table (str): Table to read impressions from (optional, e.g. a shared staging table)
+        granularity (str): Bucket size of the WEEKLY counts: day, week or month (optional)
+        duplicate_buckets (str): DUPLICATES buckets, see parse_duplicate_buckets (optional)
+        exposure_layout (str): Layout of the EXPOSURE output files, see get_exposure_order_clause (optional)
+        include_weekly (bool): Include the WEEKLY queries; leave them out when aggregates.py builds
+                               the file from the Exposure File instead (optional)
+        include_duplicates (bool): Include the DUPLICATES queries, as include_weekly (optional)
     Returns:
         Query string
     """
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S") + "{}".format(report_num)
-    run_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S") + "{}".format(report_num)
+    if run_date is None:
+        run_date = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
     where_clause = get_where_clause(output_type)
+    order_clause = get_exposure_order_clause(exposure_layout)
+    exposure_settings, exposure_reset = get_exposure_settings(exposure_layout)
     target_join = get_target_join_targeted(targeted)
     time_range = get_time_range_targeted(targeted, start_date, end_date)
     pixel_where = get_pixel_where_targeted(targeted, profile_ids)
     data_source_id_part = get_data_source_id_part(impression_src)
-    start_dates, end_dates = create_weekly_splits(start_date, end_date)
+    start_dates, end_dates = create_splits(start_date, end_date, granularity)
     s3_path = "s3://{s3_bucket}/{s3_prefix}/{campaign_name}".format(s3_bucket=s3_bucket,
                                                                     s3_prefix=s3_prefix,
                                                                     campaign_name=campaign_name)
     if report_type == "Household":
         report_queries = get_household_queries(audience_file,timestamp, data_source_id_part, campaign_name,
                                                start_date, end_date, pixel_id, profile_ids, target_join,
-                                               time_range, pixel_where, s3_path, run_date, where_clause, report_num)
+                                               time_range, pixel_where, s3_path, run_date, where_clause, report_num,
+                                               impression_table=impression_table, order_clause=order_clause,
+                                               exposure_settings=exposure_settings, exposure_reset=exposure_reset)
     elif report_type == "Individual":
         report_queries = get_individual_queries(audience_file, timestamp, data_source_id_part, campaign_name,
                                                 start_date, end_date, pixel_id, profile_ids, s3_path,
-                                                run_date, where_clause, report_num)
+                                                run_date, where_clause, report_num,
+                                                impression_table=impression_table, order_clause=order_clause,
+                                                exposure_settings=exposure_settings, exposure_reset=exposure_reset)
 
-    weekly_queries = get_weekly_queries(start_dates, end_dates, s3_path, timestamp)
-    duplicate_queries = get_duplicate_queries(report_num, campaign_name, timestamp, s3_path)
+    weekly_queries = get_weekly_queries(start_dates, end_dates, s3_path, timestamp, granularity) if include_weekly else ""
+    duplicate_queries = get_duplicate_queries(report_num, campaign_name, timestamp, s3_path, duplicate_buckets) if include_duplicates else ""
     return report_queries + weekly_queries + duplicate_queries
 
 
@@ -50,6 +196,41 @@ def get_where_clause(output_type):
         return "WHERE IMPRESSION_TIMESTAMP IS NULL"
 
 
+def get_exposure_order_clause(exposure_layout="unsorted"):
+    """ Return query string laying out the EXPOSURE output files
+        unsorted: reducer files in no particular order, sorted locally after download
+        sorted_parts: all rows of a CUST_ID in one file, each file sorted on
+                      (CUST_ID, IMPRESSION_TIMESTAMP), so the files only need a local merge
+        ordered_gzip: gzip files in total (CUST_ID, IMPRESSION_TIMESTAMP) order across files, so
+                      the files only need concatenating (see get_exposure_settings)
+    Returns:
+        String distribute/sort statement or empty string
+    """
+    if exposure_layout == "sorted_parts":
+        return "DISTRIBUTE BY CUST_ID SORT BY CUST_ID, IMPRESSION_TIMESTAMP"
+    elif exposure_layout == "ordered_gzip":
+        return "ORDER BY CUST_ID, IMPRESSION_TIMESTAMP"
+    return ""
+
+
+def get_exposure_settings(exposure_layout="unsorted"):
+    """ Return set statements for the EXPOSURE insert, and statements restoring the defaults after
+        it so the later WEEKLY and DUPLICATES files stay plain CSV. For ordered_gzip, output is
+        gzip compressed and ORDER BY is range partitioned over all reducers from a sample of the
+        keys, instead of running on one reducer; files are written in key order.
+    Returns:
+        Settings string and reset string, both empty if nothing changes
+    """
+    if exposure_layout == "ordered_gzip":
+        settings = """set hive.exec.compress.output=true;
+        set mapreduce.output.fileoutputformat.compress.codec=org.apache.hadoop.io.compress.GzipCodec;
+        set hive.optimize.sampling.orderby=true;"""
+        reset = """set hive.exec.compress.output=false;
+        set hive.optimize.sampling.orderby=false;"""
+        return settings, reset
+    return "", ""
+
+
 def get_target_join_targeted(targeted):
     """ Adds an extra join to query if a targeted campaign
     Returns:
@@ -111,6 +292,21 @@ def create_weekly_splits(start_date, end_date):
     Returns:
         Two lists of start and end date strings
     """
+    return create_splits(start_date, end_date, "week")
+
+
+def create_splits(start_date, end_date, granularity="week"):
+    """ Creates a list of start and end dates for the counts table at a given granularity.
+        Days and weeks are counted from the start date; months after the first start on the 1st.
+        NOTE: end date + 1 because of the exclusive '<' in
+              'IMPRESSION TIMESTAMP < [END DATE]'
+    Args:
+        start_date: Start date
+        end_date: End date string
+        granularity: day, week or month
+    Returns:
+        Two lists of start and end date strings
+    """
     start = datetime.strptime(start_date, "%Y%m%d")
     end = datetime.strptime(end_date, "%Y%m%d") + timedelta(days=1)
 
@@ -118,7 +314,12 @@ def create_weekly_splits(start_date, end_date):
     end_dates = []
     while start < end:
         start_dates.append(start.strftime("%Y-%m-%d %H:%M:%S"))
-        start = start + timedelta(days=7)
+        if granularity == "day":
+            start = start + timedelta(days=1)
+        elif granularity == "month":
+            start = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        else:
+            start = start + timedelta(days=7)
     end_dates = start_dates[1:]
     end_dates.append(end.strftime("%Y-%m-%d %H:%M:%S"))
 
@@ -126,8 +327,30 @@ def create_weekly_splits(start_date, end_date):
     return start_dates, end_dates
 
 
-def get_weekly_queries(start_dates, end_dates, s3_path, timestamp):
-    """Returns weekly file queries"""
+def get_bucket_expression(start_date, granularity="week"):
+    """ Returns the Hive expression numbering an impression's bucket from 1, matching create_splits
+    Args:
+        start_date: Start date string as returned by create_splits
+        granularity: day, week or month
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+    if granularity == "day":
+        return "DATEDIFF(TO_DATE(a.IMPRESSION_TIMESTAMP), '{}') + 1".format(start.strftime("%Y-%m-%d"))
+    elif granularity == "month":
+        return "(YEAR(a.IMPRESSION_TIMESTAMP) - {}) * 12 + MONTH(a.IMPRESSION_TIMESTAMP) - {} + 1".format(start.year, start.month)
+    return "FLOOR(DATEDIFF(TO_DATE(a.IMPRESSION_TIMESTAMP), '{}') / 7) + 1".format(start.strftime("%Y-%m-%d"))
+
+
+def get_weekly_queries(start_dates, end_dates, s3_path, timestamp, granularity="week"):
+    """ Returns weekly file queries. Impressions are counted per bucket in one grouped scan and
+        left joined to a calendar of every bucket, so buckets without impressions keep their row.
+    Args:
+        start_dates, end_dates: Bucket boundaries from create_splits
+        granularity: day, week or month, as used for create_splits
+    """
+    calendar = ",\n                                ".join(
+        "{}, '{}'".format(i + 1, datetime.strptime(start, "%Y-%m-%d %H:%M:%S").strftime("%m/%d/%Y"))
+        for i, start in enumerate(start_dates))
     queries = """
         DROP TABLE IF EXISTS WEEKLY_COUNTS_{TS};
         CREATE EXTERNAL TABLE WEEKLY_COUNTS_{TS}
@@ -140,67 +363,65 @@ def get_weekly_queries(start_dates, end_dates, s3_path, timestamp):
         LOCATION '{S3_OUT_PATH}/WEEKLY/';
 
         INSERT OVERWRITE TABLE WEEKLY_COUNTS_{TS}
-            SELECT     1,
-                       '{START_STRING}',
-                       COUNT(a.CUST_ID) COUNT_IMPRESSIONS,
-                       (COUNT(a.CUST_ID)/COUNT(DISTINCT(a.CUST_ID))) AVG_IMPS_PER_CUSTID
-            FROM       EXPOSURE_FILE_{TS} a
-            WHERE      a.IMPRESSION_TIMESTAMP IS NOT NULL
-            AND        a.IMPRESSION_TIMESTAMP >= '{START_DATE}'
-            AND        a.IMPRESSION_TIMESTAMP <  '{END_DATE}';
+            SELECT     c.WEEK_NUMBER,
+                       c.START_DATE,
+                       COALESCE(w.COUNT_IMPRESSIONS, 0),
+                       w.AVG_IMPS_PER_CUSTID
+            FROM       (SELECT stack({BUCKETS},
+                                {CALENDAR}) AS (WEEK_NUMBER, START_DATE)) c
+            LEFT JOIN  (SELECT     {BUCKET} WEEK_NUMBER,
+                                   COUNT(a.CUST_ID) COUNT_IMPRESSIONS,
+                                   (COUNT(a.CUST_ID)/COUNT(DISTINCT(a.CUST_ID))) AVG_IMPS_PER_CUSTID
+                        FROM       EXPOSURE_FILE_{TS} a
+                        WHERE      a.IMPRESSION_TIMESTAMP IS NOT NULL
+                        AND        a.IMPRESSION_TIMESTAMP >= '{START_DATE}'
+                        AND        a.IMPRESSION_TIMESTAMP <  '{END_DATE}'
+                        GROUP BY   {BUCKET}) w
+            ON         c.WEEK_NUMBER = w.WEEK_NUMBER
+            ORDER BY   c.WEEK_NUMBER;
     """.format(TS=timestamp, S3_OUT_PATH=s3_path,
-               START_STRING=datetime.strptime(start_dates[0], "%Y-%m-%d %H:%M:%S").strftime("%m/%d/%Y"),
-               START_DATE=start_dates[0], END_DATE=end_dates[0])
-
-    for i in range(1, len(start_dates)):
-        queries += """
-            INSERT INTO TABLE WEEKLY_COUNTS_{TS}
-                SELECT     {WEEK_NUM},
-                           '{START_STRING}',
-                           COUNT(a.CUST_ID) COUNT_IMPRESSIONS,
-                           (COUNT(a.CUST_ID)/COUNT(DISTINCT(a.CUST_ID))) AVG_IMPS_PER_CUSTID
-                FROM       EXPOSURE_FILE_{TS} a
-                WHERE      a.IMPRESSION_TIMESTAMP IS NOT NULL
-                AND        a.IMPRESSION_TIMESTAMP >= '{START_DATE}'
-                AND        a.IMPRESSION_TIMESTAMP <  '{END_DATE}';
-        """.format(WEEK_NUM=i+1, TS=timestamp,
-                   START_STRING=datetime.strptime(start_dates[i], "%Y-%m-%d %H:%M:%S").strftime("%m/%d/%Y"),
-                   START_DATE=start_dates[i], END_DATE=end_dates[i])
+               BUCKETS=len(start_dates), CALENDAR=calendar,
+               BUCKET=get_bucket_expression(start_dates[0], granularity),
+               START_DATE=start_dates[0], END_DATE=end_dates[-1])
     return queries
 
 
-def get_duplicate_queries(report_num, campaign_name, ts, s3_path):
-    """Returns queries calculating duplicate lines in onramp file"""
-    queries = ""
-    # Duplication metrics to track -- this can be passed in
-    metrics = [(2, '='), (3, '='), (4, '='), (5, '='), (10, '>=')]
-    # Join table denotations
-    chars = [chr(98+k) for k,v in enumerate(metrics)]
-    # Dynamic query strings
-    create = ['duplicate{metric} bigint'.format(metric=metric[0]) for metric in metrics]
-    select = ['{}.dupes'.format(char) for char in chars]
-    innerjoin = ['inner join duplicate{metric}_{ts} {table}\n\t\ton b.join_var = {table}.join_var'.format(metric=metrics[i][0], ts=ts, table=chars[i]) for i in range(1, len(metrics))]
-
-    for metric in metrics:
-        queries += """
-        drop table if exists duplicate{metric}_{ts};
-        create table duplicate{metric}_{ts} as
-            select '{report_number}' report_number, count(distinct(s.cust_id)) dupes, 'a' join_var
-            from exposure_file_{ts} s
-            inner join (
-                select cust_id, impression_timestamp, creative_id, count(*) as qty
-                from exposure_file_{ts}
-                group by cust_id, impression_timestamp, creative_id
-                having count(*) {condition} {metric}
-                ) t
-            on s.cust_id = t.cust_id
-            and s.impression_timestamp = t.impression_timestamp
-            and s.creative_id = t.creative_id;
-        """.format(metric=metric[0],
-                   condition=metric[1],
-                   ts=ts, report_number=report_num)
-
-    queries += """
+def parse_duplicate_buckets(buckets=DUPLICATE_BUCKETS):
+    """ Parses duplicate buckets such as "2,3,4,5,10+": N counts keys seen exactly N times,
+        N+ counts keys seen N or more times
+    Returns:
+        List of (count, condition) tuples, e.g. [(2, '='), (10, '>=')]
+    """
+    metrics = []
+    for bucket in str(buckets).split(','):
+        bucket = bucket.strip()
+        if bucket.endswith('+'):
+            metric = (int(bucket[:-1]), '>=')
+        else:
+            metric = (int(bucket), '=')
+        if metric[0] < 2:
+            raise ValueError("Duplicate bucket {} must count at least 2 lines".format(bucket))
+        metrics.append(metric)
+    if not metrics:
+        raise ValueError("No duplicate buckets in {}".format(buckets))
+    return metrics
+
+
+def get_duplicate_queries(report_num, campaign_name, ts, s3_path, buckets=DUPLICATE_BUCKETS):
+    """ Returns queries calculating duplicate lines in onramp file. Lines are counted once per
+        (cust_id, impression_timestamp, creative_id) key, and every bucket is read off that one
+        histogram as the number of distinct cust_ids with a key in the bucket.
+    Args:
+        buckets (str or list): Duplicate buckets, see parse_duplicate_buckets
+    """
+    metrics = parse_duplicate_buckets(buckets) if isinstance(buckets, str) else buckets
+    columns = ['duplicate{}{}'.format(count, '_or_more' if condition == '>=' else '') for count, condition in metrics]
+    create = ['{} bigint'.format(column) for column in columns]
+    select = ['h.{}'.format(column) for column in columns]
+    histogram = ['count(distinct case when k.qty {condition} {count} then k.cust_id end) {column}'.format(
+                     condition=condition, count=count, column=column) for (count, condition), column in zip(metrics, columns)]
+
+    queries = """
         drop table if exists duplicates_{ts};
         create external table duplicates_{ts}
             (report_number string,
@@ -217,22 +438,129 @@ def get_duplicate_queries(report_num, campaign_name, ts, s3_path):
                        {select},
                        (({add})/a.exposed_unique_custid) * 100
             from       summary_stats_{ts} a
-            inner join duplicate{metric}_{ts} b
-            on         a.report_number = b.report_number
-                       {innerjoin};
+            cross join (
+                select {histogram}
+                from (
+                    select cust_id, impression_timestamp, creative_id, count(*) as qty
+                    from exposure_file_{ts}
+                    where cust_id is not null
+                    and impression_timestamp is not null
+                    and creative_id is not null
+                    group by cust_id, impression_timestamp, creative_id
+                    ) k
+                ) h;
         """.format(ts=ts, report_num=report_num, campaign_name=campaign_name,
-                   s3_out_path=s3_path, metric=metrics[0][0],
+                   s3_out_path=s3_path,
                    create=',\n\t\t'.join(create),
                    select=',\n\t\t'.join(select),
                    add=' + '.join(select),
-                   innerjoin='\n\t\t'.join(innerjoin))
+                   histogram=',\n\t\t'.join(histogram))
     return queries
 
 
+SUMMARY_COLUMNS = [("ROWS_IN_EXPOSURE_FILE", "bigint"),
+                   ("TOTAL_IMPRESSIONS_SERVED", "bigint"),
+                   ("INSEGMENT_IMPRESSIONS", "bigint"),
+                   ("IMPRESSIONS_MATCHED_TO_DLX_HH", "bigint"),
+                   ("EXPOSED_UNIQUE_HH", "bigint"),
+                   ("IMPRESSIONS_IN_FILE", "bigint"),
+                   ("CUSTOMER_IDS_IN_FILE", "bigint"),
+                   ("EXPOSED_UNIQUE_CUSTID", "bigint"),
+                   ("EXPOSED_UNIQUE_HH_IN_FILE", "bigint"),
+                   ("CREATIVE_COUNT", "bigint"),
+                   ("PLACEMENT_COUNT", "bigint"),
+                   ("EXPOSURE_START_DATE", "string"),
+                   ("EXPOSURE_END_DATE", "string")]
+
+# Summary metrics as (source table, aggregate expression), keyed by report type and SUMMARY_COLUMNS
+# name. Each WHERE filter of the original per-metric tables is folded into a CASE expression so
+# every metric of a source table comes out of one scan.
+INDIVIDUAL_EXPOSED = "IMPRESSION_TIMESTAMP IS NOT NULL AND IMPRESSION_TIMESTAMP NOT LIKE '\n' AND IMPRESSION_TIMESTAMP NOT LIKE ''"
+SUMMARY_METRICS = {
+    "Household": {
+        "ROWS_IN_EXPOSURE_FILE": ("EXPOSURE_FILE", "COUNT(*)"),
+        "TOTAL_IMPRESSIONS_SERVED": ("IMPSCOUNT_TABLE", "MAX(CAST(IMPS_COUNT AS BIGINT))"),
+        "INSEGMENT_IMPRESSIONS": ("STEP1_TABLE", "COUNT(*)"),
+        "IMPRESSIONS_MATCHED_TO_DLX_HH": ("STEP1_TABLE", 'COUNT(CASE WHEN HHID != "0" THEN 1 END)'),
+        "EXPOSED_UNIQUE_HH": ("STEP1_TABLE", 'COUNT(DISTINCT CASE WHEN HHID != "0" THEN HHID END)'),
+        "IMPRESSIONS_IN_FILE": ("EXPOSURE_FILE", "COUNT(CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL THEN CUST_ID END)"),
+        "CUSTOMER_IDS_IN_FILE": ("EXPOSURE_FILE", "COUNT(DISTINCT CUST_ID)"),
+        "EXPOSED_UNIQUE_CUSTID": ("EXPOSURE_FILE", "COUNT(DISTINCT CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL THEN CUST_ID END)"),
+        "EXPOSED_UNIQUE_HH_IN_FILE": ("STEP2_TABLE", 'COUNT(DISTINCT CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL AND HHID != "0" THEN HHID END)'),
+        "CREATIVE_COUNT": ("EXPOSURE_FILE", "COUNT(CASE WHEN CREATIVE_ID <> '' AND LENGTH(CREATIVE_ID) > 0 THEN CREATIVE_ID END)"),
+        "PLACEMENT_COUNT": ("EXPOSURE_FILE", "COUNT(CASE WHEN PLACEMENT_ID <> '' AND LENGTH(PLACEMENT_ID) > 0 THEN PLACEMENT_ID END)"),
+        "EXPOSURE_START_DATE": ("EXPOSURE_FILE", "MIN(IMPRESSION_TIMESTAMP)"),
+        "EXPOSURE_END_DATE": ("EXPOSURE_FILE", "MAX(IMPRESSION_TIMESTAMP)"),
+    },
+    "Individual": {
+        "ROWS_IN_EXPOSURE_FILE": ("EXPOSURE_FILE", "COUNT(*)"),
+        "TOTAL_IMPRESSIONS_SERVED": ("IMPSCOUNT_TABLE", "MAX(CAST(IMPS_COUNT AS BIGINT))"),
+        "INSEGMENT_IMPRESSIONS": ("STEP1_TABLE", "COUNT(*)"),
+        "IMPRESSIONS_MATCHED_TO_DLX_HH": ("STEP1_TABLE", "COUNT(CASE WHEN GROUP_ID != '0' AND GROUP_ID != '-1' THEN 1 END)"),
+        "EXPOSED_UNIQUE_HH": ("STEP1_TABLE", 'COUNT(DISTINCT CASE WHEN GROUP_ID != "0" THEN GROUP_ID END)'),
+        "IMPRESSIONS_IN_FILE": ("EXPOSURE_FILE", "COUNT(CASE WHEN {} THEN 1 END)".format(INDIVIDUAL_EXPOSED)),
+        "CUSTOMER_IDS_IN_FILE": ("EXPOSURE_FILE", "COUNT(DISTINCT CUST_ID)"),
+        "EXPOSED_UNIQUE_CUSTID": ("EXPOSURE_FILE", "COUNT(DISTINCT CASE WHEN {} THEN CUST_ID END)".format(INDIVIDUAL_EXPOSED)),
+        "EXPOSED_UNIQUE_HH_IN_FILE": ("STEP2_TABLE", 'COUNT(DISTINCT CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL AND MAP_IND != "0" THEN MAP_IND END)'),
+        "CREATIVE_COUNT": ("EXPOSURE_FILE", "COUNT(CASE WHEN CREATIVE_ID <> '' AND LENGTH(CREATIVE_ID) > 0 THEN CREATIVE_ID END)"),
+        "PLACEMENT_COUNT": ("EXPOSURE_FILE", "COUNT(CASE WHEN PLACEMENT_ID <> '' AND LENGTH(PLACEMENT_ID) > 0 THEN PLACEMENT_ID END)"),
+        "EXPOSURE_START_DATE": ("EXPOSURE_FILE", "MIN(CASE WHEN {} THEN IMPRESSION_TIMESTAMP END)".format(INDIVIDUAL_EXPOSED)),
+        "EXPOSURE_END_DATE": ("EXPOSURE_FILE", "MAX(CASE WHEN {} THEN IMPRESSION_TIMESTAMP END)".format(INDIVIDUAL_EXPOSED)),
+    },
+}
+
+
+def get_summary_queries(report_type, timestamp, campaign_name, run_date, report_num, s3_path):
+    """ Returns the SUMMARY_STATS queries. All metrics of a source table are computed in one
+        aggregate scan, and the single-row scans are cross joined straight into SUMMARY_STATS
+        in the column order of headers.get_summary_headers.
+    Args:
+        report_type (str): Household or Individual
+    Returns:
+        Query string
+    """
+    metrics = SUMMARY_METRICS[report_type]
+    sources = OrderedDict()
+    for column, _ in SUMMARY_COLUMNS:
+        source, expression = metrics[column]
+        sources.setdefault(source, []).append("{} {}".format(expression, column))
+
+    scans = ["(SELECT      {EXPRESSIONS}\n                         FROM        {SOURCE}_{TS}) {SOURCE}".format(
+                 EXPRESSIONS=",\n                                     ".join(expressions), SOURCE=source, TS=timestamp)
+             for source, expressions in sources.items()]
+    return """
+        DROP TABLE IF EXISTS SUMMARY_STATS_{TS};
+        CREATE EXTERNAL TABLE SUMMARY_STATS_{TS}
+            (REPORT_NUMBER                 string,
+             CAMPAIGN_NAME                 string,
+             RUN_DATE                      string,
+             {COLUMNS})
+        ROW FORMAT DELIMITED FIELDS TERMINATED BY ','
+        NULL DEFINED AS ''
+        LOCATION '{S3_OUT_PATH}/SUMMARY/';
+
+        INSERT OVERWRITE TABLE SUMMARY_STATS_{TS}
+            SELECT      '{REPORT_NUMBER}',
+                        '{CAMPAIGN_NAME}',
+                        '{RUN_DATE}',
+                        {SELECT}
+            FROM        {SCANS};
+        """.format(TS=timestamp,
+                   COLUMNS=",\n             ".join("{:<29} {}".format(column, column_type) for column, column_type in SUMMARY_COLUMNS),
+                   S3_OUT_PATH=s3_path,
+                   REPORT_NUMBER=report_num,
+                   CAMPAIGN_NAME=campaign_name,
+                   RUN_DATE=run_date,
+                   SELECT=",\n                        ".join("{}.{}".format(metrics[column][0], column) for column, _ in SUMMARY_COLUMNS),
+                   SCANS="\n            CROSS JOIN  ".join(scans))
+
+
 def get_household_queries(audience_file, timestamp, data_source_id_part,
                           campaign_name, start_date, end_date, pixel_id,
                           profile_ids, target_join, time_range, pixel_where,
-                          s3_path, run_date, where_clause, report_num):
+                          s3_path, run_date, where_clause, report_num,
+                          impression_table=IMPRESSION_TABLE, order_clause="",
+                          exposure_settings="", exposure_reset=""):
     queries = """
         set hive.map.aggr=false;
         set hive.exec.compress.intermediate=true;
@@ -281,6 +609,20 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
                         ATTRIBUTE_2,
                         ATTRIBUTE_3,
                         ATTRIBUTE_4;
+        DROP TABLE IF EXISTS IMPRESSIONS_{TS};
+        CREATE TABLE IMPRESSIONS_{TS} AS
+                SELECT  PIXEL_ID,
+                        EVENT_TIMESTAMP,
+                        NA_GUID_ID,
+                        dlx_chpcr,
+                        dlx_chpth
+                FROM    {IMPRESSION_TABLE}
+                WHERE   DATA_DATE >= '{START_DATE}'
+                AND     DATA_DATE <= '{END_DATE}'
+                AND     PIXEL_ID IN ({PIXEL_ID})
+                AND     DATA_SOURCE_ID_PART = {DATA_SOURCE_ID_PART}
+                AND     SOURCE = "save";
+
         DROP TABLE IF EXISTS IMPSCOUNT_TABLE_{TS};
         CREATE EXTERNAL TABLE IMPSCOUNT_TABLE_{TS}
                 (IMPS_COUNT string);
@@ -288,12 +630,7 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
 
         INSERT OVERWRITE TABLE IMPSCOUNT_TABLE_{TS}
                 SELECT  COUNT(*)
-                FROM    core_digital.unified_impression
-                WHERE   DATA_DATE >= '{START_DATE}'
-                AND     DATA_DATE <= '{END_DATE}'
-                AND     PIXEL_ID IN ({PIXEL_ID})
-                AND     DATA_SOURCE_ID_PART = {DATA_SOURCE_ID_PART}
-                AND     SOURCE = "save";
+                FROM    IMPRESSIONS_{TS};
         
         DROP TABLE IF EXISTS STEP1_TABLE_{TS};
         CREATE EXTERNAL TABLE STEP1_TABLE_{TS}
@@ -309,17 +646,13 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
                             from_unixtime(unix_timestamp(a.EVENT_TIMESTAMP, "yyyy-MM-dd'T'HH:mm:ss.S'Z'")) IMPRESSION_TIMESTAMP,
                             a.dlx_chpcr,
                             a.dlx_chpth
-                FROM        core_digital.unified_impression a
+                FROM        IMPRESSIONS_{TS} a
                 INNER JOIN  core_digital.best_matched_cookies_history b
                 ON          a.NA_GUID_ID = b.GUID
                 {TARGET_JOIN}
-                WHERE       a.DATA_DATE >= '{START_DATE}' 
-                AND         a.DATA_DATE <= '{END_DATE}'
+                WHERE       a.PIXEL_ID IN ({PIXEL_ID})
                 {TIME_RANGE}
-                AND         a.PIXEL_ID IN ({PIXEL_ID})
-                {PIXEL_WHERE}
-                AND         a.DATA_SOURCE_ID_PART = {DATA_SOURCE_ID_PART}
-                AND         a.SOURCE = "save";
+                {PIXEL_WHERE};
         
         DROP TABLE IF EXISTS STEP2_TABLE_{TS};
         CREATE EXTERNAL TABLE STEP2_TABLE_{TS}
@@ -375,147 +708,32 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
                 FROM   STEP2_TABLE_{TS};
 
 
-        DROP TABLE IF EXISTS ROW_COUNT_{TS};
-        DROP TABLE IF EXISTS TOTAL_IMPS_{TS};
-        DROP TABLE IF EXISTS INSEGMENT_IMPS_{TS};
-        DROP TABLE IF EXISTS IMPS_TO_HH_{TS};
-        DROP TABLE IF EXISTS IMPS_IN_FILE_{TS};
-        DROP TABLE IF EXISTS CUSTID_IN_TABLE_{TS};
-        DROP TABLE IF EXISTS EXP_UNIQUE_CUSTID_{TS};
-        DROP TABLE IF EXISTS EXP_START_DATE_{TS};
-        DROP TABLE IF EXISTS EXP_END_DATE_{TS};
-        DROP TABLE IF EXISTS SUMMARY_STATS_{TS};
-        
-        CREATE TABLE ROW_COUNT_{TS} (JOIN_VAR VARCHAR(1), ROWS_IN_EXPOSURE_FILE BIGINT);
-        INSERT INTO TABLE ROW_COUNT_{TS} SELECT 'A', COUNT(*) FROM EXPOSURE_FILE_{TS};
-
-        CREATE TABLE TOTAL_IMPS_{TS} (JOIN_VAR VARCHAR(1), TOTAL_IMPRESSIONS_SERVED BIGINT);
-        INSERT INTO TABLE TOTAL_IMPS_{TS} SELECT 'A', IMPS_COUNT FROM IMPSCOUNT_TABLE_{TS};
-
-        CREATE TABLE INSEGMENT_IMPS_{TS} (JOIN_VAR VARCHAR(1), INSEGMENT_IMPRESSIONS BIGINT);
-        INSERT INTO TABLE INSEGMENT_IMPS_{TS} SELECT 'A', COUNT(*) FROM STEP1_TABLE_{TS};
-
-        CREATE TABLE IMPS_TO_HH_{TS} (JOIN_VAR VARCHAR(1), IMPRESSIONS_MATCHED_TO_DLX_HH BIGINT);
-        INSERT INTO TABLE IMPS_TO_HH_{TS} SELECT 'A', COUNT(*) FROM STEP1_TABLE_{TS} WHERE HHID != "0";
-
-        CREATE TABLE EXPOSED_UNIQUE_HH_{TS} (JOIN_VAR string, EXPOSED_UNIQUE_HH bigint);
-        INSERT INTO TABLE EXPOSED_UNIQUE_HH_{TS} SELECT 'A', COUNT(DISTINCT(HHID)) FROM STEP1_TABLE_{TS} WHERE HHID != "0";
-
-        CREATE TABLE IMPS_IN_FILE_{TS} (JOIN_VAR VARCHAR(1), IMPRESSIONS_IN_FILE BIGINT);
-        INSERT INTO TABLE IMPS_IN_FILE_{TS} SELECT 'A', COUNT(CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL THEN CUST_ID END) FROM EXPOSURE_FILE_{TS};
-
-        CREATE TABLE CUSTID_IN_TABLE_{TS} (JOIN_VAR VARCHAR(1), CUSTOMER_IDS_IN_FILE BIGINT);
-        INSERT INTO TABLE CUSTID_IN_TABLE_{TS} SELECT 'A', COUNT(DISTINCT CUST_ID) FROM EXPOSURE_FILE_{TS};
-
-        CREATE TABLE EXP_UNIQUE_CUSTID_{TS} (JOIN_VAR string, EXPOSED_UNIQUE_CUSTID bigint);
-        INSERT INTO TABLE EXP_UNIQUE_CUSTID_{TS} SELECT 'A', COUNT(DISTINCT CASE WHEN IMPRESSION_TIMESTAMP IS NOT NULL THEN CUST_ID END) FROM EXPOSURE_FILE_{TS};
-
-        CREATE TABLE EXP_UNIQUE_HH_IN_FILE_{TS} (JOIN_VAR string, EXPOSED_UNIQUE_HH_IN_FILE bigint);
-        INSERT INTO TABLE EXP_UNIQUE_HH_IN_FILE_{TS} SELECT 'A', COUNT(DISTINCT(HHID)) FROM STEP2_TABLE_{TS} WHERE IMPRESSION_TIMESTAMP IS NOT NULL AND HHID != "0";
-
-        CREATE TABLE CREATIVE_COUNT_{TS} (JOIN_VAR string, CREATIVE_COUNT bigint);
-        INSERT INTO TABLE CREATIVE_COUNT_{TS} SELECT 'A', COUNT(CREATIVE_ID) FROM EXPOSURE_FILE_{TS} WHERE CREATIVE_ID IS NOT NULL AND CREATIVE_ID <> '' AND LENGTH(CREATIVE_ID) > 0;
-
-        CREATE TABLE PLACEMENT_COUNT_{TS} (JOIN_VAR string, PLACEMENT_COUNT bigint);
-        INSERT INTO TABLE PLACEMENT_COUNT_{TS} SELECT 'A', COUNT(PLACEMENT_ID) FROM EXPOSURE_FILE_{TS} WHERE PLACEMENT_ID IS NOT NULL AND PLACEMENT_ID <> '' AND LENGTH(PLACEMENT_ID) > 0;
-
-        CREATE TABLE EXP_START_DATE_{TS} (JOIN_VAR VARCHAR(1), EXPOSURE_START_DATE VARCHAR(100));
-        INSERT INTO TABLE EXP_START_DATE_{TS} SELECT 'A', MIN(IMPRESSION_TIMESTAMP) FROM EXPOSURE_FILE_{TS};
-
-        CREATE TABLE EXP_END_DATE_{TS} (JOIN_VAR VARCHAR(1), EXPOSURE_END_DATE VARCHAR(100));
-        INSERT INTO TABLE EXP_END_DATE_{TS} SELECT 'A', MAX(IMPRESSION_TIMESTAMP) FROM EXPOSURE_FILE_{TS};
-
-        CREATE EXTERNAL TABLE SUMMARY_STATS_{TS}
-            (REPORT_NUMBER                 string,
-             CAMPAIGN_NAME                 string,
-             RUN_DATE                      string,
-             ROWS_IN_EXPOSURE_FILE         bigint,
-             TOTAL_IMPRESSIONS_SERVED      bigint,
-             INSEGMENT_IMPRESSIONS         bigint,
-             IMPRESSIONS_MATCHED_TO_DLX_HH bigint,
-             EXPOSED_UNIQUE_HH             bigint,
-             IMPRESSIONS_IN_FILE           bigint,
-             CUSTOMER_IDS_IN_FILE          bigint,
-             EXPOSED_UNIQUE_CUSTID         bigint,
-             EXPOSED_UNIQUE_HH_IN_FILE     bigint,
-             CREATIVE_COUNT                bigint,
-             PLACEMENT_COUNT               bigint,
-             EXPOSURE_START_DATE           string,
-             EXPOSURE_END_DATE             string)
-        ROW FORMAT DELIMITED FIELDS TERMINATED BY ','
-        NULL DEFINED AS ''
-        LOCATION '{S3_OUT_PATH}/SUMMARY/';
-
-        INSERT OVERWRITE TABLE SUMMARY_STATS_{TS}
-            SELECT      '{REPORT_NUMBER}',
-                        '{CAMPAIGN_NAME}',
-                        '{RUN_DATE}',
-                        a.ROWS_IN_EXPOSURE_FILE,
-                        b.TOTAL_IMPRESSIONS_SERVED,
-                        c.INSEGMENT_IMPRESSIONS,
-                        d.IMPRESSIONS_MATCHED_TO_DLX_HH,
-                        e.EXPOSED_UNIQUE_HH,
-                        f.IMPRESSIONS_IN_FILE,
-                        g.CUSTOMER_IDS_IN_FILE,
-                        h.EXPOSED_UNIQUE_CUSTID,
-                        i.EXPOSED_UNIQUE_HH_IN_FILE,
-                        j.CREATIVE_COUNT,
-                        k.PLACEMENT_COUNT,
-                        l.EXPOSURE_START_DATE,
-                        m.EXPOSURE_END_DATE
-            FROM        ROW_COUNT_{TS} a
-            INNER JOIN  TOTAL_IMPS_{TS} b
-            ON          a.JOIN_VAR = b.JOIN_VAR
-            INNER JOIN  INSEGMENT_IMPS_{TS} c
-            ON          b.JOIN_VAR = c.JOIN_VAR
-            INNER JOIN  IMPS_TO_HH_{TS} d
-            ON          c.JOIN_VAR = d.JOIN_VAR
-            INNER JOIN  EXPOSED_UNIQUE_HH_{TS} e
-            ON          d.JOIN_VAR = e.JOIN_VAR
-            INNER JOIN  IMPS_IN_FILE_{TS} f
-            ON          e.JOIN_VAR = f.JOIN_VAR
-            INNER JOIN  CUSTID_IN_TABLE_{TS} g
-            ON          f.JOIN_VAR = g.JOIN_VAR
-            INNER JOIN  EXP_UNIQUE_CUSTID_{TS} h
-            ON          g.JOIN_VAR = h.JOIN_VAR
-            INNER JOIN  EXP_UNIQUE_HH_IN_FILE_{TS} i
-            ON          h.JOIN_VAR = i.JOIN_VAR
-            INNER JOIN  CREATIVE_COUNT_{TS} j
-            ON          i.JOIN_VAR = j.JOIN_VAR
-            INNER JOIN  PLACEMENT_COUNT_{TS} k
-            ON          j.JOIN_VAR = k.JOIN_VAR
-            INNER JOIN  EXP_START_DATE_{TS} l
-            ON          k.JOIN_VAR = l.JOIN_VAR
-            INNER JOIN  EXP_END_DATE_{TS} m
-            ON          l.JOIN_VAR = m.JOIN_VAR;
+{SUMMARY_QUERIES}
 
         set hive.optimize.insert.dest.volume=true;
         set hive.map.aggr=false;
         set mapred.reduce.tasks=1000;
+        {EXPOSURE_SETTINGS}
         INSERT OVERWRITE DIRECTORY
         "{S3_OUT_PATH}/EXPOSURE/"
         ROW FORMAT DELIMITED FIELDS TERMINATED BY '|'
         NULL DEFINED AS ''
         SELECT *
         FROM EXPOSURE_FILE_{TS}
-        {WHERE_CLAUSE};
+        {WHERE_CLAUSE}
+        {ORDER_CLAUSE};
+        {EXPOSURE_RESET}
 
 
         DROP TABLE IF EXISTS AUDIENCE_TEMP_{TS};
         DROP TABLE IF EXISTS AUDIENCE_{TS};
+        DROP TABLE IF EXISTS IMPRESSIONS_{TS};
         DROP TABLE IF EXISTS IMPSCOUNT_TABLE_{TS};
         DROP TABLE IF EXISTS STEP1_TABLE_{TS};
-        DROP TABLE IF EXISTS ROW_COUNT_{TS};
-        DROP TABLE IF EXISTS TOTAL_IMPS_{TS};
-        DROP TABLE IF EXISTS INSEGMENT_IMPS_{TS};
-        DROP TABLE IF EXISTS IMPS_TO_HH_{TS};
-        DROP TABLE IF EXISTS IMPS_IN_FILE_{TS};
-        DROP TABLE IF EXISTS CUSTID_IN_TABLE_{TS};
-        DROP TABLE IF EXISTS EXP_UNIQUE_CUSTID_{TS};
-        DROP TABLE IF EXISTS EXP_START_DATE_{TS};
-        DROP TABLE IF EXISTS EXP_END_DATE_{TS};
         """.format(AUDIENCE_FILE=audience_file,
                    TS=timestamp,
+                   IMPRESSION_TABLE=impression_table,
+                   SUMMARY_QUERIES=get_summary_queries("Household", timestamp, campaign_name, run_date, report_num, s3_path),
                    DATA_SOURCE_ID_PART=data_source_id_part,
                    CAMPAIGN_NAME=campaign_name,
                    START_DATE=start_date,
@@ -528,6 +746,9 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
                    S3_OUT_PATH=s3_path,
                    RUN_DATE=run_date,
                    WHERE_CLAUSE=where_clause,
+                   ORDER_CLAUSE=order_clause,
+                   EXPOSURE_SETTINGS=exposure_settings,
+                   EXPOSURE_RESET=exposure_reset,
                    REPORT_NUMBER=report_num)
     return queries
 
@@ -535,7 +756,9 @@ def get_household_queries(audience_file, timestamp, data_source_id_part,
 def get_individual_queries(audience_file, timestamp, data_source_id_part,
                            campaign_name, start_date, end_date,
                            pixel_id, profile_ids, s3_path,
-                           run_date, where_clause, report_num):
+                           run_date, where_clause, report_num,
+                           impression_table=IMPRESSION_TABLE, order_clause="",
+                           exposure_settings="", exposure_reset=""):
     queries = """
         set hive.map.aggr=false;
         set hive.exec.compress.intermediate=true; 
@@ -584,18 +807,27 @@ def get_individual_queries(audience_file, timestamp, data_source_id_part,
             GROUP BY  CUST_ID, HHID, GROUP_ID, ATTRIBUTE_1, ATTRIBUTE_2, ATTRIBUTE_3, ATTRIBUTE_4;
 
 
+        DROP TABLE IF EXISTS IMPRESSIONS_{TS};
+        CREATE TABLE IMPRESSIONS_{TS} AS
+            SELECT PIXEL_ID,
+                   EVENT_TIMESTAMP,
+                   NA_GUID_ID,
+                   dlx_chpcr,
+                   dlx_chpth
+            FROM   {IMPRESSION_TABLE}
+            WHERE  PIXEL_ID IN ({PIXEL_ID})
+            AND    DATA_DATE >= '{START_DATE}'
+            AND    DATA_DATE <= '{END_DATE}'
+            AND    data_source_id_part = {DATA_SOURCE_ID_PART}
+            AND    source='save';
+
         DROP TABLE IF EXISTS IMPSCOUNT_TABLE_{TS};
         CREATE EXTERNAL TABLE IMPSCOUNT_TABLE_{TS}
             (IMPS_COUNT string);
 
         INSERT OVERWRITE TABLE IMPSCOUNT_TABLE_{TS}
             SELECT COUNT(*) IMPS_COUNT
-            FROM   core_digital.unified_impression
-            WHERE  PIXEL_ID IN ({PIXEL_ID})
-            AND    DATA_DATE >= '{START_DATE}'
-            AND    DATA_DATE <= '{END_DATE}'
-            AND    data_source_id_part = {DATA_SOURCE_ID_PART}
-            AND    source='save';
+            FROM   IMPRESSIONS_{TS};
 
         DROP TABLE IF EXISTS STEP1_TABLE_{TS};
         CREATE EXTERNAL TABLE STEP1_TABLE_{TS}
@@ -611,16 +843,11 @@ def get_individual_queries(audience_file, timestamp, data_source_id_part,
                    from_unixtime(unix_timestamp(a.event_timestamp,"yyyy-MM-dd'T'HH:mm:ss.S'Z'")) IMPRESSION_TIMESTAMP,
                    a.dlx_chpcr,
                    a.dlx_chpth
-        FROM       core_digital.unified_impression a
+        FROM       IMPRESSIONS_{TS} a
         INNER JOIN core_digital.best_matched_cookies_history b
         ON         a.NA_GUID_ID = b.GUID
         INNER JOIN core_shared.individual_consolidated c
-        ON         b.INDIVIDUAL_ID = c.INDIVIDUAL_ID
-        WHERE      a.PIXEL_ID IN ({PIXEL_ID})
-        AND        a.DATA_DATE >= '{START_DATE}'
-        AND        a.DATA_DATE <= '{END_DATE}'
-        AND        a.data_source_id_part = {DATA_SOURCE_ID_PART}
-        AND        a.source='save';
+        ON         b.INDIVIDUAL_ID = c.INDIVIDUAL_ID;
 
         DROP TABLE IF EXISTS STEP2_TABLE_{TS};
         CREATE EXTERNAL TABLE STEP2_TABLE_{TS}
@@ -676,188 +903,30 @@ def get_individual_queries(audience_file, timestamp, data_source_id_part,
             FROM   STEP2_TABLE_{TS};
 
 
-        DROP TABLE IF EXISTS QC_STEP1_{TS};
-        CREATE TABLE QC_STEP1_{TS}
-            (JOIN_VAR              string,
-             ROWS_IN_EXPOSURE_FILE int,
-             CUSTOMER_IDS_IN_FILE  int);
-
-        INSERT INTO TABLE QC_STEP1_{TS}
-            SELECT 'A' JOIN_VAR,
-                   COUNT(*) ROWS_IN_EXPOSURE_FILE,
-                   COUNT(DISTINCT CUST_ID) CUSTOMER_IDS_IN_FILE
-            FROM   EXPOSURE_FILE_{TS};
-
-
-        DROP TABLE IF EXISTS QC_STEP2_{TS};
-        CREATE TABLE QC_STEP2_{TS}
-           (JOIN_VAR                    string,
-            IMPRESSIONS_IN_FILE         int,
-            EXPOSED_UNIQUE_CUSTOMER_IDS int,
-            EXPOSURE_START_DATE         string,
-            EXPOSURE_END_DATE           string);
-
-        INSERT INTO TABLE QC_STEP2_{TS}
-            SELECT 'A' JOIN_VAR,
-                   COUNT(*) IMPRESSIONS_IN_FILE,
-                   COUNT(DISTINCT CUST_ID) EXPOSED_UNIQUE_CUSTOMER_IDS,
-                   MIN(IMPRESSION_TIMESTAMP) EXPOSURE_START_DATE,
-                   MAX(IMPRESSION_TIMESTAMP) EXPOSURE_END_DATE
-            FROM   EXPOSURE_FILE_{TS}
-            WHERE  IMPRESSION_TIMESTAMP IS NOT NULL
-            AND    IMPRESSION_TIMESTAMP NOT LIKE '\n'
-            AND    IMPRESSION_TIMESTAMP NOT LIKE '';
-
-
-        DROP TABLE IF EXISTS QC_STEP3_{TS};
-        CREATE TABLE QC_STEP3_{TS}
-            (JOIN_VAR              string,
-             INSEGMENT_IMPRESSIONS int);
-
-        INSERT INTO TABLE QC_STEP3_{TS}
-            SELECT 'A' JOIN_VAR,
-                   COUNT(*) INSEGMENT_IMPRESSIONS
-            FROM   STEP1_TABLE_{TS};
-
-
-        DROP TABLE IF EXISTS QC_STEP4_{TS};
-        CREATE TABLE QC_STEP4_{TS}
-          (JOIN_VAR string,
-           TOTAL_IMPRESSIONS_MATCHED int);
-
-        INSERT INTO TABLE QC_STEP4_{TS}
-            SELECT 'A' JOIN_VAR,
-                   COUNT(*) TOTAL_IMPRESSIONS_MATCHED
-            FROM   STEP1_TABLE_{TS}
-            WHERE  GROUP_ID != '0'
-            AND    GROUP_ID != '-1'
-            AND    GROUP_ID IS NOT NULL;
-
-
-        DROP TABLE IF EXISTS QC_STEP5_{TS};
-        CREATE TABLE QC_STEP5_{TS}
-          (JOIN_VAR                 string,
-           TOTAL_IMPRESSIONS_SERVED int);
-
-        INSERT INTO TABLE QC_STEP5_{TS}
-        SELECT 'A' JOIN_VAR,
-               IMPS_COUNT
-        FROM   IMPSCOUNT_TABLE_{TS};
-
-
-        DROP TABLE IF EXISTS QC_STEP6_{TS};
-        CREATE TABLE QC_STEP6_{TS} (JOIN_VAR string, EXPOSED_UNIQUE_HH bigint);
-        INSERT INTO TABLE QC_STEP6_{TS} SELECT 'A', COUNT(DISTINCT(GROUP_ID)) FROM STEP1_TABLE_{TS} WHERE GROUP_ID != "0";
-
-
-        DROP TABLE IF EXISTS QC_STEP7_{TS};
-        CREATE TABLE QC_STEP7_{TS}
-          (JOIN_VAR        string,
-           CREATIVE_COUNT  bigint);
-
-        INSERT INTO TABLE QC_STEP7_{TS}
-            SELECT 'A',
-                   COUNT(CREATIVE_ID)
-            FROM   EXPOSURE_FILE_{TS}
-            WHERE  CREATIVE_ID IS NOT NULL
-            AND    CREATIVE_ID <> ''
-            AND    LENGTH(CREATIVE_ID) > 0;
-
-
-        DROP TABLE IF EXISTS QC_STEP8_{TS};
-        CREATE TABLE QC_STEP8_{TS}
-          (JOIN_VAR        string,
-           PLACEMENT_COUNT  bigint);
-
-        INSERT INTO TABLE QC_STEP8_{TS}
-            SELECT 'A',
-                   COUNT(PLACEMENT_ID)
-            FROM   EXPOSURE_FILE_{TS}
-            WHERE  PLACEMENT_ID IS NOT NULL
-            AND    PLACEMENT_ID <> ''
-            AND    LENGTH(PLACEMENT_ID) > 0;
-
-        CREATE TABLE QC_STEP9_{TS} (JOIN_VAR string, EXPOSED_UNIQUE_HH_IN_FILE bigint);
-        INSERT INTO TABLE QC_STEP9_{TS} SELECT 'A', COUNT(DISTINCT(MAP_IND)) FROM STEP2_TABLE_{TS} WHERE IMPRESSION_TIMESTAMP IS NOT NULL AND MAP_IND != "0";
-
-
-        CREATE EXTERNAL TABLE SUMMARY_STATS_{TS}
-            (REPORT_NUMBER                 string,
-             CAMPAIGN_NAME                 string,
-             RUN_DATE                      string,
-             ROWS_IN_EXPOSURE_FILE         bigint,
-             TOTAL_IMPRESSIONS_SERVED      bigint,
-             INSEGMENT_IMPRESSIONS         bigint,
-             IMPRESSIONS_MATCHED_TO_DLX_HH bigint,
-             EXPOSED_UNIQUE_HH             bigint,
-             IMPRESSIONS_IN_FILE           bigint,
-             CUSTOMER_IDS_IN_FILE          bigint,
-             EXPOSED_UNIQUE_CUSTID         bigint,
-             EXPOSED_UNIQUE_HH_IN_FILE     bigint,
-             CREATIVE_COUNT                bigint,
-             PLACEMENT_COUNT               bigint,
-             EXPOSURE_START_DATE           string,
-             EXPOSURE_END_DATE             string)
-        ROW FORMAT DELIMITED FIELDS TERMINATED BY ','
-        NULL DEFINED AS ''
-        LOCATION '{S3_PATH}/SUMMARY/';
-
-        INSERT OVERWRITE TABLE SUMMARY_STATS_{TS}
-            SELECT '{REPORT_NUMBER}' REPORT_NUMBER,
-                   '{CAMPAIGN_NAME}' CAMPAIGN_NAME, 
-                   '{TODAY_STAMP}' RUN_DATE,
-                   a.ROWS_IN_EXPOSURE_FILE,
-                   e.TOTAL_IMPRESSIONS_SERVED,
-                   c.INSEGMENT_IMPRESSIONS,
-                   d.TOTAL_IMPRESSIONS_MATCHED,
-                   f.EXPOSED_UNIQUE_HH,
-                   b.IMPRESSIONS_IN_FILE,
-                   a.CUSTOMER_IDS_IN_FILE,
-                   b.EXPOSED_UNIQUE_CUSTOMER_IDS,
-                   i.EXPOSED_UNIQUE_HH_IN_FILE,
-                   g.CREATIVE_COUNT,
-                   h.PLACEMENT_COUNT,
-                   b.EXPOSURE_START_DATE,
-                   b.EXPOSURE_END_DATE
-            FROM QC_STEP1_{TS} a
-            INNER JOIN QC_STEP2_{TS} b
-            ON LOWER(a.JOIN_VAR) = LOWER(b.JOIN_VAR)
-            INNER JOIN QC_STEP3_{TS} c
-            ON LOWER(a.JOIN_VAR) = LOWER(c.JOIN_VAR)
-            INNER JOIN QC_STEP4_{TS} d
-            ON LOWER(a.JOIN_VAR) = LOWER(d.JOIN_VAR)
-            INNER JOIN QC_STEP5_{TS} e
-            ON LOWER(a.JOIN_VAR) = LOWER(e.JOIN_VAR)
-            INNER JOIN QC_STEP6_{TS} f
-            ON LOWER(a.JOIN_VAR) = LOWER(f.JOIN_VAR)
-            INNER JOIN QC_STEP7_{TS} g
-            ON LOWER(a.JOIN_VAR) = LOWER(g.JOIN_VAR)
-            INNER JOIN QC_STEP8_{TS} h
-            ON LOWER(a.JOIN_VAR) = LOWER(h.JOIN_VAR)
-            INNER JOIN QC_STEP9_{TS} i
-            ON LOWER(a.JOIN_VAR) = LOWER(i.JOIN_VAR);
+{SUMMARY_QUERIES}
 
         set hive.optimize.insert.dest.volume=true;
         set hive.map.aggr=false;
         set mapred.reduce.tasks=200;
+        {EXPOSURE_SETTINGS}
         INSERT OVERWRITE DIRECTORY "{S3_PATH}/EXPOSURE/"
         ROW FORMAT DELIMITED fields terminated by '|'
         NULL DEFINED AS ''
             SELECT * 
             FROM EXPOSURE_FILE_{TS} 
-            {WHERE_CLAUSE};
+            {WHERE_CLAUSE}
+            {ORDER_CLAUSE};
+        {EXPOSURE_RESET}
 
         DROP TABLE IF EXISTS MAPPING_TABLE_TEMP_{TS};
         DROP TABLE IF EXISTS MAPPING_TABLE_{TS};
+        DROP TABLE IF EXISTS IMPRESSIONS_{TS};
         DROP TABLE IF EXISTS IMPSCOUNT_TABLE_{TS};
         DROP TABLE IF EXISTS STEP1_TABLE_{TS};
-        DROP TABLE IF EXISTS QC_STEP1_{TS};
-        DROP TABLE IF EXISTS QC_STEP2_{TS};
-        DROP TABLE IF EXISTS QC_STEP3_{TS};
-        DROP TABLE IF EXISTS QC_STEP4_{TS};
-        DROP TABLE IF EXISTS QC_STEP5_{TS};
         """.format(AUDIENCE_FILE=audience_file,
                    TS=timestamp,
+                   IMPRESSION_TABLE=impression_table,
+                   SUMMARY_QUERIES=get_summary_queries("Individual", timestamp, campaign_name, run_date, report_num, s3_path),
                    DATA_SOURCE_ID_PART=data_source_id_part,
                    CAMPAIGN_NAME=campaign_name,
                    START_DATE=start_date,
@@ -867,5 +936,8 @@ def get_individual_queries(audience_file, timestamp, data_source_id_part,
                    S3_PATH=s3_path,
                    TODAY_STAMP=run_date,
                    WHERE_CLAUSE=where_clause,
+                   ORDER_CLAUSE=order_clause,
+                   EXPOSURE_SETTINGS=exposure_settings,
+                   EXPOSURE_RESET=exposure_reset,
                    REPORT_NUMBER=report_num)
     return queries
\ No newline at end of file
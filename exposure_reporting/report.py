@@ -21,6 +21,12 @@ class Report(object):
         self.report_number = report_number
         self.bucket = bucket
         self.output_prefix = output_prefix
+        self.job_instance_id = None
+        self.status = None
+        self.timestamp = None
+        self.run_date = None
+        self.impression_table = None
+        self.local_aggregates = False
 
 
     def validate(self):
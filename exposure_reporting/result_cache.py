@@ -0,0 +1,144 @@
+"""This module caches the S3 outputs of report queries so re-running a ticket with the same inputs
+does not run the same Hive queries again.
+
+Each report's query is normalized (volatile table suffixes and the run date are removed, whitespace
+is collapsed) and hashed together with the composite ETag of its audience file. After the report's
+Datanado job succeeds, a JSON manifest is written under the cache prefix, keyed by that hash, with
+a composite ETag for each output prefix. A later run with the same hash reuses the outputs if the
+manifest is younger than the TTL and the outputs are unchanged; otherwise the manifest is evicted
+and the query runs again.
+
+Exported Classes
+ResultCache
+
+Exported Functions
+normalize
+get_key
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+
+CACHE_TTL_DAYS = 30
+OUTPUTS = ['EXPOSURE', 'SUMMARY', 'WEEKLY', 'DUPLICATES']
+
+
+def normalize(query, volatile):
+    """ Normalizes a query for hashing
+    Args:
+        query (str): Rendered query
+        volatile (list(str)): Values that differ between otherwise identical runs, e.g. the table
+                              suffix, run date and shared impression table name
+    Returns:
+        Normalized query string
+    """
+    for value in volatile:
+        if value:
+            query = query.replace(str(value), '')
+    return ' '.join(query.split())
+
+
+def get_key(query, volatile, inputs=None):
+    """ Returns the cache key (sha256 hex digest) of a normalized query
+    Args:
+        query (str): Rendered query
+        volatile (list(str)): See normalize
+        inputs (list(str)): Values the results also depend on, e.g. the ETags of input files (optional)
+    """
+    key = normalize(query, volatile)
+    for value in inputs or []:
+        key += '\0' + str(value)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    A class used to look up and record cached report outputs
+
+    Parameters
+    ----------
+    aws: AWS
+        AWS connection for the bucket holding both the outputs and the manifests
+    prefix: str
+        S3 prefix for manifests
+    ttl_days: int
+        Age after which a manifest is no longer used and is evicted
+    """
+
+    def __init__(self, aws, prefix, ttl_days=CACHE_TTL_DAYS):
+        self.aws = aws
+        self.prefix = prefix.rstrip('/')
+        self.ttl = datetime.timedelta(days=ttl_days)
+
+    def get_manifest_key(self, key):
+        """Returns the S3 key of a manifest"""
+        return '{}/{}.json'.format(self.prefix, key)
+
+    def lookup(self, key):
+        """ Checks for reusable outputs, evicting the manifest if they are stale or have changed
+        Args:
+            key (str): Cache key from get_key
+        Returns:
+            Manifest dict if the outputs can be reused, else None
+        """
+        try:
+            body = self.aws.read_object(self.get_manifest_key(key))
+        except Exception as e:
+            logging.log(30, "Unable to read result cache manifest {}\n{}".format(key, e))
+            return None
+        if body is None:
+            return None
+
+        manifest = json.loads(body.decode('utf-8'))
+        created = datetime.datetime.strptime(manifest['created'], "%Y-%m-%dT%H:%M:%S")
+        if datetime.datetime.utcnow() - created > self.ttl:
+            logging.log(20, "Result cache entry {} expired".format(key))
+            self.evict(key)
+            return None
+        for name, output in manifest['outputs'].items():
+            if self.aws.get_etag(output['prefix']) != output['etag']:
+                logging.log(20, "Result cache entry {} invalid: {} changed".format(key, output['prefix']))
+                self.evict(key)
+                return None
+        return manifest
+
+    def record(self, key, output_prefixes, **info):
+        """ Records a report's outputs after its queries succeeded
+        Args:
+            key (str): Cache key from get_key
+            output_prefixes (dict): Output name to S3 prefix
+            info: Extra fields to store in the manifest (e.g. ticket, report number)
+        """
+        manifest = dict(info)
+        manifest['key'] = key
+        manifest['created'] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        manifest['outputs'] = {name: {'prefix': prefix, 'etag': self.aws.get_etag(prefix)}
+                               for name, prefix in output_prefixes.items()}
+        try:
+            self.aws.write_object(self.get_manifest_key(key), json.dumps(manifest, indent=2))
+        except Exception as e:
+            logging.log(30, "Unable to write result cache manifest {}\n{}".format(key, e))
+
+    def evict(self, key):
+        """Deletes a manifest"""
+        try:
+            self.aws.delete_object(self.get_manifest_key(key))
+        except Exception as e:
+            logging.log(30, "Unable to evict result cache manifest {}\n{}".format(key, e))
+
+    def evict_expired(self):
+        """ Deletes manifests older than the TTL
+        Returns:
+            Number of manifests evicted
+        """
+        evicted = 0
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for obj in self.aws.get_keys(self.prefix + '/'):
+            if obj.key.endswith('.json') and now - obj.last_modified > self.ttl:
+                self.evict(obj.key[len(self.prefix) + 1:-len('.json')])
+                evicted += 1
+        if evicted:
+            logging.log(20, "Evicted {} expired result cache entries".format(evicted))
+        return evicted
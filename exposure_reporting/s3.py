@@ -5,9 +5,9 @@ Exported Classes
 S3Tools
 """
 
-import boto3
 import os
 import logging
+import connections
 
 
 class S3Tools:
@@ -35,7 +35,7 @@ class S3Tools:
     _create_folder(path)
         Creates a specified folder if it doesn't exist
     _create_s3_session()
-        Returns AWS S3 Session object
+        Returns the shared AWS S3 Session object
     _upload_file(s3_bucket, s3_prefix, local_directory, file_name
         Uploads local file to S3 location
     _delete_file(s3_bucket, s3_prefix, file_name)
@@ -49,7 +49,7 @@ class S3Tools:
         self.s3_access_key = os.environ['S3_ACCESS_KEY']
         self.s3_secret_key = os.environ['S3_SECRET']
         self.s3_session = self._create_s3_session()
-        self.s3_client = self.s3_session.resource('s3')
+        self.s3_client = connections.get_resource(self.s3_access_key, self.s3_secret_key)
         self.local_prefix = self.config.get_field('project', 'data_directory')
 
     def upload_sql_file(self, file_name, file_string):
@@ -76,13 +76,10 @@ class S3Tools:
             os.makedirs(path)
 
     def _create_s3_session(self):
-        """Returns AWS S3 Session object"""
-        s3_session = boto3.Session(
-            aws_access_key_id=self.s3_access_key,
-            aws_secret_access_key=self.s3_secret_key,
-        )
+        """Returns the shared AWS S3 Session object"""
+        s3_session = connections.get_session(self.s3_access_key, self.s3_secret_key)
 
-        logging.log(20, 's3_session object ({0}) created'.format(s3_session))
+        logging.log(20, 's3_session object ({0}) in use'.format(s3_session))
 
         return s3_session
 
@@ -0,0 +1,137 @@
+"""This module recounts the Exposure File metrics of the SUMMARY file locally, so the Hive numbers
+can be checked before they are posted to JIRA and emailed.
+
+The metrics are collected from the chunks chunk_tap hands out while the sorted Exposure File
+streams through a pass we already make (the sort or the gzip), on a background thread and with
+vectorized pandas operations, so the pass is not slowed down. Every chunk holds complete CUST_ID
+groups, so the distinct CUST_ID counts are exact sums of per-chunk counts.
+
+Exported Classes
+ExposureStats
+
+Exported Functions
+reconcile
+"""
+
+from collections import OrderedDict
+
+import chunk_tap
+
+ROWS = "Rows in Exposure File"
+IMPRESSIONS = "Impressions in File"
+CUSTOMERS = "Customer IDs in File"
+EXPOSED_CUSTOMERS = "Exposed Unique Customer IDs in File"
+CREATIVES = "Creative Count"
+PLACEMENTS = "Placement Count"
+START_DATE = "Exposure Start Date"
+END_DATE = "Exposure End Date"
+
+# Metrics that can be compared for each output type. The Hive summary is computed before the
+# output type filter, so Exposed files only match on the exposed metrics, and Unexposed files
+# only on their row count (rows less impressions, see reconcile).
+COMPARED_METRICS = {
+    "All": [ROWS, IMPRESSIONS, CUSTOMERS, EXPOSED_CUSTOMERS, CREATIVES, PLACEMENTS, START_DATE, END_DATE],
+    "Exposed": [IMPRESSIONS, EXPOSED_CUSTOMERS, CREATIVES, PLACEMENTS, START_DATE, END_DATE],
+    "Unexposed": [ROWS]
+}
+
+
+class ExposureStats(object):
+    """
+    A class used to recount the SUMMARY metrics of a sorted Exposure File from its chunks
+    (see chunk_tap; CUST_ID, IMPRESSION_TIMESTAMP, CREATIVE_ID and PLACEMENT_ID, NULL read as '')
+
+    Parameters
+    ----------
+    report_type: str
+        Household or Individual; Household impressions are only counted with a CUST_ID, as in Hive
+
+    Methods
+    -------
+    update(df)
+        Adds a chunk of complete CUST_ID groups
+    update_file(file)
+        Adds a whole sorted file, gzipped if its name ends in .gz
+    get_metrics()
+        Returns an OrderedDict of SUMMARY header to recounted value
+    """
+
+    def __init__(self, report_type=None):
+        # Hive counts CUST_ID for Household impressions, which skips rows without one
+        self.impressions_need_cust_id = report_type == 'Household'
+        self.rows = 0
+        self.impressions = 0
+        self.customers = 0
+        self.exposed_customers = 0
+        self.creatives = 0
+        self.placements = 0
+        self.start_date = None
+        self.end_date = None
+
+    def update(self, df):
+        """Adds a chunk of complete CUST_ID groups"""
+        has_cust_id = df['CUST_ID'] != ''
+        exposed = df['IMPRESSION_TIMESTAMP'] != ''
+        self.rows += len(df)
+        self.impressions += int((exposed & has_cust_id).sum() if self.impressions_need_cust_id else exposed.sum())
+        self.customers += df.loc[has_cust_id, 'CUST_ID'].nunique()
+        self.exposed_customers += df.loc[has_cust_id & exposed, 'CUST_ID'].nunique()
+        self.creatives += int((df['CREATIVE_ID'] != '').sum())
+        self.placements += int((df['PLACEMENT_ID'] != '').sum())
+        if exposed.any():
+            timestamps = df.loc[exposed, 'IMPRESSION_TIMESTAMP']
+            start_date, end_date = timestamps.min(), timestamps.max()
+            if self.start_date is None or start_date < self.start_date:
+                self.start_date = start_date
+            if self.end_date is None or end_date > self.end_date:
+                self.end_date = end_date
+
+    def update_file(self, file, delimiter='|'):
+        """Adds a whole sorted file, gzipped if its name ends in .gz"""
+        chunk_tap.read_file(file, [self], delimiter)
+
+    def get_metrics(self):
+        """Returns an OrderedDict of SUMMARY header to recounted value"""
+        return OrderedDict([(ROWS, self.rows),
+                            (IMPRESSIONS, self.impressions),
+                            (CUSTOMERS, self.customers),
+                            (EXPOSED_CUSTOMERS, self.exposed_customers),
+                            (CREATIVES, self.creatives),
+                            (PLACEMENTS, self.placements),
+                            (START_DATE, self.start_date or ''),
+                            (END_DATE, self.end_date or '')])
+
+
+def reconcile(stats, summary, output_type="All"):
+    """ Compares the recounted metrics of an Exposure File with its row of the Hive SUMMARY file
+    Args:
+        stats: ExposureStats object
+        summary (OrderedDict): SUMMARY header to value, as read by zfs.get_fields
+        output_type (str): All, Exposed or Unexposed; decides which metrics can be compared
+    Returns:
+        List of mismatch descriptions, empty if everything matches
+    """
+    metrics = stats.get_metrics()
+    expected = OrderedDict((name, summary.get(name)) for name in COMPARED_METRICS.get(output_type, []))
+    if output_type == "Unexposed":
+        try:
+            expected[ROWS] = int(summary.get(ROWS)) - int(summary.get(IMPRESSIONS))
+        except (TypeError, ValueError):
+            pass
+
+    mismatches = []
+    for name, value in expected.items():
+        actual = metrics[name]
+        if value in (None, '\\N'):
+            value = ''
+        if isinstance(actual, int):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                mismatches.append("{}: Hive '{}' vs local {}".format(name, value, actual))
+                continue
+            if actual != value:
+                mismatches.append("{}: Hive {} vs local {}".format(name, value, actual))
+        elif actual != value:
+            mismatches.append("{}: Hive '{}' vs local '{}'".format(name, value, actual))
+    return mismatches
@@ -0,0 +1,125 @@
+"""Checks aggregates.ExposureAggregates against the semantics of queries.get_weekly_queries and
+queries.get_duplicate_queries on small sorted Exposure Files.
+
+Run from the repository root with: python -m pytest exposure_reporting/tests
+"""
+
+import gzip
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregates  # noqa: E402
+import queries  # noqa: E402
+
+
+def write_exposure(path, rows):
+    """Writes (CUST_ID, IMPRESSION_TIMESTAMP, CREATIVE_ID) rows as a sorted, gzipped Exposure File"""
+    lines = ['{}|{}|a1|a2|a3|a4|{}|pl1\n'.format(cust_id, timestamp, creative_id)
+             for cust_id, timestamp, creative_id in sorted(rows)]
+    file = os.path.join(str(path), 'exposure.txt.gz')
+    with gzip.open(file, 'wt') as f:
+        f.writelines(lines)
+    return file
+
+
+def aggregate(path, rows, start_date, end_date, granularity='week', buckets='2,3,4,5,10+'):
+    start_dates, end_dates = queries.create_splits(start_date, end_date, granularity)
+    return aggregates.ExposureAggregates(start_dates, end_dates, granularity, buckets).aggregate_file(
+        write_exposure(path, rows), chunk_rows=2)
+
+
+def test_empty_bucket(tmp_path):
+    rows = [('C1', '2024-01-01 10:00:00', 'cr1'),
+            ('C1', '2024-01-02 10:00:00', 'cr1'),
+            ('C2', '2024-01-03 10:00:00', 'cr1'),
+            ('C2', '2024-01-15 10:00:00', 'cr1')]
+    result = aggregate(tmp_path, rows, '20240101', '20240121')
+    # The calendar keeps every bucket: COUNT 0 and a NULL average where no impression landed
+    assert result.get_weekly_rows() == [['1', '01/01/2024', '3', '1.5'],
+                                        ['2', '01/08/2024', '0', ''],
+                                        ['3', '01/15/2024', '1', '1.0']]
+
+
+def test_out_of_range_impressions(tmp_path):
+    rows = [('C1', '2023-12-31 23:59:59', 'cr1'),
+            ('C1', '2024-01-07 23:59:59', 'cr1'),
+            ('C2', '2024-01-08 00:00:00', 'cr1')]
+    result = aggregate(tmp_path, rows, '20240101', '20240107')
+    assert result.get_weekly_rows() == [['1', '01/01/2024', '1', '1.0']]
+
+
+def test_month_buckets(tmp_path):
+    rows = [('C1', '2024-01-20 10:00:00', 'cr1'),
+            ('C1', '2024-02-01 00:00:00', 'cr1'),
+            ('C2', '2024-02-29 23:00:00', 'cr1'),
+            ('C3', '2024-03-10 10:00:00', 'cr1')]
+    result = aggregate(tmp_path, rows, '20240115', '20240310', 'month')
+    # Months after the first start on the 1st and are numbered by calendar month
+    assert result.get_weekly_rows() == [['1', '01/15/2024', '1', '1.0'],
+                                        ['2', '02/01/2024', '2', '1.0'],
+                                        ['3', '03/01/2024', '1', '1.0']]
+
+
+def test_day_buckets(tmp_path):
+    rows = [('C1', '2024-01-01 00:00:00', 'cr1'),
+            ('C1', '2024-01-03 23:59:59', 'cr1'),
+            ('C2', '2024-01-03 12:00:00', 'cr1')]
+    result = aggregate(tmp_path, rows, '20240101', '20240103', 'day')
+    assert result.get_weekly_rows() == [['1', '01/01/2024', '1', '1.0'],
+                                        ['2', '01/02/2024', '0', ''],
+                                        ['3', '01/03/2024', '2', '1.0']]
+
+
+def test_duplicate_buckets(tmp_path):
+    rows = [('C1', '2024-01-01 10:00:00', 'cr1')] * 2 + \
+           [('C2', '2024-01-01 10:00:00', 'cr1')] * 3 + \
+           [('C3', '2024-01-01 10:00:00', 'cr1')] * 5 + \
+           [('C3', '2024-01-02 10:00:00', 'cr1')] * 2 + \
+           [('C4', '2024-01-01 10:00:00', 'cr1')]
+    result = aggregate(tmp_path, rows, '20240101', '20240107', buckets='2,3+')
+    # Each bucket counts distinct CUST_IDs with a key in it, so C3 counts in both
+    assert result.get_duplicate_row(1, 'Campaign') == ['1', 'Campaign', '2', '2', '100.0']
+
+
+def test_empty_keys_are_null(tmp_path):
+    rows = [('', '2024-01-01 10:00:00', 'cr1')] * 3 + \
+           [('C1', '', 'cr1')] * 3 + \
+           [('C2', '2024-01-01 10:00:00', '')] * 3 + \
+           [('C3', '2024-01-01 10:00:00', 'cr1')] * 2
+    result = aggregate(tmp_path, rows, '20240101', '20240107', buckets='2,3+')
+    # Empty strings are read as NULL: no CUST_ID, timestamp or creative, no key
+    assert result.exposed_customers == 2
+    assert result.get_weekly_rows() == [['1', '01/01/2024', '5', '2.5']]
+    assert result.get_duplicate_row(1, 'Campaign') == ['1', 'Campaign', '1', '0', '50.0']
+
+
+def test_no_exposed_customers(tmp_path):
+    rows = [('C1', '', 'cr1')] * 2
+    result = aggregate(tmp_path, rows, '20240101', '20240107', buckets='2,3+')
+    # The percentage divides by zero exposed customers, which Hive writes as NULL
+    assert result.get_duplicate_row(1, 'Campaign') == ['1', 'Campaign', '0', '0', '']
+    assert result.get_weekly_rows() == [['1', '01/01/2024', '0', '']]
+
+
+@pytest.mark.parametrize('text, expected', [
+    (repr(1.0), '1.0'),
+    (repr(1.5), '1.5'),
+    (repr(0.001), '0.001'),
+    (repr(0.0001234), '1.234E-4'),
+    (repr(9999999.0), '9999999.0'),
+    (repr(10000000.0), '1.0E7'),
+    (repr(12345678.0), '1.2345678E7'),
+    (repr(7 / 3.0), '2.3333333333333335'),
+    (repr(0.0), '0.0'),
+    (str(np.float32(100 / 3.0)), '33.333332'),
+    (str(np.float32(50.0)), '50.0'),
+    (str(np.float32(2 / 3.0 * 100)), '66.666664'),
+    (str(np.float32(1e-5)), '1.0E-5'),
+])
+def test_format_java(text, expected):
+    assert aggregates.format_java(text) == expected
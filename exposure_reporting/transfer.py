@@ -0,0 +1,326 @@
+"""This module provides a parallel ranged-GET transfer engine for S3. Objects under a prefix are
+split into byte ranges which are fetched concurrently and handed back strictly in key order, so a
+whole prefix can be streamed to disk while only a bounded window of chunks is held in memory.
+
+Uploads run the other way: a file is read into a fixed pool of reusable part buffers, and the parts
+are sent concurrently as a multipart upload whose part size grows with the file size.
+
+Objects can also be concatenated into a new object without downloading them, as a multipart upload
+whose parts are server-side copies (UploadPartCopy) of the source objects.
+
+Exported Functions
+iter_ranges
+fetch_range
+stream_objects
+download_objects
+get_part_size
+upload_file
+plan_assembly
+assemble_objects
+"""
+
+import logging
+import math
+import os
+import queue
+import time
+from collections import deque
+
+from log_context import ContextThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CHUNK_SIZE = 8388608
+MIN_PART_SIZE = 10485760
+MAX_PARTS = 10000
+PART_RETRIES = 3
+MIN_COPY_PART_SIZE = 5242880
+MAX_COPY_PART_SIZE = 5368709120
+
+
+def iter_ranges(objects, chunk_size):
+    """ Splits S3 objects into inclusive byte ranges, preserving key order
+    Args:
+        objects: Iterable of S3 ObjectSummary objects (key and size are used)
+        chunk_size (int): Maximum number of bytes per ranged GET
+    Returns:
+        Generator of (key, start, end) tuples
+    """
+    for obj in objects:
+        for start in range(0, obj.size, chunk_size):
+            yield obj.key, start, min(start + chunk_size, obj.size) - 1
+
+
+def fetch_range(client, bucket, key, start, end):
+    """ Fetches one inclusive byte range of an S3 object
+    Args:
+        client: boto3 S3 client
+        bucket (str): S3 bucket
+        key (str): S3 key
+        start (int): First byte offset
+        end (int): Last byte offset
+    Returns:
+        bytes
+    """
+    response = client.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(start, end))
+    data = response["Body"].read()
+    if len(data) != end - start + 1:
+        raise IOError("Short read on s3://{}/{} bytes {}-{}: got {} bytes".format(bucket, key, start, end, len(data)))
+    return data
+
+
+def stream_objects(client, bucket, objects, concurrency=DEFAULT_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Streams the contents of S3 objects in key order using concurrent ranged GETs
+    Args:
+        client: boto3 S3 client (clients are thread-safe and shared by all workers)
+        bucket (str): S3 bucket
+        objects: Iterable of S3 ObjectSummary objects, in the order they should be emitted
+        concurrency (int): Number of ranged GETs in flight
+        chunk_size (int): Maximum number of bytes per ranged GET
+    Returns:
+        Generator of bytes chunks. At most 2 * concurrency chunks are buffered at any time.
+    """
+    ranges = iter_ranges(objects, chunk_size)
+    window = deque()
+    with ContextThreadPoolExecutor(max_workers=concurrency) as pool:
+        def submit_next():
+            rng = next(ranges, None)
+            if rng is None:
+                return False
+            window.append(pool.submit(fetch_range, client, bucket, *rng))
+            return True
+
+        try:
+            for _ in range(2 * concurrency):
+                if not submit_next():
+                    break
+            while window:
+                data = window.popleft().result()
+                submit_next()
+                yield data
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def download_objects(client, bucket, objects, dst, concurrency=DEFAULT_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Downloads S3 objects into one local file, concatenated in key order
+    Args:
+        client: boto3 S3 client
+        bucket (str): S3 bucket
+        objects: Iterable of S3 ObjectSummary objects
+        dst (str): Local file to write
+        concurrency (int): Number of ranged GETs in flight
+        chunk_size (int): Maximum number of bytes per ranged GET
+    Returns:
+        Number of bytes written
+    """
+    start_time = time.time()
+    written = 0
+    with open(dst, 'wb') as outfile:
+        for data in stream_objects(client, bucket, objects, concurrency, chunk_size):
+            outfile.write(data)
+            written += len(data)
+    elapsed = time.time() - start_time
+    logging.log(20, "Downloaded {} bytes to {} in {:.1f}s ({:.1f} MB/s)".format(
+        written, dst, elapsed, written / 1048576.0 / max(elapsed, 0.001)))
+    return written
+
+
+def get_part_size(file_size, min_part_size=MIN_PART_SIZE, max_parts=MAX_PARTS):
+    """ Gets a multipart part size that keeps the upload within S3's part-count limit
+    Args:
+        file_size (int): Size of the file to upload in bytes
+        min_part_size (int): Smallest part size to use
+        max_parts (int): Maximum number of parts
+    Returns:
+        Part size in bytes, a multiple of 1 MiB
+    """
+    part_size = max(min_part_size, int(math.ceil(file_size / float(max_parts))))
+    return int(math.ceil(part_size / 1048576.0)) * 1048576
+
+
+def _upload_part(client, bucket, key, upload_id, part_number, body, retries=PART_RETRIES):
+    """ Uploads one part, retrying it on failure without restarting the upload
+    Returns:
+        {"ETag", "PartNumber"} dict for complete_multipart_upload
+    """
+    attempt = 1
+    while True:
+        try:
+            part = client.upload_part(Body=body, Bucket=bucket, Key=key,
+                                      PartNumber=part_number, UploadId=upload_id)
+            return {"ETag": part["ETag"], "PartNumber": part_number}
+        except Exception as e:
+            if attempt > retries:
+                raise
+            logging.log(30, "Part {} of s3://{}/{} failed (attempt {}), retrying\n{}".format(part_number, bucket, key, attempt, e))
+            time.sleep(2 ** attempt)
+            attempt += 1
+
+
+def upload_file(client, bucket, src, key, concurrency=DEFAULT_CONCURRENCY, retries=PART_RETRIES):
+    """ Uploads a local file to S3 as a multipart upload with parts sent concurrently.
+        The file is read with readinto() into `concurrency` reusable buffers, so memory is bounded
+        by concurrency * part size and full parts are uploaded without copying. If any part
+        fails after its retries, the multipart upload is aborted.
+    Args:
+        client: boto3 S3 client
+        bucket (str): S3 bucket
+        src (str): Local file to upload
+        key (str): Destination S3 key
+        concurrency (int): Number of parts in flight
+        retries (int): Number of retries per part
+    Returns:
+        Number of parts uploaded
+    """
+    start_time = time.time()
+    file_size = os.path.getsize(src)
+    part_size = get_part_size(file_size)
+    part_count = max(1, int(math.ceil(file_size / float(part_size))))
+
+    free_buffers = queue.Queue()
+    for _ in range(min(concurrency, part_count)):
+        free_buffers.put(bytearray(part_size))
+
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def send(part_number, buffer, length):
+        try:
+            body = buffer if length == len(buffer) else bytes(memoryview(buffer)[:length])
+            return _upload_part(client, bucket, key, upload_id, part_number, body, retries)
+        finally:
+            free_buffers.put(buffer)
+
+    futures = []
+    try:
+        with ContextThreadPoolExecutor(max_workers=concurrency) as pool, open(src, 'rb') as fin:
+            for part_number in range(1, part_count + 1):
+                buffer = free_buffers.get()
+                length = fin.readinto(buffer)
+                futures.append(pool.submit(send, part_number, buffer, length))
+                if any(future.done() and future.exception() for future in futures[-concurrency:]):
+                    break
+            parts = [future.result() for future in futures]
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except Exception:
+        for future in futures:
+            future.cancel()
+        logging.log(40, "Aborting multipart upload of {} to s3://{}/{}".format(src, bucket, key))
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.log(40, "Unable to abort multipart upload {}\n{}".format(upload_id, e))
+        raise
+
+    elapsed = time.time() - start_time
+    logging.log(20, "Uploaded {} bytes in {} parts of {} bytes to s3://{}/{} in {:.1f}s".format(
+        file_size, len(parts), part_size, bucket, key, elapsed))
+    return len(parts)
+
+
+def plan_assembly(objects, min_part_size=MIN_COPY_PART_SIZE, max_part_size=MAX_COPY_PART_SIZE):
+    """ Plans the parts of a multipart upload concatenating S3 objects in order. Every part but the
+        last must be at least min_part_size, so a run of undersized objects is grouped into one
+        uploaded part, topped up with the head of the next object; everything else is copied
+        server-side in ranges of at most max_part_size.
+    Args:
+        objects: Iterable of S3 ObjectSummary objects, in the order they should be concatenated
+        min_part_size (int): Smallest part S3 accepts, except for the last part
+        max_part_size (int): Largest part S3 accepts
+    Returns:
+        List of parts, each ('copy', [(key, start, end)]) or ('upload', [(key, start, end), ...])
+        with inclusive byte ranges
+    """
+    parts, pending, pending_size = [], [], 0
+    for obj in objects:
+        start = 0
+        if pending and obj.size:
+            start = min(obj.size, min_part_size - pending_size)
+            pending.append((obj.key, 0, start - 1))
+            pending_size += start
+            if pending_size >= min_part_size:
+                parts.append(('upload', pending))
+                pending, pending_size = [], 0
+        remaining = obj.size - start
+        if remaining >= min_part_size:
+            step = int(math.ceil(remaining / math.ceil(remaining / float(max_part_size))))
+            for offset in range(start, obj.size, step):
+                parts.append(('copy', [(obj.key, offset, min(offset + step, obj.size) - 1)]))
+        elif remaining > 0:
+            pending.append((obj.key, start, obj.size - 1))
+            pending_size += remaining
+    if pending:
+        parts.append(('upload', pending))
+    return parts
+
+
+def _copy_part(client, bucket, key, upload_id, part_number, src_key, start, end, retries=PART_RETRIES):
+    """ Copies a byte range of an S3 object into one part, retrying it on failure
+    Returns:
+        {"ETag", "PartNumber"} dict for complete_multipart_upload
+    """
+    attempt = 1
+    while True:
+        try:
+            part = client.upload_part_copy(Bucket=bucket, Key=key, PartNumber=part_number, UploadId=upload_id,
+                                           CopySource={"Bucket": bucket, "Key": src_key},
+                                           CopySourceRange="bytes={}-{}".format(start, end))
+            return {"ETag": part["CopyPartResult"]["ETag"], "PartNumber": part_number}
+        except Exception as e:
+            if attempt > retries:
+                raise
+            logging.log(30, "Part {} of s3://{}/{} failed (attempt {}), retrying\n{}".format(part_number, bucket, key, attempt, e))
+            time.sleep(2 ** attempt)
+            attempt += 1
+
+
+def assemble_objects(client, bucket, objects, key, concurrency=DEFAULT_CONCURRENCY, retries=PART_RETRIES):
+    """ Concatenates S3 objects into one object, in order, as a multipart upload of server-side
+        copies (see plan_assembly). Only undersized objects are read, at most one minimum part
+        size per group. If any part fails after its retries, the multipart upload is aborted.
+    Args:
+        client: boto3 S3 client
+        bucket (str): S3 bucket of the source objects and the destination
+        objects: Iterable of S3 ObjectSummary objects, in the order they should be concatenated
+        key (str): Destination S3 key
+        concurrency (int): Number of parts in flight
+        retries (int): Number of retries per part
+    Returns:
+        Number of parts
+    """
+    start_time = time.time()
+    plan = plan_assembly(objects)
+    copied = sum(end - start + 1 for kind, ranges in plan if kind == 'copy' for _, start, end in ranges)
+    uploaded = sum(end - start + 1 for kind, ranges in plan if kind == 'upload' for _, start, end in ranges)
+
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def send(part_number, kind, ranges):
+        if kind == 'copy':
+            return _copy_part(client, bucket, key, upload_id, part_number, *ranges[0], retries=retries)
+        body = b''.join(fetch_range(client, bucket, *rng) for rng in ranges)
+        return _upload_part(client, bucket, key, upload_id, part_number, body, retries)
+
+    futures = []
+    try:
+        with ContextThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(send, part_number, kind, ranges)
+                       for part_number, (kind, ranges) in enumerate(plan, 1)]
+            parts = [future.result() for future in futures]
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except Exception:
+        for future in futures:
+            future.cancel()
+        logging.log(40, "Aborting multipart copy to s3://{}/{}".format(bucket, key))
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.log(40, "Unable to abort multipart upload {}\n{}".format(upload_id, e))
+        raise
+
+    elapsed = time.time() - start_time
+    logging.log(20, "Assembled s3://{}/{} from {} parts in {:.1f}s ({} bytes copied in S3, {} bytes relayed)".format(
+        bucket, key, len(parts), elapsed, copied, uploaded))
+    return len(parts)
@@ -2,13 +2,28 @@
 import os
 import shutil
 import gzip
-from collections import OrderedDict
+import heapq
+import logging
+import multiprocessing
+import resource
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from exception import FileError
+from log_context import ContextThreadPoolExecutor
+
+SORT_MEMORY_MB = 1024
+SORT_WORKERS = 2
+SORT_FAN_IN = 64
+FD_HEADROOM = 256
+READ_SIZE = 4194304
+GZIP_BLOCK_SIZE = 16777216
+GZIP_LEVEL = 9
 
 
 def stage_path(path):
     """ Creates path """
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
 
 def get_count(file):
@@ -45,13 +60,393 @@ def sort(file, delimiter, column, path):
         print( "File sort failed.\n{}".format(e))
 
 
-def zip(file):
-    """ Zips a file """
+def sort_key(delimiter):
+    """ Returns the composite sort key for a delimited line: (CUST_ID, IMPRESSION_TIMESTAMP, line).
+        The whole line is the final tie-breaker so the output order is fully deterministic.
+    Args:
+        delimiter (string): File delimiter
+    """
+    delim = delimiter.encode('utf-8')
+
+    def key(line):
+        fields = line.rstrip(b'\n').split(delim, 2)
+        return fields[0], fields[1] if len(fields) > 1 else b'', line
+    return key
+
+
+def iter_blocks(chunks, block_size):
+    """ Regroups a stream of byte chunks into line-aligned blocks
+    Args:
+        chunks: Iterable of bytes
+        block_size (int): Target block size in bytes
+    Returns:
+        Generator of bytes blocks, each ending on a line boundary
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= block_size:
+            cut = buffer.rfind(b'\n') + 1
+            if cut:
+                yield bytes(buffer[:cut])
+                del buffer[:cut]
+    if buffer:
+        yield bytes(buffer)
+
+
+def iter_file(file, read_size=READ_SIZE):
+    """Yields a file's contents in chunks of read_size bytes"""
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(read_size), b''):
+            yield chunk
+
+
+def _open_run(file, mode, compress):
+    """Opens a run file, gzip level 1 compressed when compress is set"""
+    if compress:
+        return gzip.open(file, mode, compresslevel=1)
+    return open(file, mode)
+
+
+def _sort_run(block, run_file, delimiter, compress=False):
+    """ Sorts one block of lines and writes it as a run file (runs in a worker process)
+    Returns:
+        Number of lines in the run
+    """
+    lines = block.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    lines.sort(key=sort_key(delimiter))
+    with _open_run(run_file, 'wb', compress) as f:
+        f.write(b'\n'.join(lines))
+        f.write(b'\n')
+    return len(lines)
+
+
+def _make_runs(chunks, delimiter, tmpdir, memory_mb, workers, compress=False):
+    """ Sorts a stream of chunks into run files, sorting up to `workers` blocks in parallel.
+        Each block is about memory_mb / (workers * 4) so the parsed lines and keys of all
+        in-flight blocks stay within the memory budget.
+    Returns:
+        List of run file paths
+    """
+    block_size = max(1048576, memory_mb * 1048576 // (workers * 4))
+    runs, pending = [], deque()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        for block in iter_blocks(chunks, block_size):
+            if len(pending) >= workers:
+                _finish_run(pending.popleft(), len(runs))
+            run_file = os.path.join(tmpdir, 'run_{:05d}'.format(len(runs) + len(pending)))
+            pending.append((run_file, pool.submit(_sort_run, block, run_file, delimiter, compress)))
+            runs.append(run_file)
+        while pending:
+            _finish_run(pending.popleft(), len(runs))
+    return runs
+
+
+def _finish_run(entry, total):
+    """Waits on a pending run and logs progress"""
+    run_file, future = entry
+    logging.log(20, "Sorted {} ({} lines, {} runs started)".format(os.path.basename(run_file), future.result(), total))
+
+
+def _merge(files, out, delimiter, compress=False, check=False):
+    """ K-way merges sorted files into an open binary file object
+    Args:
+        check (bool): Raise FileError if the output is not in (CUST_ID, IMPRESSION_TIMESTAMP) order,
+                      i.e. if an input was not sorted
+    Returns:
+        Number of lines written
+    """
+    handles = [_open_run(file, 'rb', compress) for file in files]
+    key = sort_key(delimiter)
+    count = 0
+    previous = None
+    try:
+        for line in heapq.merge(*handles, key=key):
+            if check:
+                current = key(line)[:2]
+                if previous is not None and current < previous:
+                    raise FileError("Input is not sorted at line {}".format(count + 1))
+                previous = current
+            out.write(line)
+            count += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    return count
+
+
+def _merge_runs(runs, out, delimiter, tmpdir, fan_in=SORT_FAN_IN, compress=False, check=False):
+    """ Merges run files into out, first collapsing them in passes of at most fan_in files
+        (check: see _merge)
+    Returns:
+        Number of lines written
+    """
+    level = 0
+    while len(runs) > fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            merged_file = os.path.join(tmpdir, 'merge_{}_{:05d}'.format(level, i // fan_in))
+            with _open_run(merged_file, 'wb', compress) as f:
+                _merge(runs[i:i + fan_in], f, delimiter, compress, check)
+            for run in runs[i:i + fan_in]:
+                os.remove(run)
+            merged.append(merged_file)
+        logging.log(20, "Merge pass {}: {} runs -> {} runs".format(level, len(runs), len(merged)))
+        runs = merged
+        level += 1
+    return _merge(runs, out, delimiter, compress, check)
+
+
+def get_fan_in_limit(runs, headroom=FD_HEADROOM):
+    """ Returns how many run files one merge pass can hold open, at most runs. The soft limit on open
+        files is first raised to a finite hard limit if it is lower, and headroom files are left for the
+        rest of the process (other tickets' transfers and merges).
+    Args:
+        runs (int): Number of run files to merge
+        headroom (int): Open files kept free
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as e:
+            logging.log(30, "Could not raise the open file limit from {}\n{}".format(soft, e))
+    if soft == resource.RLIM_INFINITY:
+        return runs
+    return max(2, min(runs, soft - headroom))
+
+
+def _split_parts(chunks, part_sizes, tmpdir, compress=False):
+    """ Writes a stream of concatenated part files back out as one run file per part, as the
+        chunks arrive. A chunk never spans two parts (see transfer.iter_ranges).
+    Args:
+        chunks: Iterable of bytes
+        part_sizes (list(int)): Size of each part in the stream, in order
+    Returns:
+        List of run file paths
+    """
+    runs = []
+    sizes = iter(part_sizes)
+    remaining = 0
+    f = None
+    try:
+        for data in chunks:
+            if remaining == 0:
+                run_file = os.path.join(tmpdir, 'part_{:05d}'.format(len(runs)))
+                f = _open_run(run_file, 'wb', compress)
+                runs.append(run_file)
+                remaining = next(sizes)
+            f.write(data)
+            remaining -= len(data)
+            if remaining == 0:
+                # Keep part boundaries on line boundaries
+                if not data.endswith(b'\n'):
+                    f.write(b'\n')
+                f.close()
+                f = None
+    finally:
+        if f is not None:
+            f.close()
+    return runs
+
+
+def sort_stream(chunks, out, delimiter, path, memory_mb=SORT_MEMORY_MB, workers=SORT_WORKERS, compress_runs=False,
+                part_sizes=None):
+    """ External sort of a stream of delimited lines on (CUST_ID, IMPRESSION_TIMESTAMP).
+        Blocks are sorted in parallel worker processes and spilled to run files in a
+        temporary directory under path, then k-way merged into out.
+        With part_sizes, the stream is a concatenation of parts that are each already sorted
+        (e.g. Hive SORT BY output): every part is spilled as a run as it arrives and the runs are
+        merged without sorting. FileError is raised if a part turns out not to be sorted.
+    Args:
+        chunks: Iterable of bytes (e.g. iter_file or an S3 stream)
+        out: Binary file object to write sorted lines to
+        delimiter (string): File delimiter
+        path (string): Directory for spill files
+        memory_mb (int): Memory budget for run generation
+        workers (int): Number of sorting processes
+        compress_runs (bool): Gzip spill files so they never hold a full uncompressed copy
+        part_sizes (list(int)): Sizes of the pre-sorted parts making up the stream (optional)
+    Returns:
+        Number of lines written
+    """
+    tmpdir = tempfile.mkdtemp(prefix='sort_', dir=path)
+    try:
+        if part_sizes is not None:
+            runs = _split_parts(chunks, part_sizes, tmpdir, compress_runs)
+            # Parts need no sort, so merge them all in one pass if the open file limit allows
+            fan_in = get_fan_in_limit(len(runs))
+            logging.log(20, "Merging {} pre-sorted parts, {} at a time".format(len(runs), fan_in))
+            return _merge_runs(runs, out, delimiter, tmpdir, fan_in=fan_in, compress=compress_runs, check=True)
+        runs = _make_runs(chunks, delimiter, tmpdir, memory_mb, workers, compress_runs)
+        logging.log(20, "Merging {} sorted runs".format(len(runs)))
+        return _merge_runs(runs, out, delimiter, tmpdir, compress=compress_runs)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def external_sort(file, delimiter, path, memory_mb=SORT_MEMORY_MB, workers=SORT_WORKERS):
+    """ Sorts a file in one pass on (CUST_ID, IMPRESSION_TIMESTAMP). The sorted output is written
+        to a temporary file which then replaces the original.
+    Args:
+        file (string): File to sort
+        delimiter (string): File delimiter
+        path (string): Path of temporary sorting directory
+        memory_mb (int): Memory budget for run generation
+        workers (int): Number of sorting processes
+    Returns:
+        Number of lines sorted
+    """
+    sorted_file = "{file}.sorted".format(file=file)
+    try:
+        with open(sorted_file, 'wb') as out:
+            count = sort_stream(iter_file(file), out, delimiter, path, memory_mb, workers)
+        os.replace(sorted_file, file)
+    except Exception as e:
+        if os.path.exists(sorted_file):
+            os.remove(sorted_file)
+        raise FileError("File sort failed: {}\n{}".format(file, e))
+    logging.log(20, "Sorted {} lines in {}".format(count, file))
+    return count
+
+
+def merge_parts(chunks, part_sizes, file, delimiter, path):
+    """ Merges a stream of pre-sorted parts (see sort_stream) into a file, without a full sort
+    Args:
+        chunks: Iterable of bytes (e.g. an S3 stream)
+        part_sizes (list(int)): Size of each part in the stream, in order
+        file (string): File to write
+        delimiter (string): File delimiter
+        path (string): Directory for spill files
+    Returns:
+        Number of lines written
+    """
+    try:
+        with open(file, 'wb') as out:
+            count = sort_stream(chunks, out, delimiter, path, part_sizes=part_sizes)
+    except Exception as e:
+        if os.path.exists(file):
+            os.remove(file)
+        raise FileError("Merge of sorted parts failed: {}\n{}".format(file, e))
+    logging.log(20, "Merged {} lines from {} parts into {}".format(count, len(part_sizes), file))
+    return count
+
+
+class ParallelGzipFile(object):
+    """ Write-only gzip file that compresses independent blocks on a pool of threads (zlib
+        releases the GIL). Each block becomes its own gzip member; the members are written in
+        order, so the result is a standard multi-member gzip stream readable by any client.
+    """
+    def __init__(self, filename, workers, block_size=GZIP_BLOCK_SIZE, compresslevel=GZIP_LEVEL):
+        self._file = open(filename, 'wb')
+        self._pool = ContextThreadPoolExecutor(max_workers=workers)
+        self._window = deque()
+        self._max_window = 2 * workers
+        self._buffer = bytearray()
+        self._block_size = block_size
+        self._compresslevel = compresslevel
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        """Queues the buffered block for compression, draining finished blocks in order"""
+        block = bytes(self._buffer)
+        self._buffer = bytearray()
+        while len(self._window) >= self._max_window:
+            self._file.write(self._window.popleft().result())
+        self._window.append(self._pool.submit(gzip.compress, block, self._compresslevel))
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit()
+            while self._window:
+                self._file.write(self._window.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TeeWriter(object):
+    """ Write-through wrapper around a binary file object that also writes everything to a tap
+        (e.g. chunk_tap.ChunkTap), so the tap sees the lines of a pass we already make
+    """
+
+    def __init__(self, out, tap):
+        self.out = out
+        self.tap = tap
+
+    def write(self, data):
+        self.tap.write(data)
+        return self.out.write(data)
+
+
+def open_gzip(zipfile, workers=1):
+    """ Opens a gzip file for writing, block-parallel when workers > 1
+    Args:
+        zipfile (string): Gzip file to write
+        workers (int): Number of compression threads
+    """
+    if workers and workers > 1:
+        return ParallelGzipFile(zipfile, workers)
+    return gzip.open(zipfile, 'wb', compresslevel=GZIP_LEVEL)
+
+
+def sort_to_gzip(chunks, zipfile, delimiter, path, memory_mb=SORT_MEMORY_MB, workers=SORT_WORKERS, gzip_workers=1,
+                 part_sizes=None, tap=None):
+    """ Sorts a stream of delimited lines straight into a gzip file. Spill runs are compressed,
+        so no full uncompressed copy of the data is ever written to disk.
+    Args:
+        chunks: Iterable of bytes (e.g. an S3 stream)
+        zipfile (string): Gzip file to write
+        delimiter (string): File delimiter
+        path (string): Directory for spill files
+        memory_mb (int): Memory budget for run generation
+        workers (int): Number of sorting processes
+        gzip_workers (int): Number of compression threads
+        part_sizes (list(int)): Sizes of the pre-sorted parts making up the stream (optional, see sort_stream)
+        tap: Writable also given the sorted lines, e.g. a chunk_tap.ChunkTap (optional)
+    Returns:
+        Number of lines written
+    """
+    try:
+        with open_gzip(zipfile, gzip_workers) as out:
+            count = sort_stream(chunks, TeeWriter(out, tap) if tap else out, delimiter, path, memory_mb, workers,
+                                compress_runs=True, part_sizes=part_sizes)
+    except Exception as e:
+        if os.path.exists(zipfile):
+            os.remove(zipfile)
+        raise FileError("Sort to gzip failed: {}\n{}".format(zipfile, e))
+    logging.log(20, "Sorted {} lines into {}".format(count, zipfile))
+    return count
+
+
+def zip(file, workers=1, tap=None):
+    """ Zips a file
+    Args:
+        file (string): File to zip
+        workers (int): Number of compression threads; > 1 compresses blocks in parallel
+        tap: Writable also given the file's lines, e.g. a chunk_tap.ChunkTap (optional)
+    """
     zipfile = "{file}.gz".format(file=file)
     try:
         with open(file, 'rb') as f_in:
-            with gzip.open(zipfile, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            with open_gzip(zipfile, workers) as f_out:
+                shutil.copyfileobj(f_in, TeeWriter(f_out, tap) if tap else f_out, READ_SIZE)
         return zipfile
     except:
         #logging.log(40, "Unable to zip file {}".format(filename))